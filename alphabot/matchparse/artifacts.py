@@ -3,37 +3,47 @@ import cv2
 import numpy as np
 
 from .base import draw_bboxes
+from .image_context import get_image_context
+from .resolution import scale_px
 
-# TODO: these should not be flat pixel numbers, it should scale w/ something (e.g. size of a reference object, or entire image)
+# pixel sizes at resolution.CANONICAL_HEIGHT
 MIN_WIDTH = 20
 MIN_HEIGHT = 20
 
 EXPECTED_NUM_ARTIFACTS = 24
 
 
-def get_artifact_bboxes(image, min_x=None):
+def get_artifact_bboxes(image, min_x=None, context=None):
+    """Find the artifact bboxes right of ``min_x`` (default: a quarter of the width).
+
+    ``context`` is the screenshot's ImageContext, the gray/binary planes are
+    shared with the hero detection.
+
+    """
     if min_x is None:
         _, width = image.shape[:2]
         min_x = width//4
-    left_side = image[:, min_x:]
 
-    gray = cv2.cvtColor(left_side, cv2.COLOR_BGR2GRAY)
-    _, binary = cv2.threshold(gray, 85, 255, cv2.THRESH_BINARY)
-    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    # cv2.imwrite('testartifacts.png', binary)
+    context = get_image_context(image, context)
+    # contours are in whole image coordinates
+    contours = context.get_contours(min_x=min_x)
+    # cv2.imwrite('testartifacts.png', context.binary[:, min_x:])
 
-    image_copy = image.copy()
-    for c in contours:
-        x, y, w, h = cv2.boundingRect(c)
-        cv2.rectangle(image_copy, (min_x+x, y), (min_x+x+w, y+h), (255, 0, 0), 2)
+    # image_copy = image.copy()
+    # for c in contours:
+    #     x, y, w, h = cv2.boundingRect(c)
+    #     cv2.rectangle(image_copy, (x, y), (x+w, y+h), (255, 0, 0), 2)
     # cv2.imwrite('testartifacts_contours.png', image_copy)
 
+    min_width = scale_px(MIN_WIDTH, image)
+    min_height = scale_px(MIN_HEIGHT, image)
+
     bboxes = []
     square_contours = []
     polygons = []
     for contour in contours:
         cx, cy, cw, ch = cv2.boundingRect(contour)
-        if cw < MIN_WIDTH or ch < MIN_HEIGHT:
+        if cw < min_width or ch < min_height:
             continue
 
         aspect_ratio = float(cw) / ch  # NOTE: do you need the float here?
@@ -47,11 +57,11 @@ def get_artifact_bboxes(image, min_x=None):
         approx = cv2.approxPolyDP(contour, epsilon, True)
         polygons.append(approx)
 
-        # print(f'{min_x+cx},{cy},{cw},{ch} - {aspect_ratio} {is_squareish} - {len(approx)}')
+        # print(f'{cx},{cy},{cw},{ch} - {aspect_ratio} {is_squareish} - {len(approx)}')
 
         if len(approx) == 4:
             x, y, w, h = cv2.boundingRect(approx)
-            bbox = (min_x+x, y, w, h)
+            bbox = (x, y, w, h)
             bboxes.append(bbox)
 
     inferred_bboxes = []
@@ -68,7 +78,7 @@ def get_artifact_bboxes(image, min_x=None):
             x, y, w, h = cv2.boundingRect(approx)
             
             if expected_min_size <= w <= expected_max_size:
-                bbox = min_x+x, y, w, h
+                bbox = x, y, w, h
                 inferred_bboxes.append(bbox)
 
     # image_copy = image.copy()
@@ -0,0 +1,380 @@
+"""Template based reader for the genre EXP numbers.
+
+The EXP numbers are rendered in a fixed game font, so most of them can be
+read by matching each digit against a small atlas of glyph templates
+instead of running EasyOCR:
+
+ - threshold the crop and split it into glyphs with connected components
+ - resize every glyph to GLYPH_SIZE and normalize it
+ - correlate it against every template in the atlas (one matrix product)
+
+Crops where any glyph scores below the threshold are left for the OCR
+fallback, and so is every crop while the atlas is missing any of the digits
+0-9: a glyph always has a best template, even when its own digit has none.
+
+The curated atlas at DEFAULT_ATLAS_PATH is built from saved genre icons,
+with confident EasyOCR reads as the labels:
+
+    python -m matchparse.digits output/genres
+
+On top of it the glyphs of EXP numbers EasyOCR reads with at least
+LEARN_MIN_CONFIDENCE are learned (up to MAX_TEMPLATES_PER_DIGIT per digit),
+unless they disagree with the templates already there (see ``learn``). The
+learned glyphs are kept in memory until ``take_learned``/``merge`` hand them
+to the process that saves them (the bot, or the parent of the parser
+workers).
+
+"""
+import argparse
+import glob
+import logging
+import os
+import threading
+
+from collections import Counter
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ATLAS_PATH = os.path.join(os.path.dirname(__file__), 'data', 'digit_atlas.npz')
+
+# OCR reads confident enough to learn the glyphs from
+LEARN_MIN_CONFIDENCE = 0.9
+
+GLYPH_SIZE = (12, 16)  # (width, height)
+MATCH_THRESHOLD = 0.8
+MAX_DIGITS = 3
+MAX_TEMPLATES_PER_DIGIT = 20
+# learned glyphs this close to a template of their digit add nothing to the atlas
+DUPLICATE_SCORE = 0.98
+
+DIGITS = tuple(range(10))
+
+# glyph filters, relative to the crop
+MIN_GLYPH_HEIGHT_PERC = 0.3
+MIN_GLYPH_AREA_PERC = 0.01
+GLYPH_HEIGHT_TOLERANCE = 0.25
+
+
+def normalize_glyph(glyph):
+    """Resize a binary glyph to GLYPH_SIZE and return it as a zero mean, unit norm vector."""
+    resized = cv2.resize(glyph.astype(np.float32), GLYPH_SIZE, interpolation=cv2.INTER_AREA)
+    vector = resized.ravel()
+    vector = vector - vector.mean()
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return vector
+
+    return vector / norm
+
+
+def get_glyph_components(crop):
+    """Return (label image, [(x, y, w, h, label)]) of the glyphs in a gray crop, ordered left to right."""
+    if crop.ndim == 3:
+        crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+
+    height, width = crop.shape[:2]
+    if height == 0 or width == 0:
+        return None, []
+
+    _, binary = cv2.threshold(crop, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+
+    min_height = MIN_GLYPH_HEIGHT_PERC * height
+    min_area = MIN_GLYPH_AREA_PERC * height * width
+    candidates = []
+    for label in range(1, num_labels):  # 0 is the background
+        x, y, w, h, area = stats[label]
+        if h < min_height or area < min_area:
+            continue
+        if h >= height or w >= width:
+            # touches the whole crop, this is background/icon and not a digit
+            continue
+        candidates.append((x, y, w, h, label))
+
+    if not candidates:
+        return labels, []
+
+    max_height = max(c[3] for c in candidates)
+    candidates = [c for c in candidates if (max_height - c[3]) / max_height <= GLYPH_HEIGHT_TOLERANCE]
+    return labels, sorted(candidates, key=lambda c: c[0])
+
+
+def get_digits_bbox(crop):
+    """(x0, y0, x1, y1) around all glyphs of a gray crop, None if there are none."""
+    _, candidates = get_glyph_components(crop)
+    if not candidates:
+        return None
+
+    return (min(c[0] for c in candidates), min(c[1] for c in candidates),
+            max(c[0] + c[2] for c in candidates), max(c[1] + c[3] for c in candidates))
+
+
+def segment_digits(crop):
+    """Split a gray crop into glyphs, ordered left to right.
+
+    Returns a list of normalized glyph vectors (see ``normalize_glyph``).
+
+    """
+    labels, candidates = get_glyph_components(crop)
+    glyphs = []
+    for x, y, w, h, label in candidates:
+        glyph = labels[y:y+h, x:x+w] == label
+        glyphs.append(normalize_glyph(glyph))
+
+    return glyphs
+
+
+class DigitReader:
+    """Read numbers by correlating glyphs against an atlas of digit templates.
+
+    ``counts`` tracks how many crops were read from the templates and how
+    many were left for the OCR fallback, since the reader was created, and
+    how many learned crops were rejected. ``path`` is where ``save`` writes
+    the atlas to.
+
+    """
+
+    def __init__(self, atlas=None, threshold=MATCH_THRESHOLD, path=None):
+        self.threshold = threshold
+        self.path = path
+        self.counts = Counter()
+        # the atlas grew since it was loaded/saved
+        self.is_changed = False
+        self._lock = threading.Lock()
+        # (digit, glyph) learned since the last take_learned
+        self._learned = []
+        self._set_atlas(atlas or {})
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_ATLAS_PATH, threshold=MATCH_THRESHOLD, fallback_path=DEFAULT_ATLAS_PATH):
+        """Load the atlas at ``path``, or the one at ``fallback_path`` (the curated atlas) if there is none yet."""
+        atlas = {}
+        for filepath in (path, fallback_path):
+            if filepath and os.path.exists(filepath):
+                with np.load(filepath) as data:
+                    atlas = {int(digit): data[digit] for digit in data.files}
+                break
+        else:
+            logger.warning('No digit atlas found at %s, the genre EXP numbers are read with OCR', path)
+
+        return cls(atlas, threshold=threshold, path=path)
+
+    def _set_atlas(self, atlas):
+        self.atlas = {digit: np.asarray(templates, dtype=np.float32) for digit, templates in atlas.items()}
+        if self.atlas:
+            templates = np.concatenate([self.atlas[d] for d in sorted(self.atlas)])
+            labels = np.concatenate([[d] * len(self.atlas[d]) for d in sorted(self.atlas)])
+        else:
+            templates = np.zeros((0, GLYPH_SIZE[0] * GLYPH_SIZE[1]), dtype=np.float32)
+            labels = np.zeros(0, dtype=int)
+        # swapped in one assignment, match() may run in another thread
+        self._table = templates, labels
+
+    @property
+    def is_complete(self):
+        """Whether every digit 0-9 has a template, the matches are not trusted before."""
+        return all(len(self.atlas.get(digit, ())) > 0 for digit in DIGITS)
+
+    def save(self, path=None):
+        path = path or self.path or DEFAULT_ATLAS_PATH
+        with self._lock:
+            atlas = dict(self.atlas)
+            self.is_changed = False
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # np.savez adds .npz to names without it
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez_compressed(tmp_path, **{str(digit): templates for digit, templates in atlas.items()})
+        os.replace(tmp_path, path)
+
+    def match(self, crop):
+        """Return (number, score) for the crop, or (None, score) if it cannot be read.
+
+        The score is that of the worst glyph against its best template.
+
+        """
+        templates, labels = self._table
+        glyphs = segment_digits(crop)
+        if not glyphs or len(glyphs) > MAX_DIGITS or len(labels) == 0:
+            return None, 0.0
+
+        scores = np.stack(glyphs) @ templates.T  # (num glyphs, num templates)
+        best = scores.argmax(axis=1)
+        digits = labels[best]
+        score = float(scores[np.arange(len(glyphs)), best].min())
+
+        number = int(''.join(str(d) for d in digits))
+        return number, score
+
+    def read(self, crop):
+        """Return (exp, conf) when the templates are confident, otherwise None."""
+        if self.is_complete:
+            number, score = self.match(crop)
+            is_hit = number is not None and score >= self.threshold
+        else:
+            is_hit = False
+
+        with self._lock:
+            self.counts['template' if is_hit else 'fallback'] += 1
+
+        if not is_hit:
+            return None
+
+        return number, score
+
+    def hit_rates(self):
+        """Fraction of crops handled by each reader (template vs OCR fallback), since the reader was created."""
+        total = self.counts['template'] + self.counts['fallback']
+        if total == 0:
+            return {'template': 0.0, 'fallback': 0.0}
+
+        return {name: self.counts[name] / total for name in ('template', 'fallback')}
+
+    def _check_glyph(self, digit, glyph):
+        """Return 'new', 'duplicate' or 'conflict' for a glyph labeled ``digit``."""
+        templates, labels = self._table
+        scores = templates @ glyph
+        is_own = labels == digit
+        own_best = scores[is_own].max() if is_own.any() else None
+        other_best = scores[~is_own].max() if (~is_own).any() else -1.0
+
+        if own_best is not None and own_best < self.threshold:
+            # does not look like the known glyphs of its digit
+            return 'conflict'
+        if other_best >= self.threshold and (own_best is None or other_best > own_best):
+            # looks like another digit, e.g. a "7" read as "1" before there was any "7"
+            return 'conflict'
+        if own_best is not None and own_best >= DUPLICATE_SCORE:
+            return 'duplicate'
+
+        return 'new'
+
+    def learn(self, crop, text):
+        """Add the glyphs of a crop whose number is known (e.g. a confident OCR read).
+
+        The whole crop is rejected if one of its glyphs looks like another
+        digit's templates or unlike its own, a single misread would otherwise
+        stay in the atlas for good. Returns whether any glyph was added.
+
+        """
+        if not text.isnumeric():
+            return False
+
+        glyphs = segment_digits(crop)
+        if len(glyphs) != len(text):
+            return False
+
+        return self.merge([(int(char), glyph) for char, glyph in zip(text, glyphs)])
+
+    def merge(self, glyphs):
+        """Add (digit, glyph) pairs, e.g. learned in a parser worker, with the same checks as ``learn``."""
+        if not glyphs:
+            return False
+
+        with self._lock:
+            checks = [self._check_glyph(digit, glyph) for digit, glyph in glyphs]
+            if 'conflict' in checks:
+                self.counts['rejected'] += 1
+                return False
+
+            atlas = {digit: list(templates) for digit, templates in self.atlas.items()}
+            added = []
+            for (digit, glyph), check in zip(glyphs, checks):
+                templates = atlas.setdefault(digit, [])
+                if check == 'new' and len(templates) < MAX_TEMPLATES_PER_DIGIT:
+                    templates.append(glyph)
+                    added.append((digit, glyph))
+
+            if added:
+                self._set_atlas(atlas)
+                self._learned.extend(added)
+                self.is_changed = True
+
+        return bool(added)
+
+    def take_learned(self):
+        """Return the (digit, glyph) pairs learned since the last take and forget them."""
+        with self._lock:
+            learned = self._learned
+            self._learned = []
+        return learned
+
+    def save_if_changed(self):
+        """Save the atlas to ``path`` if it learned new glyphs."""
+        if self.path is None or not self.is_changed:
+            return False
+
+        self.save()
+        return True
+
+
+_DIGIT_READER = None
+_DIGIT_READER_LOCK = threading.Lock()
+
+
+def configure(path=None):
+    """Load the process-wide DigitReader from ``path`` (or the curated atlas), learned glyphs are saved to it.
+
+    Only the process that saves should pass a path, see ``save_if_changed``.
+
+    """
+    global _DIGIT_READER
+    with _DIGIT_READER_LOCK:
+        _DIGIT_READER = DigitReader.from_file(path)
+
+    return _DIGIT_READER
+
+
+def get_digit_reader():
+    """Return the process-wide DigitReader, loading the atlas on first use."""
+    global _DIGIT_READER
+    with _DIGIT_READER_LOCK:
+        if _DIGIT_READER is None:
+            # the curated atlas, read only
+            _DIGIT_READER = DigitReader.from_file(None)
+
+    return _DIGIT_READER
+
+
+def build_atlas(icon_filepaths, reader, min_confidence=LEARN_MIN_CONFIDENCE):
+    """Build a DigitReader from genre icons, using EasyOCR reads as the labels."""
+    from . import genres, ocr
+
+    crops = []
+    for filepath in icon_filepaths:
+        icon = cv2.imread(filepath)
+        if icon is None:
+            continue
+        height, width = icon.shape[:2]
+        crops.append(genres.get_genre_exp_crop(icon, (0, 0, width, height)))
+
+    digit_reader = DigitReader()
+    texts = ocr.as_backend(reader).recognize_crops(crops, allowlist='0123456789')
+    num_learned = 0
+    for crop, (text, conf) in zip(crops, texts):
+        if conf >= min_confidence and digit_reader.learn(crop, text):
+            num_learned += 1
+
+    print(f'Learned glyphs from {num_learned} / {len(crops)} genre icons '
+          f'({digit_reader.counts["rejected"]} rejected), digits: {sorted(digit_reader.atlas)}')
+    if not digit_reader.is_complete:
+        print('WARNING: some digits have no template, the atlas is not used until it has all of 0-9')
+    return digit_reader
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the genre EXP digit atlas from saved genre icons.')
+    parser.add_argument('icon_dir', help='directory with saved genre icons (e.g. output/genres)')
+    parser.add_argument('-o', '--output', default=DEFAULT_ATLAS_PATH)
+    parser.add_argument('--min-confidence', type=float, default=LEARN_MIN_CONFIDENCE)
+    args = parser.parse_args()
+
+    from .ocr import create_reader
+
+    icon_filepaths = sorted(glob.glob(os.path.join(args.icon_dir, '*.png')))
+    digit_reader = build_atlas(icon_filepaths, create_reader(), min_confidence=args.min_confidence)
+    digit_reader.save(args.output)
+    print(f'Saved digit atlas to: {args.output}')
@@ -9,7 +9,7 @@ import math
 import cv2
 import numpy as np
 
-from . import hashes
+from . import digits, hashes
 
 from collections import Counter
 from functools import lru_cache
@@ -26,6 +26,9 @@ FACTOR_SPACING_GAPS = 0.043
 
 PADDING = 3
 
+# margin around the EXP digits sent to recognition, relative to their height (CRAFT boxes have about as much)
+GENRE_EXP_TEXT_MARGIN = 0.25
+
 GENRES = ['Crit', 'Evasion', 'Frost', 'Heal',
           'Health', 'Innerfire', 'Mech', 'Shield',
           'Spell', 'Toxin', 'Vulnerable', 'Weaponry'
@@ -124,60 +127,50 @@ def infer_genre_bboxes(player_artifact_bboxes, reference_width, base_x):
     return genre_bboxes
 
 
-def detect_yellow_bboxes(image, min_area_perc=0.005, bottom_region_ratio=0.4):
-    # Convert to HSV color space (better for color detection)
-    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    #cv2.imwrite('genrehsv.png', hsv)
+# yellow star range in HSV
+YELLOW_LOWER = np.array([20, 70, 150])
+YELLOW_UPPER = np.array([30, 255, 255])
 
-    # Define range for yellow colors in HSV
-    lower_yellow = np.array([20, 70, 150])
-    upper_yellow = np.array([30, 255, 255])
+STAR_MIN_AREA_PERC = 0.005
+STAR_BOTTOM_REGION_RATIO = 0.4
+# blank pixels around every icon in get_genre_levels, at least the opening kernel size
+STAR_TILE_PADDING = 2
 
-    # Create a mask for yellow regions
-    mask = cv2.inRange(hsv, lower_yellow, upper_yellow)
+
+def get_yellow_mask(hsv):
+    """Yellow mask of an HSV image, opened to remove some background noise."""
+    mask = cv2.inRange(hsv, YELLOW_LOWER, YELLOW_UPPER)
     #cv2.imwrite('genremask.png', mask)
 
-    # remove some background noise
     kernel = np.ones((2,2), np.uint8)
     mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=1)
     #cv2.imwrite('genremask2.png', mask)
+    return mask
 
-    # Focus only on the bottom region of the image
-    height = image.shape[0]
-    bottom_start = int(height * (1 - bottom_region_ratio))
-    bottom_region = mask[bottom_start:height, :]
-    _h, _w = bottom_region.shape[:2]
-    bottom_area = _h * _w
-    min_area = int(min_area_perc * bottom_area)
 
-    # Find contours in the bottom region
-    contours, _ = cv2.findContours(bottom_region, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    # Filter contours by area and adjust their coordinates (since we cropped the region)
+def split_star_contours(contours):
+    """Split the too wide star contours in two and drop the ones much narrower than the widest."""
     yellow_contours = []
     for cnt in contours:
-        if cv2.contourArea(cnt) > min_area:
-            # Adjust contour coordinates to full image space
-            cnt_adjusted = cnt + [0, bottom_start]
-
-            # Check aspect ratio
-            x, y, w, h = cv2.boundingRect(cnt_adjusted)
-            aspect_ratio = float(w)/h
-
-            if aspect_ratio > 1.8:
-                # "hack" mostly in place to catch when shield icons
-                # merge the second and third star
-                # Left half
-                left_half = cnt_adjusted.copy()
-                left_half[:, :, 0] = np.clip(left_half[:, :, 0], x, x + w//2)
-
-                # Right half
-                right_half = cnt_adjusted.copy()
-                right_half[:, :, 0] = np.clip(right_half[:, :, 0], x + w//2, x + w)
-
-                yellow_contours.extend([left_half, right_half])
-            else:
-                yellow_contours.append(cnt_adjusted)
-    
+        # Check aspect ratio
+        x, y, w, h = cv2.boundingRect(cnt)
+        aspect_ratio = float(w)/h
+
+        if aspect_ratio > 1.8:
+            # "hack" mostly in place to catch when shield icons
+            # merge the second and third star
+            # Left half
+            left_half = cnt.copy()
+            left_half[:, :, 0] = np.clip(left_half[:, :, 0], x, x + w//2)
+
+            # Right half
+            right_half = cnt.copy()
+            right_half[:, :, 0] = np.clip(right_half[:, :, 0], x + w//2, x + w)
+
+            yellow_contours.extend([left_half, right_half])
+        else:
+            yellow_contours.append(cnt)
+
     if len(yellow_contours) == 0:
         return yellow_contours
 
@@ -197,10 +190,38 @@ def detect_yellow_bboxes(image, min_area_perc=0.005, bottom_region_ratio=0.4):
     return yellow_contours
 
 
-def get_genre_level(image, bbox):
+def detect_yellow_bboxes(image, min_area_perc=STAR_MIN_AREA_PERC, bottom_region_ratio=STAR_BOTTOM_REGION_RATIO,
+                         hsv=None):
+    # Convert to HSV color space (better for color detection)
+    # callers with an ImageContext pass in the icon's slice of its HSV plane
+    if hsv is None:
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    #cv2.imwrite('genrehsv.png', hsv)
+
+    mask = get_yellow_mask(hsv)
+
+    # Focus only on the bottom region of the image
+    height = image.shape[0]
+    bottom_start = int(height * (1 - bottom_region_ratio))
+    bottom_region = mask[bottom_start:height, :]
+    _h, _w = bottom_region.shape[:2]
+    bottom_area = _h * _w
+    min_area = int(min_area_perc * bottom_area)
+
+    # Find contours in the bottom region
+    contours, _ = cv2.findContours(bottom_region, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # Filter contours by area and adjust their coordinates (since we cropped the region)
+    # to full image space
+    contours = [cnt + [0, bottom_start] for cnt in contours if cv2.contourArea(cnt) > min_area]
+
+    return split_star_contours(contours)
+
+
+def get_genre_level(image, bbox, context=None):
     x, y, w, h = bbox
     icon = image[y:y+h, x:x+w]
-    yellow_contours = detect_yellow_bboxes(icon)
+    hsv = None if context is None else context.hsv[y:y+h, x:x+w]
+    yellow_contours = detect_yellow_bboxes(icon, hsv=hsv)
 
     # Adjust contour coordinates to be relative to original image
     adjusted_contours = []
@@ -212,6 +233,99 @@ def get_genre_level(image, bbox):
     return len(yellow_contours), adjusted_contours
 
 
+def get_genre_levels(image, bboxes, context=None, min_area_perc=STAR_MIN_AREA_PERC,
+                     bottom_region_ratio=STAR_BOTTOM_REGION_RATIO):
+    """Star level and star contours of every genre bbox, see ``get_genre_level``.
+
+    Instead of masking every icon on its own, the bottom strip of every icon
+    is copied into one mosaic, side by side with STAR_TILE_PADDING blank
+    pixels around each. The yellow mask is built once for the mosaic and the
+    stars are found with a single connected components pass, then assigned
+    to the tile they are in. The wide star split and the width filter are
+    applied per bbox.
+
+    The opening looks at the neighbouring pixels, so every tile starts
+    STAR_TILE_PADDING rows above the bottom region (within the icon), and
+    the padding acts like the edge of a cropped icon: never eroded into,
+    never dilated from.
+
+    """
+    if not bboxes:
+        return []
+
+    height, width = image.shape[:2]
+    pad = STAR_TILE_PADDING
+    # (x0, tile y0, bottom start, x1, y1) of every icon, clipped like cropping it would
+    tiles = []
+    for x, y, w, h in bboxes:
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(width, x + w), max(0, min(height, y + h))
+        bottom_start = y0 + int(max(0, y1 - y0) * (1 - bottom_region_ratio))
+        tiles.append((x0, max(y0, bottom_start - pad), bottom_start, max(x0, x1), max(y0, y1)))
+    tiles = np.array(tiles).reshape(-1, 5)
+    tile_widths = tiles[:, 3] - tiles[:, 0]
+    tile_heights = tiles[:, 4] - tiles[:, 1]
+
+    # left edge of every tile in the mosaic
+    mosaic_xs = pad + np.concatenate([[0], np.cumsum(tile_widths + pad)[:-1]])
+    mosaic_width = int(mosaic_xs[-1] + tile_widths[-1] + pad)
+    mosaic_height = int(tile_heights.max() + 2 * pad)
+
+    plane = image if context is None else context.hsv
+    mosaic = np.zeros((mosaic_height, mosaic_width, 3), dtype=np.uint8)
+    is_padding = np.ones((mosaic_height, mosaic_width), dtype=bool)
+    is_bottom = np.zeros((mosaic_height, mosaic_width), dtype=bool)
+    for (x0, tile_y0, bottom_start, x1, y1), mx in zip(tiles.tolist(), mosaic_xs.tolist()):
+        mosaic[pad:pad + y1 - tile_y0, mx:mx + x1 - x0] = plane[tile_y0:y1, x0:x1]
+        is_padding[pad:pad + y1 - tile_y0, mx:mx + x1 - x0] = False
+        is_bottom[pad + bottom_start - tile_y0:pad + y1 - tile_y0, mx:mx + x1 - x0] = True
+    if context is None:
+        mosaic = cv2.cvtColor(mosaic, cv2.COLOR_BGR2HSV)
+
+    # get_yellow_mask, with the padding treated like the image border of a cropped icon
+    mask = cv2.inRange(mosaic, YELLOW_LOWER, YELLOW_UPPER)
+    kernel = np.ones((2,2), np.uint8)
+    mask[is_padding] = 255
+    mask = cv2.erode(mask, kernel)
+    mask[is_padding] = 0
+    mask = cv2.dilate(mask, kernel)
+    mask[~is_bottom] = 0
+
+    # block based labeling, ~3x faster than the default (with stats) on a single thread
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(mask, 8, cv2.CV_32S,
+                                                                                cv2.CCL_BBDT)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    # the tile of every component (0 is the background), by its left edge
+    label2bbox = np.searchsorted(mosaic_xs, stats[:, cv2.CC_STAT_LEFT], side='right') - 1
+    label2bbox[0] = -1
+
+    bottom_areas = tile_widths * (tiles[:, 4] - tiles[:, 2])
+    min_areas = (min_area_perc * bottom_areas).astype(int)
+    # the contour area is never above the pixel count, no need to look at the smaller components
+    is_candidate = (label2bbox >= 0) & (stats[:, cv2.CC_STAT_AREA] > min_areas[label2bbox])
+
+    bbox2contours = [[] for _ in bboxes]
+    if contours:
+        # every external contour traces exactly one component, which its first point belongs to
+        first_points = np.array([cnt[0, 0] for cnt in contours])
+        contour_labels = labels[first_points[:, 1], first_points[:, 0]]
+
+        # back to image coordinates
+        offsets = np.column_stack([tiles[:, 0] - mosaic_xs, tiles[:, 1] - pad]).astype(np.int32)
+        candidates = np.flatnonzero(is_candidate[contour_labels])
+        for j, i in zip(candidates.tolist(), label2bbox[contour_labels[candidates]].tolist()):
+            if cv2.contourArea(contours[j]) > min_areas[i]:
+                bbox2contours[i].append(contours[j] + offsets[i])
+
+    genre_levels = []
+    for star_contours in bbox2contours:
+        star_contours = split_star_contours(star_contours)
+        genre_levels.append((len(star_contours), star_contours))
+
+    return genre_levels
+
+
 def get_top_right(image):
     height, width = image.shape[:2]
 
@@ -219,13 +333,41 @@ def get_top_right(image):
     return top_right
 
 
-def read_genre_exp(image, bbox, reader):
+def get_genre_exp_crop(image, bbox, context=None):
+    """Return the preprocessed (gray + blurred) top right corner where the EXP number is."""
     x, y, w, h = bbox
-    icon = image[y:y+h, x:x+w]
-    top_right = get_top_right(icon)
+    if context is None:
+        icon = image[y:y+h, x:x+w]
+        gray = cv2.cvtColor(get_top_right(icon), cv2.COLOR_BGR2GRAY)
+    else:
+        gray = get_top_right(context.gray[y:y+h, x:x+w])
 
-    gray = cv2.cvtColor(top_right, cv2.COLOR_BGR2GRAY)
     blurred = cv2.GaussianBlur(gray, (3,3), 0)
+    return blurred
+
+
+def get_genre_exp_text_crop(crop):
+    """Cut an EXP crop down to its digits plus a margin, like the text box readtext would recognize.
+
+    The whole crop is returned when no digits are found in it.
+
+    """
+    bbox = digits.get_digits_bbox(crop)
+    if bbox is None:
+        return crop
+
+    x0, y0, x1, y1 = bbox
+    height, width = crop.shape[:2]
+    margin = max(1, int(round(GENRE_EXP_TEXT_MARGIN * (y1 - y0))))
+    return crop[max(0, y0 - margin):min(height, y1 + margin), max(0, x0 - margin):min(width, x1 + margin)]
+
+
+def parse_genre_exp(num):
+    return int(num) if num.isnumeric() else -1
+
+
+def read_genre_exp(image, bbox, reader):
+    blurred = get_genre_exp_crop(image, bbox)
 
     texts = reader.readtext(blurred, allowlist='0123456789')
     if len(texts) > 1:
@@ -236,10 +378,42 @@ def read_genre_exp(image, bbox, reader):
         return -1, 0
 
     _, num, conf = texts[0][:3]
-    genre_exp = int(num) if num.isnumeric() else -1
+    genre_exp = parse_genre_exp(num)
     return genre_exp, conf
 
 
+def read_genre_exps(image, bboxes, ocr_backend, digit_reader=None, context=None):
+    """Read the EXP number of every genre bbox.
+
+    Numbers are matched against the digit templates first (see digits.py),
+    the rest go through a single batched recognition pass. Text detection is
+    skipped since the bboxes already locate the numbers, each crop is cut
+    down to its digits instead (get_genre_exp_text_crop), so the recognizer
+    sees about what it saw in the detected text box. Confident OCR reads are
+    added to the digit templates.
+    Returns the same (exp, conf) tuples as ``read_genre_exp``.
+
+    """
+    if digit_reader is None:
+        digit_reader = digits.get_digit_reader()
+
+    crops = [get_genre_exp_crop(image, bbox, context) for bbox in bboxes]
+    genre_exps = [digit_reader.read(crop) for crop in crops]
+
+    fallback_idxs = [i for i, genre_exp in enumerate(genre_exps) if genre_exp is None]
+    text_crops = [get_genre_exp_text_crop(crops[i]) for i in fallback_idxs]
+    texts = ocr_backend.recognize_crops(text_crops, allowlist='0123456789')
+    for i, (num, conf) in zip(fallback_idxs, texts):
+        if not num:
+            genre_exps[i] = (-1, 0)
+        else:
+            genre_exps[i] = (parse_genre_exp(num), conf)
+            if conf >= digits.LEARN_MIN_CONFIDENCE:
+                digit_reader.learn(crops[i], num)
+
+    return genre_exps
+
+
 def to_genre_shorthand(genre_name, genre_level, genre_exp):
     genre_code = get_genre_code(genre_name)
     return f'{genre_code}{genre_level}_{genre_exp:02d}'
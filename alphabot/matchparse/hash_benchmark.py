@@ -0,0 +1,73 @@
+"""Benchmark of the reference hash search methods (see hashes.SEARCH_METHODS).
+
+Compares the vectorized linear scan, the BK-tree and multi-index hashing on
+synthetic reference libraries of growing size:
+
+    python -m matchparse.hash_benchmark --sizes 1000 10000 100000
+
+"""
+import argparse
+import random
+import time
+
+import imagehash
+import numpy as np
+
+from .hashes import (HASH_BITS, HAMMING_TRAIT_THRESHOLD, SEARCH_METHOD_NAMES, Artifact, ReferenceTable,
+                     get_hash_to_artifact_info, get_hash_to_hero_info, get_hash_to_trait_info, words_to_int)
+
+
+def _make_library(size, max_flips, rng):
+    """Synthetic reference library: variants of the real reference hashes, like new patches add."""
+    base_hashes = list(get_hash_to_trait_info()) + list(get_hash_to_artifact_info()) + list(get_hash_to_hero_info())
+    hash2info = {}
+    while len(hash2info) < size:
+        value = int(rng.choice(base_hashes), 16)
+        for _ in range(rng.randint(0, max_flips)):
+            value ^= 1 << rng.randrange(HASH_BITS)
+        hex_hash = imagehash.hex_to_hash(f'{value:0{HASH_BITS // 4}x}')
+        hash2info[str(hex_hash)] = Artifact(f'icon_{len(hash2info) % (size // 4 + 1)}', str(hex_hash))
+
+    return ReferenceTable.from_hash2info(hash2info)
+
+
+def benchmark_search(sizes=(1000, 10000, 100000), hamming_threshold=HAMMING_TRAIT_THRESHOLD,
+                     num_queries=200, max_flips=12, seed=0):
+    """Compare the linear scan, the BK-tree and multi-index hashing as the reference library grows."""
+    rng = random.Random(seed)
+    for size in sizes:
+        table = _make_library(size, max_flips, rng)
+
+        queries = []
+        for _ in range(num_queries):
+            value = words_to_int(table.words[rng.randrange(len(table))])
+            for _ in range(rng.randint(0, max_flips)):
+                value ^= 1 << rng.randrange(HASH_BITS)
+            queries.append(imagehash.hex_to_hash(f'{value:0{HASH_BITS // 4}x}'))
+
+        t0 = time.time()
+        table.get_bktree()
+        table.get_multi_index(hamming_threshold - 1)
+        build_seconds = time.time() - t0
+
+        timings, results = {}, {}
+        for method in SEARCH_METHOD_NAMES:
+            t0 = time.time()
+            results[method] = [table.find_within(q, hamming_threshold, method) for q in queries]
+            timings[method] = (time.time() - t0) / num_queries
+
+        is_same = all(np.array_equal(results['linear'][i][0], results[method][i][0])
+                      for method in SEARCH_METHOD_NAMES for i in range(num_queries))
+        timing_string = ', '.join(f'{method} {seconds*1e6:.0f}us' for method, seconds in timings.items())
+        print(f'{size:>7} references (threshold {hamming_threshold}, indexes built in {build_seconds:.2f}s): '
+              f'{timing_string}, same results: {is_same}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reference hash search benchmark.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--threshold', type=int, default=HAMMING_TRAIT_THRESHOLD)
+    args = parser.parse_args()
+
+    benchmark_search(args.sizes, args.threshold)
+
@@ -1,13 +1,19 @@
+import logging
+import math
+import threading
+
 import cv2
 import imagehash
+import numpy as np
 
-from collections import namedtuple, defaultdict
+from collections import Counter, defaultdict, namedtuple
 from functools import lru_cache, partial
 
-from PIL import Image
 
 from .base import DEFAULT_HASH_SIZE
 
+logger = logging.getLogger(__name__)
+
 Artifact = namedtuple('Artifact', ['name', 'reference_hash'])
 Hero = namedtuple('Hero', ['name', 'reference_hash'])
 Trait = namedtuple('Trait', ['name', 'hero_name', 'reference_hash', 'color'])
@@ -535,30 +541,27 @@ GENRES = {'Crit': ['62188731ce3b8fe3f87a1d836',
           }
 
 
-@lru_cache
-def get_hash_to_hero_info():
+def build_hash_to_hero_info(heroes):
     hash_to_hero_info = {}
-    for hero_name, hashes in HEROES.items():
+    for hero_name, hashes in heroes.items():
         for hash in hashes:
             hash_to_hero_info[hash] = Hero(hero_name, hash)
     
     return hash_to_hero_info
 
 
-@lru_cache
-def get_hash_to_artifact_info():
+def build_hash_to_artifact_info(artifacts):
     hash_to_artifact_info = {}
-    for artifact_name, hashes in ARTIFACTS.items():
+    for artifact_name, hashes in artifacts.items():
         for hash in hashes:
             hash_to_artifact_info[hash] = Artifact(artifact_name, hash)
     
     return hash_to_artifact_info
 
 
-@lru_cache
-def get_hash_to_trait_info(hero=None, color=None):
+def build_hash_to_trait_info(traits, hero=None, color=None):
     hash_to_trait_info = {}
-    for hero_name, data in TRAITS.items():
+    for hero_name, data in traits.items():
         if hero and hero != hero_name:
             continue
 
@@ -573,23 +576,478 @@ def get_hash_to_trait_info(hero=None, color=None):
     return hash_to_trait_info
 
 
-@lru_cache
-def get_hash_to_genre_info():
+def build_hash_to_genre_info(genres):
     hash_to_genre_info = {}
-    for genre_nane, hashes in GENRES.items():
+    for genre_nane, hashes in genres.items():
         for hash in hashes:
             hash_to_genre_info[hash] = Genre(genre_nane, hash)
     
     return hash_to_genre_info
 
 
+@lru_cache
+def get_hash_to_hero_info():
+    return build_hash_to_hero_info(HEROES)
+
+
+@lru_cache
+def get_hash_to_artifact_info():
+    return build_hash_to_artifact_info(ARTIFACTS)
+
+
+@lru_cache
+def get_hash_to_trait_info(hero=None, color=None):
+    return build_hash_to_trait_info(TRAITS, hero, color)
+
+
+@lru_cache
+def get_hash_to_genre_info():
+    return build_hash_to_genre_info(GENRES)
+
+
+# hashes are packed into uint64 words so a whole table is matched with one XOR + popcount
+HASH_BITS = DEFAULT_HASH_SIZE * DEFAULT_HASH_SIZE
+HASH_WORDS = (HASH_BITS + 63) // 64
+_WORD_MASK = (1 << 64) - 1
+
+if hasattr(np, 'bitwise_count'):  # numpy >= 2.0
+    _popcount = np.bitwise_count
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def _popcount(words):
+        counts = _POPCOUNT_TABLE[words.view(np.uint8)]
+        return counts.reshape(*words.shape, 8).sum(axis=-1)
+
+
+def hex_to_words(hex_hash):
+    """Pack a hex hash (as used in the reference tables) into HASH_WORDS uint64 words."""
+    value = int(hex_hash, 16)
+    return [(value >> (64 * i)) & _WORD_MASK for i in reversed(range(HASH_WORDS))]
+
+
+def hash_to_words(image_hash):
+    """Pack an imagehash.ImageHash the same way as hex_to_words."""
+    return np.array(hex_to_words(str(image_hash)), dtype=np.uint64)
+
+
+def bits_to_words(bits):
+    """Pack (n, HASH_BITS) hash bits (e.g. from average_hash_bits) into (n, HASH_WORDS) words."""
+    bits = np.asarray(bits, dtype=bool).reshape(len(bits), -1)
+    padded = np.zeros((len(bits), HASH_WORDS * 64), dtype=bool)
+    padded[:, -bits.shape[1]:] = bits
+    return np.packbits(padded, axis=1).view('>u8').astype(np.uint64)
+
+
+def words_to_int(words):
+    value = 0
+    for word in words:
+        value = (value << 64) | int(word)
+    return value
+
+
+if hasattr(int, 'bit_count'):  # python >= 3.10
+    _int_popcount = int.bit_count
+else:
+    def _int_popcount(value):
+        return bin(value).count('1')
+
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes with the Hamming distance.
+
+    Every child edge is labelled with its distance to the parent, so by the
+    triangle inequality a query within ``max_distance`` of a node at
+    distance d only has to visit the children labelled d +- max_distance.
+
+    """
+
+    def __init__(self, values):
+        self.values = values
+        self.root = None
+        for row in range(len(values)):
+            self.add(row)
+
+    def add(self, row):
+        if self.root is None:
+            self.root = (row, {})
+            return
+
+        value = self.values[row]
+        node = self.root
+        while True:
+            distance = _int_popcount(value ^ self.values[node[0]])
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (row, {})
+                return
+            node = child
+
+    def query(self, value, max_distance):
+        """Return (distance, row) of every value within max_distance, lowest first.
+
+        ``num_visited`` is set to the number of distances computed.
+
+        """
+        results = []
+        self.num_visited = 0
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            row, children = stack.pop()
+            distance = _int_popcount(value ^ self.values[row])
+            self.num_visited += 1
+            if distance <= max_distance:
+                results.append((distance, row))
+
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+
+        return sorted(results)
+
+
+def _words_to_bits(words):
+    """(n, HASH_WORDS) packed words -> (n, HASH_BITS) bits, most significant first."""
+    as_bytes = np.ascontiguousarray(words, dtype='>u8').view(np.uint8).reshape(len(words), HASH_WORDS * 8)
+    return np.unpackbits(as_bytes, axis=1)[:, -HASH_BITS:]
+
+
+class MultiIndexHash:
+    """Multi-index hashing for "all references within max_distance".
+
+    The hash is split into max_distance + 1 chunks. By the pigeonhole
+    principle a reference within max_distance has at least one chunk that
+    is exactly equal to the query's, so only references sharing a chunk
+    value (looked up in a sorted array per chunk) are compared. Works best
+    for small thresholds, with the trait threshold (25) the 4 bit chunks
+    select almost everything.
+
+    """
+
+    def __init__(self, words, max_distance):
+        self.words = words
+        self.num_chunks = max(1, min(HASH_BITS, max_distance + 1))
+        self.bounds = np.linspace(0, HASH_BITS, self.num_chunks + 1).astype(int)
+
+        chunks = self._get_chunks(_words_to_bits(words))
+        self.sorted_rows = np.argsort(chunks, axis=0, kind='stable').T
+        self.sorted_chunks = np.take_along_axis(chunks, self.sorted_rows.T, axis=0).T
+
+    def _get_chunks(self, bits):
+        chunks = np.zeros((len(bits), self.num_chunks), dtype=np.int64)
+        for i, (start, stop) in enumerate(zip(self.bounds[:-1], self.bounds[1:])):
+            powers = 1 << np.arange(stop - start - 1, -1, -1, dtype=np.int64)
+            chunks[:, i] = bits[:, start:stop].astype(np.int64) @ powers
+        return chunks
+
+    def get_candidates(self, words):
+        """Rows sharing at least one chunk with the query."""
+        query_chunks = self._get_chunks(_words_to_bits(words[None, :]))[0]
+        candidates = []
+        for i, value in enumerate(query_chunks):
+            start = np.searchsorted(self.sorted_chunks[i], value, side='left')
+            stop = np.searchsorted(self.sorted_chunks[i], value, side='right')
+            candidates.append(self.sorted_rows[i][start:stop])
+
+        return np.unique(np.concatenate(candidates)).astype(np.int64)
+
+
+class ReferenceTable:
+    """A hash -> info table compiled into packed arrays.
+
+    ``words`` holds the packed reference hashes, ``infos`` and ``name_ids``
+    the matching info / name index for every row, in the insertion order of
+    the original dict. The arrays can also be views into a memory-mapped
+    reference index (see reference_index.py).
+
+    ``dhash_words`` / ``has_dhash`` hold the difference hash of the rows
+    whose reference icon is available (see the matching cascade below),
+    None when no row has one.
+
+    """
+
+    def __init__(self, words, infos, name_ids, dhash_words=None, has_dhash=None):
+        self.words = words
+        self.infos = infos
+        self.name_ids = name_ids
+        self.num_names = len(set(info.name for info in infos))
+        self.dhash_words = dhash_words
+        self.has_dhash = has_dhash
+        self._bktree = None
+        self._mih = {}
+
+    @classmethod
+    def from_hash2info(cls, hash2info, hash2dhash=None):
+        infos = list(hash2info.values())
+        words = np.array([hex_to_words(h) for h in hash2info], dtype=np.uint64).reshape(-1, HASH_WORDS)
+
+        names = sorted(set(info.name for info in infos))
+        name_to_id = {name: i for i, name in enumerate(names)}
+        name_ids = np.array([name_to_id[info.name] for info in infos], dtype=np.int32)
+
+        dhash_words, has_dhash = None, None
+        if hash2dhash and any(h in hash2dhash for h in hash2info):
+            has_dhash = np.array([h in hash2dhash for h in hash2info], dtype=bool)
+            dhash_words = np.zeros_like(words)
+            for i, h in enumerate(hash2info):
+                if h in hash2dhash:
+                    dhash_words[i] = hex_to_words(hash2dhash[h])
+
+        return cls(words, infos, name_ids, dhash_words, has_dhash)
+
+    def __len__(self):
+        return len(self.infos)
+
+    def distances(self, icon_hash):
+        """Hamming distance from the icon hash to every reference hash."""
+        return _popcount(self.words ^ hash_to_words(icon_hash)).sum(axis=1, dtype=np.int64)
+
+    def distance_matrix(self, icon_hashes):
+        """(num icons, num references) Hamming distances, computed once per distinct icon hash."""
+        if not icon_hashes:
+            return np.zeros((0, len(self)), dtype=np.int64)
+
+        words = np.stack([hash_to_words(h) for h in icon_hashes])
+        unique_words, inverse = np.unique(words, axis=0, return_inverse=True)
+        distances = _popcount(unique_words[:, None, :] ^ self.words[None, :, :]).sum(axis=2, dtype=np.int64)
+
+        return distances[inverse.ravel()]
+
+    def distance_at(self, row, icon_hash):
+        return int(_popcount(self.words[row] ^ hash_to_words(icon_hash)).sum())
+
+    def get_bktree(self):
+        if self._bktree is None:
+            self._bktree = BKTree([words_to_int(words) for words in self.words])
+        return self._bktree
+
+    def get_multi_index(self, max_distance):
+        if max_distance not in self._mih:
+            self._mih[max_distance] = MultiIndexHash(self.words, max_distance)
+        return self._mih[max_distance]
+
+    def find_within(self, icon_hash, hamming_threshold, method='linear'):
+        """Rows and distances of the references closer than the threshold, lowest distance first.
+
+        ``method`` is 'linear' (one vectorized scan over the table), 'bktree'
+        or 'mih' (multi-index hashing), the last two only compare a subset
+        of the table.
+
+        """
+        if method == 'linear':
+            distances = self.distances(icon_hash)
+            rows = np.flatnonzero(distances < hamming_threshold)
+            order = np.argsort(distances[rows], kind='stable')
+            return rows[order], distances[rows][order]
+        elif method == 'bktree':
+            results = self.get_bktree().query(words_to_int(hash_to_words(icon_hash)), hamming_threshold - 1)
+            rows = np.array([row for _, row in results], dtype=np.int64)
+            distances = np.array([distance for distance, _ in results], dtype=np.int64)
+            return rows, distances
+        elif method == 'mih':
+            query_words = hash_to_words(icon_hash)
+            candidates = self.get_multi_index(hamming_threshold - 1).get_candidates(query_words)
+            distances = _popcount(self.words[candidates] ^ query_words).sum(axis=1, dtype=np.int64)
+            is_close = distances < hamming_threshold
+            rows, distances = candidates[is_close], distances[is_close]
+            order = np.lexsort((rows, distances))
+            return rows[order], distances[order]
+
+        raise ValueError(f'Unknown search method: {method}. Expected one of {SEARCH_METHOD_NAMES}')
+
+    def match(self, icon_hash, hamming_threshold, unknown_obj, method='linear'):
+        """Return (info, icon_hash, hamming) of the closest reference under the threshold.
+
+        Returns the unknown object (with a 9999 hamming) when nothing is
+        under the threshold or when the closest hashes belong to different names.
+
+        """
+        rows, distances = self.find_within(icon_hash, hamming_threshold, method)
+        return self._resolve_candidates(rows, distances, icon_hash, unknown_obj)
+
+    def resolve(self, distances, icon_hash, hamming_threshold, unknown_obj):
+        """``match`` for distances that were already computed (a row of ``distance_matrix``)."""
+        rows = np.flatnonzero(distances < hamming_threshold)
+        return self._resolve_candidates(rows, distances[rows], icon_hash, unknown_obj)
+
+    def _resolve_candidates(self, rows, distances, icon_hash, unknown_obj):
+        if len(rows) == 0:
+            return unknown_obj, icon_hash, 9999
+
+        lowest_hamming = int(distances.min())
+        lowest_idxs = np.sort(rows[distances == lowest_hamming])
+        if len(np.unique(self.name_ids[lowest_idxs])) > 1:
+            lowest_infos = [self.infos[i] for i in lowest_idxs]
+            print(f'Found multiple hashes with hamming distance {lowest_hamming}: {lowest_infos} (icon hash: {icon_hash})')
+            return unknown_obj, icon_hash, 9999
+
+        return self.infos[lowest_idxs[0]], icon_hash, lowest_hamming
+
+
+def get_reference_table(icon_type, hero=None, color=None):
+    """Compiled ReferenceTable for an icon type ('hero', 'trait', 'artifact', 'genre').
+
+    Taken from the active reference library: the reference index file when
+    one was built (python -m matchparse.reference_index), otherwise compiled
+    from the tables above. The library can be swapped at runtime, see
+    reference_index.start_watcher.
+
+    """
+    from .reference_index import get_reference_library
+
+    return get_reference_library().get_table(icon_type, hero, color)
+
+
+def get_hash2info(icon_type, hero=None, color=None):
+    if icon_type == 'artifact':
+        hash2info = get_hash_to_artifact_info()
+    elif icon_type == 'hero':
+        hash2info = get_hash_to_hero_info()
+    elif icon_type == 'trait':
+        hash2info = get_hash_to_trait_info(hero, color)
+    elif icon_type == 'genre':
+        hash2info = get_hash_to_genre_info()
+    else:
+        raise ValueError('Unknown icon type')
+
+    return hash2info
+
+
+def preload_reference_tables():
+    """Build every reference table up front (e.g. before forking workers, so they share them)."""
+    from .reference_index import get_reference_library
+
+    return get_reference_library().preload()
+
+
+# imagehash.average_hash(Image.fromarray(crop)) reimplemented in numpy, so a
+# whole screenshot of crops is hashed without a PIL image per icon. The
+# grayscale conversion and the Lanczos resize follow Pillow's fixed point
+# arithmetic so the hashes are bit-identical.
+LANCZOS_SUPPORT = 3.0
+_PIL_PRECISION_BITS = 32 - 8 - 2
+
+
+def _pil_gray(crops):
+    """Pillow's RGB -> L conversion of (N, h, w[, c]) crops. They are BGR, Pillow reads them as RGB all the same."""
+    if crops.ndim == 3:  # already gray
+        return crops.astype(np.int32)
+
+    crops = crops.astype(np.int32)
+    return (crops[..., 0] * 19595 + crops[..., 1] * 38470 + crops[..., 2] * 7471 + 0x8000) >> 16
+
+
+def _sinc(x):
+    if x == 0.0:
+        return 1.0
+    x = x * math.pi
+    return math.sin(x) / x
+
+
+def _lanczos(x):
+    if -LANCZOS_SUPPORT <= x < LANCZOS_SUPPORT:
+        return _sinc(x) * _sinc(x / LANCZOS_SUPPORT)
+    return 0.0
+
+
+@lru_cache(maxsize=None)
+def _get_resample_coeffs(in_size, out_size):
+    """(out_size, in_size) fixed point Lanczos weights, as Pillow's precompute_coeffs."""
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = LANCZOS_SUPPORT * filterscale
+    ss = 1.0 / filterscale
+
+    coeffs = np.zeros((out_size, in_size), dtype=np.float64)
+    for xx in range(out_size):
+        center = (xx + 0.5) * scale
+        xmin = max(int(center - support + 0.5), 0)
+        xmax = min(int(center + support + 0.5), in_size)
+
+        weights = [_lanczos((x - center + 0.5) * ss) for x in range(xmin, xmax)]
+        total = 0.0
+        for weight in weights:
+            total += weight
+
+        for x, weight in zip(range(xmin, xmax), weights):
+            if total != 0.0:
+                weight /= total
+            offset = -0.5 if weight < 0 else 0.5
+            coeffs[xx, x] = int(offset + weight * (1 << _PIL_PRECISION_BITS))
+
+    return coeffs
+
+
+def _pil_clip8(values):
+    # the weighted sums are integers well below 2**53, so the float matmul is exact
+    values = (values.astype(np.int64) + (1 << (_PIL_PRECISION_BITS - 1))) >> _PIL_PRECISION_BITS
+    return np.clip(values, 0, 255).astype(np.float64)
+
+
+def _pil_resize(grays, width, height):
+    """Pillow's Image.resize((width, height), LANCZOS) of (N, h, w) gray crops: horizontal pass, then vertical."""
+    _, in_height, in_width = grays.shape
+    grays = grays.astype(np.float64)
+    if in_width != width:
+        grays = _pil_clip8(grays @ _get_resample_coeffs(in_width, width).T)
+    if in_height != height:
+        grays = _pil_clip8(_get_resample_coeffs(in_height, height) @ grays)
+    return grays
+
+
+def resize_gray_crops(crops, width, height):
+    """Grayscale + Lanczos resize of every crop, (N, height, width) uint8.
+
+    Crops of the same shape are resized together.
+
+    """
+    shape_to_idxs = defaultdict(list)
+    for i, crop in enumerate(crops):
+        shape_to_idxs[crop.shape].append(i)
+
+    small = np.empty((len(crops), height, width), dtype=np.uint8)
+    for idxs in shape_to_idxs.values():
+        grays = _pil_gray(np.stack([crops[i] for i in idxs]))
+        small[idxs] = _pil_resize(grays, width, height)
+
+    return small
+
+
+def average_hash_bits(crops, hash_size=DEFAULT_HASH_SIZE):
+    """Average hash bits of every crop, (N, hash_size, hash_size) bool.
+
+    Same bits as imagehash.average_hash(Image.fromarray(crop), hash_size).
+
+    """
+    small = resize_gray_crops(crops, hash_size, hash_size)
+    means = small.reshape(len(crops), -1).mean(axis=1)
+    return small > means[:, None, None]
+
+
+def difference_hash_bits(crops, hash_size=DEFAULT_HASH_SIZE):
+    """Difference hash bits of every crop, (N, hash_size, hash_size) bool.
+
+    Same bits as imagehash.dhash(Image.fromarray(crop), hash_size).
+
+    """
+    small = resize_gray_crops(crops, hash_size + 1, hash_size)
+    return small[:, :, 1:] > small[:, :, :-1]
+
+
+def get_icon_hashes(image, bboxes):
+    """Average hashes of every (x, y, w, h) bbox of the image (list or (N, 4) array)."""
+    crops = [image[y:y+h, x:x+w] for x, y, w, h in bboxes]
+    return [imagehash.ImageHash(bits) for bits in average_hash_bits(crops)]
+
+
 def get_icon_hash(image, bbox):
-    x, y, w, h = bbox
-    icon = image[y:y+h, x:x+w]
-    img = Image.fromarray(icon)
-    icon_hash = imagehash.average_hash(img, hash_size=DEFAULT_HASH_SIZE)
+    return get_icon_hashes(image, [bbox])[0]
+
 
-    return icon_hash
+def get_icon_dhashes(image, bboxes):
+    """Difference hashes of every bbox of the image, the second stage of the matching cascade."""
+    crops = [image[y:y+h, x:x+w] for x, y, w, h in bboxes]
+    return [imagehash.ImageHash(bits) for bits in difference_hash_bits(crops)]
 
 
 def get_middle_section(genre_image, x_cutoff=0.2, y_cutoff=0.45):
@@ -605,72 +1063,51 @@ def get_middle_section(genre_image, x_cutoff=0.2, y_cutoff=0.45):
     return genre_image[y_start:y_end, x_start:x_end]
 
 
+def get_genre_hashes(image, bboxes):
+    """Get the genre hashes by only using the middle section of the icons."""
+    crops = [get_middle_section(image[y:y+h, x:x+w]) for x, y, w, h in bboxes]
+    return [imagehash.ImageHash(bits) for bits in average_hash_bits(crops, hash_size=10)]
+
+
 def get_genre_hash(image, bbox):
-    """Get the genre hash by only using the middle section of the icon."""
-    x, y, w, h = bbox
-    icon = image[y:y+h, x:x+w]
+    return get_genre_hashes(image, [bbox])[0]
+
 
-    middle = get_middle_section(icon)
-    # TODO: remove the grayscale conversion. imagehash.average_hash already converyts to grayscale
-    # gray = cv2.cvtColor(middle, cv2.COLOR_BGR2GRAY)
-    # img = Image.fromarray(gray)
-    img = Image.fromarray(middle)
-    genre_hash = imagehash.average_hash(img, hash_size=10)
-    return genre_hash
+def get_genre_dhashes(image, bboxes):
+    crops = [get_middle_section(image[y:y+h, x:x+w]) for x, y, w, h in bboxes]
+    return [imagehash.ImageHash(bits) for bits in difference_hash_bits(crops, hash_size=10)]
 
 
 def guess_icon_hash(image, bbox, icon_type, unknown_obj, hero=None, color=None):
     if icon_type not in ('hero', 'trait', 'artifact'):
         raise ValueError('Unknown icon type')
 
-    if icon_type == 'artifact':
-        hero2info_func  = get_hash_to_artifact_info
-        hamming_threshold = HAMMING_ARTIFACT_THRESHOLD
-    elif icon_type == 'hero':
-        hero2info_func = get_hash_to_hero_info
-        hamming_threshold = HAMMING_HERO_THRESHOLD
-    elif icon_type == 'trait':
-        hero2info_func = get_hash_to_trait_info
-        hamming_threshold = HAMMING_TRAIT_THRESHOLD
+    return guess_icon_hashes(image, [bbox], icon_type, [hero], [color])[0]
 
-    icon_hash = get_icon_hash(image, bbox)
-    if icon_type == 'trait':
-        hash2info = hero2info_func(hero, color)
-    else:
-        hash2info = hero2info_func()
-    
-    # TODO: a lot of returns peppered everywhere - reorganize
-    # This logic is mostly used for traits (e.g. only one red trait for alicia as of 20250405)
-    all_names = set([v.name for v in hash2info.values()])
-    if len(all_names) == 1:
-        # TODO: might not want to select an arbitary info? shouldn't matter too much though
-        info =  list(hash2info.values())[0]
-        reference_hash = imagehash.hex_to_hash(info.reference_hash)
-        hamming = reference_hash - icon_hash
 
-        return info, icon_hash, hamming
+def _find_icon(table, icon_type, icon_hash, distances=None):
+    """Rows and distances of the references under the threshold of the icon type.
 
-    hammings = defaultdict(list)
-    for reference_hash, info in hash2info.items():
-        reference_hash = imagehash.hex_to_hash(reference_hash)
+    From a row of a distance matrix when it was computed (linear search),
+    otherwise from the search method of the icon type.
 
-        hamming = reference_hash - icon_hash
-        if hamming < hamming_threshold:
-            hammings[hamming].append(info)
-    
-    # TODO: reformat this, kinda ugly
-    if not hammings:
-        return unknown_obj, icon_hash, 9999
+    """
+    hamming_threshold = ICON_TYPES[icon_type][1]
+    if distances is not None:
+        rows = np.flatnonzero(distances < hamming_threshold)
+        return rows, distances[rows]
 
-    # hamming_counts = {k:len(v) for k,v in hammings.items()}
-    lowest_hamming = min(hammings.keys())
-    lowest_infos = hammings[lowest_hamming]
-    unique_names = set([i.name for i in lowest_infos])
-    if len(unique_names) > 1:
-        print(f'Found multiple hashes with hamming distance {lowest_hamming}: {lowest_infos} (icon hash: {icon_hash})')
-        return unknown_obj, icon_hash, 9999
+    return table.find_within(icon_hash, hamming_threshold, SEARCH_METHODS[icon_type])
 
-    return lowest_infos[0], icon_hash, lowest_hamming
+
+def _match_icon(table, icon_type, icon_hash, unknown_obj, rows, distances):
+    """Pick the match between the rows found by ``_find_icon``."""
+    # This logic is mostly used for traits (e.g. only one red trait for alicia as of 20250405)
+    if icon_type != 'genre' and table.num_names == 1:
+        # TODO: might not want to select an arbitary info? shouldn't matter too much though
+        return table.infos[0], icon_hash, table.distance_at(0, icon_hash)
+
+    return table._resolve_candidates(rows, distances, icon_hash, unknown_obj)
 
 
 guess_artifact_hash  = partial(guess_icon_hash, icon_type='artifact', unknown_obj=UNKNOWN_ARTIFACT)
@@ -680,25 +1117,226 @@ guess_trait_hash = partial(guess_icon_hash, icon_type='trait', unknown_obj=UNKNO
 
 # TODO: may want to merge with the generic function
 def guess_genre_hash(image, bbox):
-    icon_hash = get_genre_hash(image, bbox)
-    hash2info = get_hash_to_genre_info()
+    return guess_icon_hashes(image, [bbox], 'genre')[0]
+
+
+# icon type -> (batched hash function, hamming threshold, unknown object)
+ICON_TYPES = {'artifact': (get_icon_hashes, HAMMING_ARTIFACT_THRESHOLD, UNKNOWN_ARTIFACT),
+              'hero': (get_icon_hashes, HAMMING_HERO_THRESHOLD, UNKNOWN_HERO),
+              'trait': (get_icon_hashes, HAMMING_TRAIT_THRESHOLD, UNKNOWN_TRAIT),
+              'genre': (get_genre_hashes, HAMMING_GENRE_THRESHOLD, UNKNOWN_GENRE),
+              }
+
+# nearest hash search per icon type. The vectorized linear scan is still the
+# fastest up to 100k (clustered) references, even at the hero threshold: the
+# BK-tree and multi-index hashing skip most of the comparisons, but each one
+# costs more in python. Re-run `python -m matchparse.hash_benchmark` before
+# switching as the library grows.
+SEARCH_METHOD_NAMES = ('linear', 'bktree', 'mih')
+SEARCH_METHODS = {'artifact': 'linear',
+                  'hero': 'linear',
+                  'trait': 'linear',
+                  'genre': 'linear',
+                  }
+
+# Matching cascade: the average hash decides on its own unless the closest
+# references of different names tie, or the closest one is less than
+# CASCADE_MARGIN under the threshold. Only those icons get a difference
+# hash, compared against the references within CASCADE_MARGIN of the
+# closest one that have a dHash (references built from icon PNGs, see
+# reference_index.py). Every shortlisted reference is under the aHash
+# threshold, so the dHash only picks between names the aHash accepts: it
+# never matches an icon the aHash left unknown. The tables above have no
+# icons, so with an index built from them alone (the Dockerfile's) the
+# cascade is off: ambiguous icons are only counted.
+CASCADE_MARGIN = 3
+
+# icon type -> (batched dHash function, dHash hamming threshold)
+# the dHash thresholds are the aHash ones, they only drop shortlisted references
+CASCADE_TYPES = {'artifact': (get_icon_dhashes, HAMMING_ARTIFACT_THRESHOLD),
+                 'hero': (get_icon_dhashes, HAMMING_HERO_THRESHOLD),
+                 'trait': (get_icon_dhashes, HAMMING_TRAIT_THRESHOLD),
+                 'genre': (get_genre_dhashes, HAMMING_GENRE_THRESHOLD),
+                 }
+
+_CASCADE_COUNTS = Counter()
+_CASCADE_LOCK = threading.Lock()
+_NO_ROWS = np.zeros(0, dtype=np.int64)
+
+
+def get_cascade_shortlist(table, icon_type, rows, distances):
+    """Check if the aHash match of an icon needs the second stage.
+
+    ``rows`` / ``distances`` are the references under the threshold, as
+    found for the first stage (``_find_icon``), so the cascade costs no
+    extra search whatever the search method.
+
+    Returns
+    -------
+    tuple
+        (is ambiguous, shortlisted rows, their aHash distances), the rows
+        only include references with a dHash, so they can be empty even
+        for an ambiguous icon
+
+    """
+    hamming_threshold = ICON_TYPES[icon_type][1]
+    if icon_type != 'genre' and table.num_names == 1:
+        return False, _NO_ROWS, _NO_ROWS
+
+    if len(rows) == 0:
+        return False, _NO_ROWS, _NO_ROWS
+
+    lowest_hamming = distances.min()
+    lowest_idxs = rows[distances == lowest_hamming]
+    is_tie = len(np.unique(table.name_ids[lowest_idxs])) > 1
+    is_near_threshold = lowest_hamming >= hamming_threshold - CASCADE_MARGIN
+    if not (is_tie or is_near_threshold):
+        return False, _NO_ROWS, _NO_ROWS
+
+    if table.has_dhash is None:
+        return True, _NO_ROWS, _NO_ROWS
+
+    is_short = (distances <= lowest_hamming + CASCADE_MARGIN) & table.has_dhash[rows]
+    return True, rows[is_short], distances[is_short]
+
+
+def _cascade_match(table, icon_type, rows, distances, icon_hash, icon_dhash, match):
+    """Second stage: pick between the shortlisted rows with the dHash.
+
+    Returns (outcome, match), ``match`` is the first stage result when the
+    dHash cannot decide either. The dHash is more sensitive to noise than
+    the aHash, so it never turns a first stage match into an unknown.
+
+    """
+    dhash_threshold = CASCADE_TYPES[icon_type][1]
+
+    dhash_distances = _popcount(table.dhash_words[rows] ^ hash_to_words(icon_dhash)).sum(axis=1, dtype=np.int64)
+    is_close = dhash_distances < dhash_threshold
+    if not is_close.any():
+        return 'unresolved', match
+
+    rows, distances, dhash_distances = rows[is_close], distances[is_close], dhash_distances[is_close]
+    is_lowest = dhash_distances == dhash_distances.min()
+    if len(np.unique(table.name_ids[rows[is_lowest]])) > 1:
+        return 'unresolved', match
+
+    # the reported hamming stays the aHash distance, of the closest row of the chosen name
+    best = np.argmin(distances[is_lowest])
+    info = table.infos[rows[is_lowest][best]]
+    outcome = 'confirmed' if info.name == match[0].name else 'resolved'
+    return outcome, (info, icon_hash, int(distances[is_lowest][best]))
+
+
+def _count_cascade(outcomes):
+    with _CASCADE_LOCK:
+        _CASCADE_COUNTS.update(outcomes)
+
+
+def get_cascade_stats():
+    """How many matched icons were ambiguous and how many went through the dHash stage.
+
+    ``cascade_rate`` is the fraction of icons that needed the second stage.
+    Of those, 'confirmed' kept the first stage name, 'resolved' changed it
+    (e.g. broke a tie) and 'unresolved' were left to the first stage.
+
+    """
+    with _CASCADE_LOCK:
+        counts = dict(_CASCADE_COUNTS)
+
+    icons = counts.get('icons', 0)
+    cascaded = sum(counts.get(outcome, 0) for outcome in ('confirmed', 'resolved', 'unresolved'))
+    return {'icons': icons,
+            'ambiguous': counts.get('ambiguous', 0),
+            'cascaded': cascaded,
+            'confirmed': counts.get('confirmed', 0),
+            'resolved': counts.get('resolved', 0),
+            'unresolved': counts.get('unresolved', 0),
+            'cascade_rate': cascaded / icons if icons else 0.0,
+            }
+
+
+def hash_icons(image, bboxes, hashes_func=get_icon_hashes):
+    """Hash every bbox of the image in one batch, identical crops are only hashed once."""
+    crop_to_idx = {}
+    unique_bboxes = []
+    idxs = []
+    for bbox in bboxes:
+        x, y, w, h = bbox
+        crop = image[y:y+h, x:x+w]
+        key = (crop.shape, crop.tobytes())
+        if key not in crop_to_idx:
+            crop_to_idx[key] = len(unique_bboxes)
+            unique_bboxes.append(bbox)
+        idxs.append(crop_to_idx[key])
+
+    unique_hashes = hashes_func(image, unique_bboxes) if unique_bboxes else []
+    return [unique_hashes[i] for i in idxs]
+
+
+def guess_icon_hashes(image, bboxes, icon_type, heroes=None, colors=None, library=None):
+    """Batch version of the guess_*_hash functions for every icon of a screenshot.
+
+    All bboxes of one icon type are hashed together and matched with one
+    distance matrix per reference table. Traits are matched against the
+    table of their hero / color (``heroes`` and ``colors`` hold one value
+    per bbox), so they are grouped by (hero, color) first. ``library`` pins
+    the reference_index.ReferenceLibrary to match against (default: the
+    active one).
+
+    Ambiguous and near-threshold matches go through the dHash cascade (see
+    CASCADE_MARGIN), with all of their dHashes computed in one batch.
+
+    Returns one (info, icon_hash, hamming) per bbox, same as guess_*_hash.
+
+    """
+    if icon_type not in ICON_TYPES:
+        raise ValueError('Unknown icon type')
+
+    hashes_func, _, unknown_obj = ICON_TYPES[icon_type]
+    icon_hashes = hash_icons(image, bboxes, hashes_func)
+
+    groups = defaultdict(list)
+    for i in range(len(bboxes)):
+        hero = heroes[i] if heroes else None
+        color = colors[i] if colors else None
+        groups[(hero, color)].append(i)
+
+    get_table = library.get_table if library is not None else get_reference_table
+    results = [None] * len(bboxes)
+    outcomes = Counter(icons=len(bboxes))
+    cascades = []
+    for (hero, color), idxs in groups.items():
+        if icon_type == 'trait':
+            table = get_table(icon_type, hero, color)
+        else:
+            table = get_table(icon_type)
 
-    hammings = defaultdict(list)
-    for reference_hash, info in hash2info.items():
-        reference_hash = imagehash.hex_to_hash(reference_hash)
+        group_hashes = [icon_hashes[i] for i in idxs]
+        if SEARCH_METHODS[icon_type] == 'linear':
+            distances = table.distance_matrix(group_hashes)
+        else:
+            distances = [None] * len(group_hashes)
 
-        hamming = reference_hash - icon_hash
-        if hamming < HAMMING_GENRE_THRESHOLD:
-            hammings[hamming].append(info)
+        for i, icon_hash, row in zip(idxs, group_hashes, distances):
+            rows, row_distances = _find_icon(table, icon_type, icon_hash, row)
+            results[i] = _match_icon(table, icon_type, icon_hash, unknown_obj, rows, row_distances)
 
-    if not hammings:
-        return UNKNOWN_GENRE, icon_hash, 9999
+            is_ambiguous, shortlist, shortlist_distances = get_cascade_shortlist(table, icon_type, rows,
+                                                                                 row_distances)
+            outcomes['ambiguous'] += is_ambiguous
+            if len(shortlist):
+                cascades.append((i, table, shortlist, shortlist_distances))
 
-    lowest_hamming = min(hammings.keys())
-    lowest_infos = hammings[lowest_hamming]
-    unique_names = set([i.name for i in lowest_infos])
-    if len(unique_names) > 1:
-        print(f'Found multiple hashes with hamming distance {lowest_hamming}: {lowest_infos} (icon hash: {icon_hash})')
-        return UNKNOWN_GENRE, icon_hash, 9999
+    if cascades:
+        dhashes_func = CASCADE_TYPES[icon_type][0]
+        icon_dhashes = hash_icons(image, [bboxes[i] for i, _, _, _ in cascades], dhashes_func)
+        for (i, table, shortlist, shortlist_distances), icon_dhash in zip(cascades, icon_dhashes):
+            outcome, results[i] = _cascade_match(table, icon_type, shortlist, shortlist_distances,
+                                                 icon_hashes[i], icon_dhash, results[i])
+            outcomes[outcome] += 1
+            if outcome == 'resolved':
+                logger.debug('Hash cascade %s %s %s (dhash %s): %s', outcome, icon_type, icon_hashes[i], icon_dhash,
+                             results[i][0])
 
-    return lowest_infos[0], icon_hash, lowest_hamming
+    _count_cascade(outcomes)
+    return results
@@ -1,7 +1,9 @@
 import cv2
 
+from .image_context import get_image_context
+from .resolution import scale_px
 
-# TODO: these should not be flat pixel numbers, it should scale w/ something (e.g. size of a reference object, or entire image)
+# pixel sizes at resolution.CANONICAL_HEIGHT
 MIN_WIDTH = 30
 MIN_HEIGHT = 30
 
@@ -17,29 +19,32 @@ def highlight_and_save_contours(image, contours, filename):
 
 
 
-def get_hero_bboxes(image, max_x=None):
+def get_hero_bboxes(image, max_x=None, context=None):
+    """Find the hero bboxes left of ``max_x`` (default: half the width).
+
+    ``context`` is the screenshot's ImageContext, the gray/binary planes are
+    shared with the artifact detection.
+
+    """
     if max_x is None:
         _, width = image.shape[:2]
         max_x = width//2
-    left_side = image[:, :max_x]
 
-    gray = cv2.cvtColor(left_side, cv2.COLOR_BGR2GRAY)
-    _, binary = cv2.threshold(gray, 85, 255, cv2.THRESH_BINARY)
-    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    # cv2.imwrite('testheroes.png', binary)
+    context = get_image_context(image, context)
+    contours = context.get_contours(max_x=max_x)
+    # cv2.imwrite('testheroes.png', context.binary[:, :max_x])
 
-    image_copy = image.copy()
-    for c in contours:
-        x, y, w, h = cv2.boundingRect(c)
-        cv2.rectangle(image_copy, (x, y), (x+w, y+h), (255, 0, 0), 2)
-    # cv2.imwrite('testheroes_contours.png', image_copy)
+    # highlight_and_save_contours(image, contours, 'testheroes_contours.png')
+
+    min_width = scale_px(MIN_WIDTH, image)
+    min_height = scale_px(MIN_HEIGHT, image)
 
     bboxes = []
     square_contours = []
     polygons = []
     for contour in contours:
         cx, cy, cw, ch = cv2.boundingRect(contour)
-        if cw < MIN_WIDTH or ch < MIN_HEIGHT:
+        if cw < min_width or ch < min_height:
             continue
 
         aspect_ratio = float(cw) / ch  # NOTE: do you need the float here?
@@ -0,0 +1,383 @@
+"""Cluster the unknown icons saved with SAVE_ICONS, for reference curation.
+
+``Player.save_icons`` writes every unmatched icon to
+``output/<icon type>/<hash>_<icon type>_<w>x<h>_u.png``. The same unknown
+icon shows up thousands of times with a few bits of noise, this tool
+groups them so only one icon per cluster has to be labelled:
+
+ - the icon hashes are taken from the file names (genre icons are matched
+   on their middle section, so those are hashed again from the images)
+ - identical hashes are merged, then the pairwise Hamming distances of the
+   distinct hashes are computed in tiles with XOR + popcount over the
+   packed words, on every core
+ - icons closer than the threshold are linked and the connected
+   components are the clusters
+
+The output directory gets a report.tsv of the clusters, largest first,
+with the closest known reference of every cluster, and an icons/ tree in
+the layout ``python -m matchparse.reference_index --icons`` reads. Rename
+the ``cluster_0001`` folders to the reference name (delete the ones that
+are noise), then merge them into the reference index:
+
+    python -m matchparse.icon_clusters output/ -o output/clusters
+    python -m matchparse.reference_index --icons output/clusters/icons
+
+"""
+import argparse
+import os
+import re
+import shutil
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+from . import hashes, threads, traits
+from .reference_index import ICON_DIRS, get_reference_library
+
+DEFAULT_OUTPUT_DIR = 'output/clusters'
+DEFAULT_MIN_SIZE = 2
+MAX_ICONS_PER_CLUSTER = 5
+
+# tile of the distance matrix computed at once, (ROW_BLOCK, COL_BLOCK) uint8 distances
+ROW_BLOCK = 256
+COL_BLOCK = 4096
+# linked pairs are reduced to a spanning forest when there are more than this
+MAX_EDGES = 4000000
+# the representative is the medoid of the most frequent distinct hashes of a cluster
+MAX_MEDOID_CANDIDATES = 512
+HASH_BATCH_SIZE = 4096
+HASH_HEX_LENGTH = (hashes.HASH_BITS + 3) // 4
+
+# <hash>_<icon type>_<w>x<h>[_u].png (Player.save_icons)
+# <hash>_<color>_<hero>_<w>x<h>.png (MatchParser.save_unknown_trait_icons, always unknown)
+_FILENAME_PATTERN = re.compile(r'^(?P<hash>[0-9a-f]+)_(?P<kind>[a-z]+)_(?:(?P<hero>.+)_)?'
+                               r'(?P<width>\d+)x(?P<height>\d+)(?P<unknown>_u)?\.png$')
+
+
+def load_icons(input_dir, icon_type, is_include_known=False, is_rehash=False):
+    """Find the saved icons of an icon type and their hashes.
+
+    Returns
+    -------
+    tuple
+        file paths, (n, HASH_WORDS) packed hashes and the (hero, color) of
+        every icon (None when the file name does not have them)
+
+    """
+    sub_dir = os.path.join(input_dir, ICON_DIRS[icon_type])
+    if not os.path.isdir(sub_dir):
+        return [], np.zeros((0, hashes.HASH_WORDS), dtype=np.uint64), []
+
+    hero_names = {hero.lower(): hero for hero in hashes.TRAITS}
+
+    filepaths, hex_hashes, labels = [], [], []
+    with os.scandir(sub_dir) as entries:
+        for entry in entries:
+            match = _FILENAME_PATTERN.match(entry.name)
+            if match is None:
+                continue
+
+            is_unknown_trait_format = icon_type == 'trait' and match['kind'] != ICON_DIRS[icon_type]
+            if match['kind'] != ICON_DIRS[icon_type] and not is_unknown_trait_format:
+                continue
+            if not (is_include_known or match['unknown'] or is_unknown_trait_format):
+                continue
+
+            hero, color = None, None
+            if is_unknown_trait_format and match['hero']:
+                hero, color = hero_names.get(match['hero'], match['hero']), match['kind']
+
+            filepaths.append(entry.path)
+            hex_hashes.append(match['hash'])
+            labels.append((hero, color))
+
+    filepaths, hex_hashes, labels = zip(*sorted(zip(filepaths, hex_hashes, labels))) if filepaths else ([], [], [])
+
+    # genres are matched on their middle section, the file names have the hash of the whole icon
+    if is_rehash or icon_type == 'genre' or any(len(h) != HASH_HEX_LENGTH for h in hex_hashes):
+        words = hash_icon_files(filepaths, icon_type)
+    else:
+        words = np.array([hashes.hex_to_words(h) for h in hex_hashes], dtype=np.uint64).reshape(-1, hashes.HASH_WORDS)
+
+    return list(filepaths), words, list(labels)
+
+
+def hash_icon_files(filepaths, icon_type):
+    """Hash icon PNGs the way the parser hashes the icon type, in batches."""
+    words = np.zeros((len(filepaths), hashes.HASH_WORDS), dtype=np.uint64)
+    for start in range(0, len(filepaths), HASH_BATCH_SIZE):
+        crops = [cv2.imread(fp) for fp in filepaths[start:start+HASH_BATCH_SIZE]]
+        if icon_type == 'genre':
+            crops = [hashes.get_middle_section(crop) for crop in crops]
+        words[start:start+len(crops)] = hashes.bits_to_words(hashes.average_hash_bits(crops))
+
+    return words
+
+
+def _get_tile_edges(columns, start, threshold):
+    """Pairs (i, j) with start <= i < start + ROW_BLOCK and i < j that are closer than the threshold."""
+    stop = min(start + ROW_BLOCK, len(columns[0]))
+    all_rows, all_cols = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.int32)]
+    for col_start in range(start, len(columns[0]), COL_BLOCK):
+        col_stop = min(col_start + COL_BLOCK, len(columns[0]))
+        distances = hashes._popcount(columns[0][start:stop, None] ^ columns[0][None, col_start:col_stop])
+        for column in columns[1:]:
+            distances += hashes._popcount(column[start:stop, None] ^ column[None, col_start:col_stop])
+
+        # much faster than np.nonzero on a 2d mask
+        rows, cols = np.divmod(np.flatnonzero(distances < threshold).astype(np.int32), col_stop - col_start)
+        rows += start
+        cols += col_start
+        if col_start < stop:
+            is_upper = rows < cols
+            rows, cols = rows[is_upper], cols[is_upper]
+        all_rows.append(rows)
+        all_cols.append(cols)
+
+    return np.concatenate(all_rows), np.concatenate(all_cols)
+
+
+def _get_labels(num_nodes, rows, cols):
+    graph = csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(num_nodes, num_nodes))
+    return connected_components(graph, directed=True, connection='weak')[1]
+
+
+def _get_spanning_edges(labels):
+    """Edges from every node to the first node of its component (same components, fewer edges)."""
+    nodes = np.arange(len(labels))
+    first_nodes = np.full(labels.max() + 1, len(labels))
+    np.minimum.at(first_nodes, labels, nodes)
+
+    is_linked = first_nodes[labels] != nodes
+    return nodes[is_linked], first_nodes[labels[is_linked]]
+
+
+def cluster_hashes(words, threshold, num_threads=None):
+    """Connected components of the hashes, linking pairs closer than the threshold.
+
+    Returns the component label of every row of ``words`` (distinct hashes).
+
+    """
+    if len(words) == 0:
+        return np.zeros(0, dtype=np.int32)
+
+    # one contiguous array per word, the tiles broadcast them against each other
+    columns = [np.ascontiguousarray(words[:, i]) for i in range(words.shape[1])]
+    rows = [np.zeros(0, dtype=np.int32)]
+    cols = [np.zeros(0, dtype=np.int32)]
+    num_edges = 0
+
+    # numpy releases the GIL in the tiles, so threads use every core
+    with ThreadPoolExecutor(num_threads or threads.get_num_cores()) as executor:
+        for tile_rows, tile_cols in executor.map(lambda start: _get_tile_edges(columns, start, threshold),
+                                                 range(0, len(words), ROW_BLOCK)):
+            rows.append(tile_rows)
+            cols.append(tile_cols)
+            num_edges += len(tile_rows)
+
+            if num_edges > MAX_EDGES:
+                spanning_rows, spanning_cols = _get_spanning_edges(_get_labels(len(words), np.concatenate(rows),
+                                                                               np.concatenate(cols)))
+                rows, cols, num_edges = [spanning_rows], [spanning_cols], len(spanning_rows)
+
+    return _get_labels(len(words), np.concatenate(rows), np.concatenate(cols))
+
+
+def get_representative(words, counts):
+    """Index of the (count weighted) medoid among the most frequent distinct hashes of a cluster."""
+    candidates = np.argsort(-counts, kind='stable')[:MAX_MEDOID_CANDIDATES]
+    candidate_words = words[candidates]
+    distances = hashes._popcount(candidate_words[:, None, :] ^ candidate_words[None, :, :]).sum(axis=2, dtype=np.int64)
+
+    return candidates[np.argmin(distances @ counts[candidates])]
+
+
+def _get_nearest_references(icon_type, words):
+    """(info, hamming) of the closest known reference of every hash, None for an empty table."""
+    table = get_reference_library().get_table(icon_type)
+    if len(table) == 0 or len(words) == 0:
+        return [(None, None)] * len(words)
+
+    distances = hashes._popcount(words[:, None, :] ^ table.words[None, :, :]).sum(axis=2, dtype=np.int64)
+    rows = distances.argmin(axis=1)
+    return [(table.infos[row], int(distances[i, row])) for i, row in enumerate(rows)]
+
+
+def _to_hex(words):
+    return f'{hashes.words_to_int(words):0{HASH_HEX_LENGTH}x}'
+
+
+def cluster_icons(filepaths, words, threshold, min_size=DEFAULT_MIN_SIZE, num_threads=None):
+    """Cluster the icons, returning a list of dicts (largest cluster first).
+
+    Every cluster has its number of icons and distinct hashes, the index
+    of its representative icon and the indexes of up to
+    MAX_ICONS_PER_CLUSTER icons with the most frequent distinct hashes.
+
+    """
+    if len(filepaths) == 0:
+        return []
+
+    unique_words, inverse, counts = np.unique(words, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    labels = cluster_hashes(unique_words, threshold, num_threads)
+
+    # first icon file of every distinct hash
+    first_files = np.full(len(unique_words), len(filepaths))
+    np.minimum.at(first_files, inverse, np.arange(len(filepaths)))
+
+    label_sizes = np.bincount(labels, weights=counts).astype(np.int64)
+    order = np.argsort(labels, kind='stable')
+    order = order[label_sizes[labels[order]] >= min_size]
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+
+    clusters = []
+    for members in np.split(order, bounds) if len(order) else []:
+        num_icons = int(label_sizes[labels[members[0]]])
+        member_counts = counts[members]
+        if len(members) == 1:
+            representative = members[0]
+        else:
+            representative = members[get_representative(unique_words[members], member_counts)]
+        top_members = members[np.argsort(-member_counts, kind='stable')][:MAX_ICONS_PER_CLUSTER]
+        examples = [representative] + [m for m in top_members if m != representative][:MAX_ICONS_PER_CLUSTER - 1]
+
+        clusters.append({'num_icons': num_icons,
+                         'num_hashes': len(members),
+                         'representative': int(first_files[representative]),
+                         'representative_hash': _to_hex(unique_words[representative]),
+                         'examples': [int(first_files[m]) for m in examples],
+                         })
+
+    return sorted(clusters, key=lambda c: (-c['num_icons'], c['representative_hash']))
+
+
+def _get_trait_dirs(filepath, label):
+    """Hero and color folders of a trait cluster, from the file name or the icon's colors."""
+    hero, color = label
+    if color is None:
+        color, _ = traits.determine_primary_bbox_color(cv2.imread(filepath))
+    return [hero or hashes.UNKNOWN_HERO.name, color or hashes.UNKNOWN_TRAIT.color]
+
+
+def write_clusters(icon_type, clusters, filepaths, labels, output_dir):
+    """Copy the example icons of every cluster into the reference_index icons/ layout, returns report rows."""
+    icon_type_dir = os.path.join(output_dir, 'icons', ICON_DIRS[icon_type])
+    # folders of a previous run would be merged with the new clusters otherwise
+    shutil.rmtree(icon_type_dir, ignore_errors=True)
+
+    representative_words = np.array([hashes.hex_to_words(c['representative_hash']) for c in clusters],
+                                    dtype=np.uint64).reshape(-1, hashes.HASH_WORDS)
+    nearest_references = _get_nearest_references(icon_type, representative_words)
+
+    rows = []
+    for rank, (cluster, (info, hamming)) in enumerate(zip(clusters, nearest_references), start=1):
+        cluster_name = f'cluster_{rank:04d}'
+        representative_filepath = filepaths[cluster['representative']]
+
+        sub_dirs = []
+        if icon_type == 'trait':
+            sub_dirs = _get_trait_dirs(representative_filepath, labels[cluster['representative']])
+        cluster_dir = os.path.join(icon_type_dir, *sub_dirs, cluster_name)
+        os.makedirs(cluster_dir, exist_ok=True)
+        for i in cluster['examples']:
+            shutil.copy2(filepaths[i], cluster_dir)
+
+        rows.append({'icon_type': icon_type,
+                     'rank': rank,
+                     'cluster': os.path.relpath(cluster_dir, output_dir),
+                     'num_icons': cluster['num_icons'],
+                     'num_hashes': cluster['num_hashes'],
+                     'representative_hash': cluster['representative_hash'],
+                     'representative_file': representative_filepath,
+                     'nearest_reference': info.name if info else '',
+                     'nearest_hamming': hamming,
+                     })
+
+    return rows
+
+
+def run(input_dir, output_dir=DEFAULT_OUTPUT_DIR, icon_types=tuple(ICON_DIRS), threshold=None,
+        min_size=DEFAULT_MIN_SIZE, is_include_known=False, is_rehash=False, num_threads=None):
+    os.makedirs(output_dir, exist_ok=True)
+
+    report_rows = []
+    for icon_type in icon_types:
+        type_threshold = threshold or hashes.ICON_TYPES[icon_type][1]
+
+        t0 = time.time()
+        filepaths, words, labels = load_icons(input_dir, icon_type, is_include_known, is_rehash)
+        t1 = time.time()
+        clusters = cluster_icons(filepaths, words, type_threshold, min_size, num_threads)
+        t2 = time.time()
+        report_rows.extend(write_clusters(icon_type, clusters, filepaths, labels, output_dir))
+
+        print(f'{icon_type}: {len(filepaths)} icons -> {len(clusters)} clusters of {min_size}+ icons '
+              f'(threshold {type_threshold}, loaded in {t1-t0:.2f}s, clustered in {t2-t1:.2f}s)')
+
+    columns = ['icon_type', 'rank', 'cluster', 'num_icons', 'num_hashes', 'representative_hash',
+               'representative_file', 'nearest_reference', 'nearest_hamming']
+    df = pd.DataFrame(report_rows, columns=columns)
+    report_filepath = os.path.join(output_dir, 'report.tsv')
+    df.to_csv(report_filepath, sep='\t', index=False)
+
+    print(df.head(30).to_string(index=False))
+    print(f'Saved {len(df)} clusters to: {report_filepath}')
+    print(f'Rename the cluster folders in {os.path.join(output_dir, "icons")} to the reference names, then run: '
+          f'python -m matchparse.reference_index --icons {os.path.join(output_dir, "icons")}')
+
+    return df
+
+
+def _make_unknown_icons(num_icons, num_sources, max_flips, rng):
+    """Synthetic saved icons: noisy copies of ``num_sources`` new icons (random hashes)."""
+    source_bits = rng.random((num_sources, hashes.HASH_BITS)) < 0.5
+    icon_bits = source_bits[rng.integers(0, num_sources, num_icons)]
+    num_flips = rng.integers(0, max_flips + 1, num_icons)
+    for k in range(max_flips):
+        idxs = np.flatnonzero(num_flips > k)
+        icon_bits[idxs, rng.integers(0, hashes.HASH_BITS, len(idxs))] ^= True
+
+    return hashes.bits_to_words(icon_bits)
+
+
+def benchmark(num_icons=100000, num_sources=300, threshold=hashes.HAMMING_TRAIT_THRESHOLD, max_flips=6, seed=0,
+              num_threads=None):
+    """Time the clustering of synthetic unknown icons."""
+    words = _make_unknown_icons(num_icons, num_sources, max_flips, np.random.default_rng(seed))
+    filepaths = [f'icon_{i}.png' for i in range(len(words))]
+
+    t0 = time.time()
+    clusters = cluster_icons(filepaths, words, threshold, DEFAULT_MIN_SIZE, num_threads)
+    print(f'{num_icons} icons ({len(np.unique(words, axis=0))} distinct hashes) of {num_sources} sources -> '
+          f'{len(clusters)} clusters in {time.time()-t0:.2f}s '
+          f'(threshold {threshold}, {num_threads or threads.get_num_cores()} threads)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cluster the unknown icons saved by the parser.')
+    parser.add_argument('input_dir', nargs='?', default='output/', help='output directory of the parser')
+    parser.add_argument('-o', '--output-dir', default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument('--types', nargs='+', choices=list(ICON_DIRS), default=list(ICON_DIRS))
+    parser.add_argument('--threshold', type=int, default=None,
+                        help='link icons closer than this (default: the matching threshold of the icon type)')
+    parser.add_argument('--min-size', type=int, default=DEFAULT_MIN_SIZE, help='skip smaller clusters')
+    parser.add_argument('--all', action='store_true', help='include the icons that were matched')
+    parser.add_argument('--rehash', action='store_true', help='hash the images instead of using the file names')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--benchmark', type=int, metavar='N', help='time N synthetic icons instead')
+    parser.add_argument('--sources', type=int, default=300, help='distinct icons in the benchmark')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.sources, args.threshold or hashes.HAMMING_TRAIT_THRESHOLD,
+                  num_threads=args.threads)
+    else:
+        run(args.input_dir, args.output_dir, args.types, args.threshold, args.min_size, args.all, args.rehash,
+            args.threads)
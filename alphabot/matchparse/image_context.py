@@ -0,0 +1,84 @@
+"""Per screenshot cache of the image planes the detectors work on.
+
+The artifact, hero, trait and genre detectors all look at overlapping parts
+of the same screenshot. Each used to convert its own slice to gray/HSV and
+run its own threshold + contour extraction. ``ImageContext`` computes every
+plane once for the whole image, on first use, and the detectors slice it:
+
+ - ``gray``: BGR2GRAY
+ - ``hsv``: BGR2HSV
+ - ``binary``: ``gray`` thresholded at BINARY_THRESHOLD
+ - ``get_contours``: external contours of a column range of ``binary``
+
+Color conversions and thresholds are per pixel, so a slice of a cached plane
+is identical to converting the slice. Contours are not: the contour pass runs
+on the column range each detector looks at, like before. Cropping cuts
+through any bright frame around the scoreboard, which would otherwise make
+every icon a nested (and dropped) contour.
+
+"""
+import cv2
+
+import numpy as np
+
+# gray level separating the icon frames from the dark background
+BINARY_THRESHOLD = 85
+
+
+class ImageContext:
+    """Lazily computed (and cached) planes of one BGR image."""
+
+    def __init__(self, image):
+        self.image = image
+
+        self._gray = None
+        self._hsv = None
+        self._binary = None
+        self._contours = {}
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    @property
+    def hsv(self):
+        if self._hsv is None:
+            self._hsv = cv2.cvtColor(self.image, cv2.COLOR_BGR2HSV)
+        return self._hsv
+
+    @property
+    def binary(self):
+        if self._binary is None:
+            _, self._binary = cv2.threshold(self.gray, BINARY_THRESHOLD, 255, cv2.THRESH_BINARY)
+        return self._binary
+
+    def get_contours(self, min_x=0, max_x=None):
+        """External contours of the columns [min_x, max_x) of ``binary``.
+
+        Coordinates are those of the whole image. Cached per column range.
+
+        """
+        width = self.image.shape[1]
+        if max_x is None:
+            max_x = width
+        min_x, max_x = max(0, min_x), min(width, max_x)
+
+        key = min_x, max_x
+        if key not in self._contours:
+            binary = np.ascontiguousarray(self.binary[:, min_x:max_x])
+            contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(min_x, 0))
+            self._contours[key] = contours
+        return self._contours[key]
+
+
+def get_image_context(image, context=None):
+    """Return ``context``, or a new ImageContext of the image if there is none."""
+    if context is None:
+        return ImageContext(image)
+    return context
@@ -0,0 +1,402 @@
+"""Cache of solved screenshot layouts.
+
+Screenshots from the same device/resolution have the same geometry: the
+artifact grid, the hero column and the 6x8 trait grid (the genre bboxes are
+derived from the artifacts). Every parse detects them again through
+thresholds and contours. A ``Layout`` keeps the solved geometry, keyed by a
+fingerprint of the working resolution and the position of the "PLAYER"
+header.
+
+On a new screenshot with a matching fingerprint the layout is spot-checked
+(the frames of the first/last artifact and hero must still be where they
+were) and reused, skipping the contour detection. Which trait cells are
+empty changes per screenshot, so the cells are classified again by their
+gray fill, with a threshold calibrated on the screenshot the layout was
+solved on. Anything that does not check out falls back to full detection.
+
+A screenshot with a new fingerprint (another resolution, a shifted
+scoreboard) can transfer a cached layout solved on another screenshot: one
+scale + offset from the template onto the screenshot is least-squares
+fitted on the artifact squares detected on it (the header gives the initial
+guess). The detected artifacts are kept, the missing ones and the hero
+bboxes are mapped from the template. This saves the hero detection, not the
+artifact contour pass, and it needs a template: on a cold cache every
+screenshot is detected in full. The genre bboxes follow from the artifacts
+(genres.infer_genre_bboxes) either way. The trait grid is far from the
+artifacts the transfer is fitted on and the spot-check does not cover it,
+so it is not transferred: the traits are detected, and calibrated into the
+layout for the next screenshots with its fingerprint.
+
+"""
+import logging
+import threading
+
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from . import artifacts, heroes, placements, traits
+from .image_context import BINARY_THRESHOLD
+from .resolution import scale_px
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_LAYOUTS = 32
+
+# pixel sizes at resolution.CANONICAL_HEIGHT
+HEADER_TOLERANCE = 4
+FRAME_BAND = 3
+
+# share of the band along the inside of an anchor's edges that must be bright (the frame)
+ANCHOR_MIN_FILL = 0.6
+# and how much darker the band just outside of it must be
+ANCHOR_MIN_CONTRAST = 0.2
+
+# transferring a template layout onto a screenshot
+MAX_TRANSFER_TEMPLATES = 3
+MIN_FIT_ANCHORS = 6
+FIT_ITERATIONS = 2
+# anchors further than this from every template bbox are not matched, relative to the artifact width
+MATCH_DISTANCE = 0.4
+# RMS distance between the fitted and detected anchor centers, px at canonical height
+FIT_TOLERANCE = 3
+
+
+def get_fingerprint(image, header):
+    """(height, width, header x, header y) of a screenshot, None without a header."""
+    if header is None:
+        return None
+
+    height, width = image.shape[:2]
+    hx0, _, hy0, _ = placements.get_minmax(header[0])
+    return height, width, int(hx0), int(hy0)
+
+
+def get_frame_fills(image, bbox, band):
+    """Share of bright pixels along the inside of the bbox edges and just outside of them."""
+    x, y, w, h = bbox
+    height, width = image.shape[:2]
+    x0, y0, x1, y1 = x - band, y - band, x + w + band, y + h + band
+    if x0 < 0 or y0 < 0 or x1 > width or y1 > height or min(w, h) <= 4 * band:
+        return 0.0, 1.0
+
+    gray = cv2.cvtColor(image[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+    bright = gray > BINARY_THRESHOLD
+
+    outside = np.ones(bright.shape, dtype=bool)
+    outside[band:-band, band:-band] = False
+    inside = np.zeros(bright.shape, dtype=bool)
+    inside[band:-band, band:-band] = True
+    inside[2*band:-2*band, 2*band:-2*band] = False
+
+    return bright[inside].mean(), bright[outside].mean()
+
+
+def is_anchor_present(image, bbox):
+    band = max(1, int(round(scale_px(FRAME_BAND, image))))
+    inside_fill, outside_fill = get_frame_fills(image, bbox, band)
+    return inside_fill >= ANCHOR_MIN_FILL and inside_fill - outside_fill >= ANCHOR_MIN_CONTRAST
+
+
+class Layout:
+    """Solved geometry of a screenshot.
+
+    ``trait_cells`` are the 48 trait grid cells, cells with a gray fill of at
+    least ``min_missing_fill`` are missing traits. Both are None when the
+    calibration did not separate the cells, the traits are then detected.
+
+    """
+
+    def __init__(self, fingerprint, artifact_bboxes, hero_bboxes, trait_cells=None, min_missing_fill=None):
+        self.fingerprint = fingerprint
+        self.artifact_bboxes = list(artifact_bboxes)
+        self.hero_bboxes = list(hero_bboxes)
+        self.trait_cells = trait_cells
+        self.min_missing_fill = min_missing_fill
+
+        # (scale, residual, number of anchors) when transferred from a template, see transfer_layout
+        self.transfer = None
+
+    def __repr__(self):
+        return (f'Layout(fingerprint={self.fingerprint}, artifacts={len(self.artifact_bboxes)}, '
+                f'heroes={len(self.hero_bboxes)}, has_traits={self.has_traits}, transfer={self.transfer})')
+
+    @property
+    def has_traits(self):
+        return self.trait_cells is not None
+
+    @property
+    def anchors(self):
+        """First and last artifact and hero bboxes (top to bottom)."""
+        artifact_bboxes = sorted(self.artifact_bboxes, key=lambda b: (b[1], b[0]))
+        hero_bboxes = sorted(self.hero_bboxes, key=lambda b: b[1])
+        return [artifact_bboxes[0], artifact_bboxes[-1], hero_bboxes[0], hero_bboxes[-1]]
+
+    def is_valid(self, image):
+        """Spot-check the anchors on a screenshot."""
+        return all(is_anchor_present(image, bbox) for bbox in self.anchors)
+
+    def get_trait_bboxes(self, image, context=None):
+        """Return (trait bboxes, missing trait bboxes) like traits.get_trait_and_missing_bboxes."""
+        return traits.split_trait_cells(image, self.trait_cells, self.min_missing_fill, context)
+
+    def calibrate_traits(self, image, missing_bboxes, context=None):
+        """Set the trait cells from the traits detected on a screenshot of this layout, see calibrate_trait_cells."""
+        trait_cells, min_missing_fill = calibrate_trait_cells(image, missing_bboxes, context)
+        # has_traits looks at trait_cells, set it last
+        self.min_missing_fill = min_missing_fill
+        self.trait_cells = trait_cells
+        return self.has_traits
+
+
+def calibrate_trait_cells(image, missing_bboxes, context=None):
+    """Return the trait grid cells and the gray fill separating the missing ones, or (None, None)."""
+    try:
+        cells = traits.get_trait_grid(missing_bboxes, image)
+    except ValueError:
+        return None, None
+
+    missing_fills = []
+    trait_fills = []
+    for bbox, is_missing in cells:
+        fill = traits.get_missing_fill(image, bbox, context)
+        (missing_fills if is_missing else trait_fills).append(fill)
+
+    if not missing_fills or not trait_fills or min(missing_fills) <= max(trait_fills):
+        return None, None
+
+    min_missing_fill = (min(missing_fills) + max(trait_fills)) / 2
+    return [bbox for bbox, _ in cells], min_missing_fill
+
+
+def solve_layout(image, header, artifact_bboxes, hero_bboxes, missing_bboxes, context=None):
+    """Build a Layout from the detected bboxes, or None if they are not worth caching.
+
+    Only complete detections are kept, and only if their anchors pass the
+    spot-check on the screenshot they were detected on.
+
+    """
+    fingerprint = get_fingerprint(image, header)
+    if fingerprint is None:
+        return None
+    if len(artifact_bboxes) != artifacts.EXPECTED_NUM_ARTIFACTS or len(hero_bboxes) != heroes.EXPECTED_HEROES:
+        return None
+
+    layout = Layout(fingerprint, artifact_bboxes, hero_bboxes)
+    if not layout.is_valid(image):
+        logger.info('Not caching the layout %s, the anchors do not pass the spot-check', fingerprint)
+        return None
+
+    layout.calibrate_traits(image, missing_bboxes, context)
+    return layout
+
+
+def get_centers(bboxes):
+    """(n, 2) array of the centers of (x, y, w, h) bboxes."""
+    bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+    return bboxes[:, :2] + bboxes[:, 2:] / 2
+
+
+def fit_scale_offset(template_points, points):
+    """Least squares (scale, offset) with points ~ scale * template_points + offset."""
+    template_mean = template_points.mean(axis=0)
+    mean = points.mean(axis=0)
+    template_deltas = template_points - template_mean
+
+    denominator = (template_deltas ** 2).sum()
+    if denominator == 0:
+        return None
+
+    scale = (template_deltas * (points - mean)).sum() / denominator
+    return scale, mean - scale * template_mean
+
+
+def transform_bboxes(bboxes, scale, offset):
+    """Map template (x, y, w, h) bboxes through the model, rounded to pixels."""
+    bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+    top_left = np.rint(bboxes[:, :2] * scale + offset)
+    bottom_right = np.rint((bboxes[:, :2] + bboxes[:, 2:]) * scale + offset)
+    transformed = np.hstack([top_left, bottom_right - top_left]).astype(int)
+    return [tuple(bbox) for bbox in transformed.tolist()]
+
+
+def match_anchors(template_bboxes, bboxes, scale, offset, max_distance):
+    """Pair detected bboxes with the closest template bbox under the model.
+
+    Returns the (template indexes, detected indexes) of the pairs, every
+    template bbox is paired at most once (with the closest detection).
+
+    """
+    template_centers = get_centers(template_bboxes)
+    centers = get_centers(bboxes)
+    if not len(template_centers) or not len(centers):
+        return [], []
+
+    distances = np.linalg.norm(centers[:, None] - (template_centers * scale + offset)[None], axis=2)
+    nearest = distances.argmin(axis=1)
+    nearest_distances = distances[np.arange(len(centers)), nearest]
+
+    # closest first, so a template bbox keeps its best detection
+    template_idxs = []
+    idxs = []
+    for i in np.argsort(nearest_distances).tolist():
+        if nearest_distances[i] > max_distance:
+            break
+        if nearest[i] not in template_idxs:
+            template_idxs.append(nearest[i])
+            idxs.append(i)
+
+    return template_idxs, idxs
+
+
+def transfer_layout(template, image, header, artifact_bboxes):
+    """Map a template layout onto a screenshot, fitted on its detected artifact bboxes.
+
+    The initial model takes the scale from the artifact sizes and the
+    offset from the header. The artifacts are then matched to the closest
+    template artifacts and the scale + offset is refitted on the pairs.
+    Returns the Layout with the matched detected artifacts, the missing
+    ones and the heroes generated through the model and no trait cells.
+    None if too few anchors match, the residual is above FIT_TOLERANCE or
+    the spot-check fails.
+
+    """
+    fingerprint = get_fingerprint(image, header)
+    if fingerprint is None or not artifact_bboxes:
+        return None
+
+    template_width = np.median([b[2] for b in template.artifact_bboxes])
+    scale = np.median([b[2] for b in artifact_bboxes]) / template_width
+    offset = np.array(fingerprint[2:], dtype=float) - scale * np.array(template.fingerprint[2:], dtype=float)
+
+    template_centers = get_centers(template.artifact_bboxes)
+    centers = get_centers(artifact_bboxes)
+    for _ in range(FIT_ITERATIONS):
+        template_idxs, idxs = match_anchors(template.artifact_bboxes, artifact_bboxes, scale, offset,
+                                            MATCH_DISTANCE * template_width * scale)
+        if len(idxs) < MIN_FIT_ANCHORS:
+            return None
+
+        template_points, points = template_centers[template_idxs], centers[idxs]
+        model = fit_scale_offset(template_points, points)
+        if model is None:
+            return None
+        scale, offset = model
+
+    residual = np.sqrt(((template_points * scale + offset - points) ** 2).sum(axis=1).mean())
+    if residual > scale_px(FIT_TOLERANCE, image):
+        logger.info('Not transferring %s onto %s, residual %.2fpx', template, fingerprint, residual)
+        return None
+
+    # the detected artifacts are more precise than the model, it only fills in the missing ones
+    fitted_artifact_bboxes = transform_bboxes(template.artifact_bboxes, scale, offset)
+    for template_idx, i in zip(template_idxs, idxs):
+        fitted_artifact_bboxes[template_idx] = tuple(artifact_bboxes[i])
+
+    layout = Layout(fingerprint,
+                    fitted_artifact_bboxes,
+                    transform_bboxes(template.hero_bboxes, scale, offset))
+    layout.transfer = (round(float(scale), 4), round(float(residual), 2), len(points))
+    if not layout.is_valid(image):
+        return None
+
+    return layout
+
+
+class LayoutCache:
+    """Thread safe LRU of solved layouts."""
+
+    def __init__(self, max_layouts=DEFAULT_MAX_LAYOUTS):
+        self.max_layouts = max_layouts
+
+        self.hits = 0
+        self.misses = 0
+        self.rejects = 0  # matching fingerprint but failed the spot-check
+        self.transfers = 0  # transferred from a template layout with another fingerprint
+
+        self._layouts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._layouts)
+
+    def _get_candidates(self, fingerprint, tolerance):
+        height, width, hx, hy = fingerprint
+        with self._lock:
+            return [layout for key, layout in reversed(self._layouts.items())
+                    if key[:2] == (height, width) and abs(key[2] - hx) <= tolerance and abs(key[3] - hy) <= tolerance]
+
+    def get(self, image, header):
+        """Return the cached layout of the screenshot if it passes the spot-check, else None."""
+        fingerprint = get_fingerprint(image, header)
+        if fingerprint is None:
+            return None
+
+        candidates = self._get_candidates(fingerprint, scale_px(HEADER_TOLERANCE, image))
+        for layout in candidates:
+            if layout.is_valid(image):
+                with self._lock:
+                    self.hits += 1
+                    if layout.fingerprint in self._layouts:
+                        self._layouts.move_to_end(layout.fingerprint)
+                return layout
+
+        with self._lock:
+            if candidates:
+                self.rejects += 1
+            else:
+                self.misses += 1
+        return None
+
+    def transfer(self, image, header, artifact_bboxes):
+        """Transfer one of the most recently used layouts onto a screenshot the cache missed.
+
+        See ``transfer_layout``. The transferred layout is cached under the
+        screenshot's fingerprint. None on an empty cache.
+
+        """
+        with self._lock:
+            templates = list(reversed(self._layouts.values()))[:MAX_TRANSFER_TEMPLATES]
+
+        for template in templates:
+            layout = transfer_layout(template, image, header, artifact_bboxes)
+            if layout is not None:
+                self.put(layout)
+                with self._lock:
+                    self.transfers += 1
+                return layout
+
+        return None
+
+    def put(self, layout):
+        with self._lock:
+            self._layouts[layout.fingerprint] = layout
+            self._layouts.move_to_end(layout.fingerprint)
+            while len(self._layouts) > self.max_layouts:
+                self._layouts.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses + self.rejects
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'rejects': self.rejects,
+                'transfers': self.transfers,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'layouts': len(self._layouts),
+                }
+
+
+_CACHE = LayoutCache()
+
+
+def configure(max_layouts=DEFAULT_MAX_LAYOUTS):
+    """Replace the process-wide layout cache, 0 disables it."""
+    global _CACHE
+    _CACHE = LayoutCache(max_layouts) if max_layouts > 0 else None
+    return _CACHE
+
+
+def get_layout_cache():
+    """Return the process-wide layout cache (None when disabled)."""
+    return _CACHE
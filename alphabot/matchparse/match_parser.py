@@ -1,24 +1,28 @@
 import argparse
 import fnmatch
+import logging
 import os
 import shutil
 import time
 from collections import Counter, defaultdict
 
 import cv2
-import easyocr
 import imagehash
 import pandas as pd
-from matchparse import artifacts, genres, hashes, heroes, placements, traits
+from matchparse import (artifacts, digits, genres, hashes, heroes, layouts, ocr, placements, reference_index,
+                        resolution, threads, traits)
+from matchparse.image_context import ImageContext
 from matchparse.base import add_text_top_left, draw_bboxes, draw_contours
 from PIL import Image
 
 INPUT_DIR = 'input'
 OUTPUT_DIR = 'output/'
 
-LANGUAGES = ['ch_tra', 'en']
+LANGUAGES = ocr.LANGUAGES
 IMG_EXTENSION_PATTERNS = {'*.jpg', '*.png'}
 
+logger = logging.getLogger(__name__)
+
 # for QA only
 COLORS = [
     (0, 128, 0),      # Green
@@ -69,6 +73,7 @@ class Player:
         self.trait_hashes = []
         self.trait_guesses = []
         self.trait_hammings = []
+        self.trait_colors = []
         self.unknown_trait_indexes = []
 
         self.genre_bboxes = []
@@ -114,34 +119,55 @@ class Player:
     def add_trait_bbox(self, bbox):
         self.trait_bboxes.append(bbox)
 
-    def guess_icons(self, image, reader):
+    def guess_icons(self, image):
+        """Guess the icons of this player only, see MatchParser.guess_icons for the whole match."""
+        self.order_bboxes()
         if self.hero_bbox:
-            self.hero_guess, self.hero_hash, self.hero_hamming = hashes.guess_hero_hash(image, self.hero_bbox)
+            self.set_hero_guess(*hashes.guess_icon_hashes(image, [self.hero_bbox], 'hero')[0])
 
-        self.order_bboxes()
-        for i, bbox in enumerate(self.artifact_bboxes):
-            artifact_guess, artifact_hash, artifact_hamming = hashes.guess_artifact_hash(image, bbox)
-            self.artifact_guesses.append(artifact_guess)
-            self.artifact_hashes.append(artifact_hash)
-            self.artifact_hammings.append(artifact_hamming)
+        for guess in hashes.guess_icon_hashes(image, self.artifact_bboxes, 'artifact'):
+            self.add_artifact_guess(*guess)
 
-            if hashes.is_unknown(artifact_guess):
-                self.unknown_artifact_indexes.append(i)
+        trait_colors = self.get_trait_colors(image)
+        trait_heroes = [self.get_trait_hero()] * len(self.trait_bboxes)
+        for guess in hashes.guess_icon_hashes(image, self.trait_bboxes, 'trait', trait_heroes, trait_colors):
+            self.add_trait_guess(*guess)
+        self.infer_hero_from_traits()
 
-        trait_hero = None if hashes.is_unknown(self.hero_guess) else self.hero_guess.name
-        for i, bbox in enumerate(self.trait_bboxes):
-            # TODO: might want to add some logic to account for non-dupes.
-            # i.e. you cannot get the same trait twice
-            primary_color, _ = traits.determine_primary_bbox_color(image, bbox)
-            trait_guess, trait_hash, trait_hamming = hashes.guess_trait_hash(image, bbox,
-                                                                             hero=trait_hero, color=primary_color)
-            self.trait_guesses.append(trait_guess)
-            self.trait_hashes.append(trait_hash)
-            self.trait_hammings.append(trait_hamming)
-
-            if hashes.is_unknown(trait_guess):
-                self.unknown_trait_indexes.append(i)
+        for bbox, guess in zip(self.genre_bboxes, hashes.guess_icon_hashes(image, self.genre_bboxes, 'genre')):
+            self.add_genre_guess(image, bbox, *guess)
+
+    def set_hero_guess(self, hero_guess, hero_hash, hero_hamming):
+        self.hero_guess, self.hero_hash, self.hero_hamming = hero_guess, hero_hash, hero_hamming
+
+    def add_artifact_guess(self, artifact_guess, artifact_hash, artifact_hamming):
+        if hashes.is_unknown(artifact_guess):
+            self.unknown_artifact_indexes.append(len(self.artifact_guesses))
+
+        self.artifact_guesses.append(artifact_guess)
+        self.artifact_hashes.append(artifact_hash)
+        self.artifact_hammings.append(artifact_hamming)
+
+    def get_trait_hero(self):
+        return None if hashes.is_unknown(self.hero_guess) else self.hero_guess.name
+
+    def get_trait_colors(self, image, color_map=None):
+        # TODO: might want to add some logic to account for non-dupes.
+        # i.e. you cannot get the same trait twice
+        if color_map is None:
+            color_map = traits.TraitColorMap(image, self.trait_bboxes)
+        self.trait_colors = [color_map.determine_primary_color(bbox)[0] for bbox in self.trait_bboxes]
+        return self.trait_colors
 
+    def add_trait_guess(self, trait_guess, trait_hash, trait_hamming):
+        if hashes.is_unknown(trait_guess):
+            self.unknown_trait_indexes.append(len(self.trait_guesses))
+
+        self.trait_guesses.append(trait_guess)
+        self.trait_hashes.append(trait_hash)
+        self.trait_hammings.append(trait_hamming)
+
+    def infer_hero_from_traits(self):
         if hashes.is_unknown(self.hero_guess):
             counts = Counter([t.hero_name for t in self.trait_guesses if hashes.is_known(t)])
             more_than_threshold = any(cnt > 2 for cnt in counts.values())
@@ -157,28 +183,39 @@ class Player:
             else:
                 self.hero_guess = hashes.UNKNOWN_HERO
                 #raise ValueError(f'Could not infer hero from traits: {[t.name for t in self.trait_guesses]}')
-        
-        for i, bbox in enumerate(self.genre_bboxes):
-            genre_guess, genre_hash, genre_hamming = hashes.guess_genre_hash(image, bbox)
-            genre_level, star_contours = genres.get_genre_level(image, bbox)
-            genre_exp, _ = genres.read_genre_exp(image, bbox, reader)
 
-            self.genre_guesses.append(genre_guess)
-            self.genre_hashes.append(genre_hash)
-            self.genre_hammings.append(genre_hamming)
-            self.initial_genre_levels.append(genre_level)
-            self.initial_genre_exps.append(genre_exp)
+    def add_genre_guess(self, image, bbox, genre_guess, genre_hash, genre_hamming, context=None, genre_stars=None):
+        # genre_stars: (level, star contours) when already detected for the whole match
+        if genre_stars is None:
+            genre_stars = genres.get_genre_level(image, bbox, context)
+        genre_level, star_contours = genre_stars
+
+        self.genre_guesses.append(genre_guess)
+        self.genre_hashes.append(genre_hash)
+        self.genre_hammings.append(genre_hamming)
+        self.initial_genre_levels.append(genre_level)
 
-            self.genre_star_contours.extend(star_contours)
+        self.genre_star_contours.extend(star_contours)
 
-    def save_icons(self, image, output_dir):
-        def _save_icons(bbox, icon_type, is_unknown=False):
+    def save_icons(self, image, output_dir, to_image_bbox=None):
+        """Save the icon crops of this player, named <hash>_<type>_<w>x<h>[_u].png.
+
+        ``to_image_bbox`` maps the (working image) bboxes onto ``image``,
+        e.g. MatchParser.to_original_bbox to save the icons of the original
+        screenshot. The hashes in the names are then of the saved pixels.
+
+        """
+        def _save_icons(bbox, image_hash, icon_type, is_unknown=False):
             if bbox is None:
                 return
+            if to_image_bbox is not None:
+                bbox = to_image_bbox(bbox)
+                image_hash = None
+            if image_hash is None:
+                image_hash = hashes.get_icon_hash(image, bbox)
 
             x, y, w, h = bbox
             icon = image[y : y + h, x : x + w]
-            image_hash = hashes.get_icon_hash(image, bbox)
 
             suffix = "_u.png" if is_unknown else ".png"
             output_fn = f"{image_hash}_{icon_type}_{w}x{h}{suffix}"
@@ -187,19 +224,26 @@ class Player:
             output_fp = os.path.join(output_path, output_fn)
             cv2.imwrite(output_fp, icon)
 
+        # the hero/artifact/trait hashes were computed when guessing, the file names of the
+        # genres use the hash of the whole icon rather than the middle section that was matched
         is_hero_unknown = hashes.is_unknown(self.hero_guess)
-        _save_icons(self.hero_bbox, "heroes", is_hero_unknown)
+        _save_icons(self.hero_bbox, self.hero_hash, "heroes", is_hero_unknown)
 
-        for i, bbox in enumerate(self.artifact_bboxes):
+        for i, (bbox, image_hash) in enumerate(zip(self.artifact_bboxes, self.artifact_hashes)):
             is_unknown = i in self.unknown_artifact_indexes
-            _save_icons(bbox, "artifacts", is_unknown)
+            _save_icons(bbox, image_hash, "artifacts", is_unknown)
 
-        for i, bbox in enumerate(self.trait_bboxes):
+        for i, (bbox, image_hash) in enumerate(zip(self.trait_bboxes, self.trait_hashes)):
             is_unknown = i in self.unknown_trait_indexes
-            _save_icons(bbox, "traits", is_unknown)
+            _save_icons(bbox, image_hash, "traits", is_unknown)
         
-        for i, bbox in enumerate(self.genre_bboxes):
-            _save_icons(bbox, "genres")
+        if to_image_bbox is not None:
+            # hashed once mapped
+            genre_hashes = [None] * len(self.genre_bboxes)
+        else:
+            genre_hashes = hashes.get_icon_hashes(image, self.genre_bboxes) if self.genre_bboxes else []
+        for bbox, image_hash in zip(self.genre_bboxes, genre_hashes):
+            _save_icons(bbox, image_hash, "genres")
     
 
     # TODO: remove at some point or refactor. currently used in a utility script
@@ -222,7 +266,10 @@ class Player:
             icon = image[y : y + h, x : x + w]
             image_hash = hashes.get_icon_hash(image, bbox)
 
-            primary_color, _ = traits.determine_primary_bbox_color(icon)
+            if i < len(self.trait_colors):
+                primary_color = self.trait_colors[i]
+            else:
+                primary_color, _ = traits.determine_primary_bbox_color(icon)
 
             output_fn = f"{image_hash}_{primary_color}_{hero_name.lower()}_{w}x{h}.png"
             output_fp = os.path.join(output_dir, 'traits', output_fn)
@@ -234,12 +281,38 @@ class Player:
 
 class MatchParser:
     
-    def __init__(self, image_filepath):
+    def __init__(self, image_filepath, reader=None, normalize=True, layout_cache=None, digit_reader=None):
+        # torch/OpenCV thread pools, see threads.configure to share the cores between concurrent parses
+        threads.ensure_applied()
+
         self.image_filepath = str(image_filepath)
-        self.image = cv2.imread(self.image_filepath)
+        self.original_image = cv2.imread(self.image_filepath)
+        self.original_height, self.original_width = self.original_image.shape[:2]
+
+        # all parsing happens on the normalized image, use to_original_bbox to map results back
+        if normalize:
+            self.image, self.scale = resolution.normalize_image(self.original_image)
+        else:
+            self.image, self.scale = self.original_image, 1.0
         self.image_height, self.image_width = self.image.shape[:2]
+        # gray/HSV/threshold/contours of the working image, computed once and shared by the detectors
+        self.context = ImageContext(self.image)
+
+        # readers are expensive to load, callers should pass one in from an ocr.ReaderPool
+        # (or an ocr.OCRBackend, e.g. to replay recorded OCR results)
+        if reader is None:
+            reader = ocr.get_shared_reader()
+        self.ocr_backend = ocr.as_backend(reader).for_image(self.image_filepath)
+
+        # solved geometry of screenshots with the same resolution/header, see layouts.py
+        if layout_cache is None:
+            layout_cache = layouts.get_layout_cache()
+        self.layout_cache = layout_cache
+        self.layout = None
+        self.header = None
 
-        self.reader = easyocr.Reader(LANGUAGES)
+        # genre EXP digit templates, see digits.py (default: the process-wide atlas)
+        self.digit_reader = digit_reader
 
         self.artifact_bboxes = []
         self.hero_bboxes = []
@@ -253,6 +326,9 @@ class MatchParser:
         self.genres_main = []
         self.genres_banned = []
 
+        # version of the reference library the icons were matched with
+        self.reference_version = None
+
     def run(self, output_dir=OUTPUT_DIR, is_save_icons=True):
         try:
             self.main()
@@ -269,12 +345,53 @@ class MatchParser:
             self.save_icons(output_dir)
 
     def main(self):
+        self.parse()
+
+        text = self.to_text()
+        print(text)
+        # jsn = self.to_json()
+        # print(jsn)
+        rows, headers = self.to_rows()
+        df = pd.DataFrame(rows, columns=headers)
+        df.to_csv('output.tsv', sep='\t', index=False)
+        print('saved tsv')
+
+    def parse(self):
+        """Parse the screenshot into ``self.players`` without writing any output."""
+        # one pooled reader for every OCR call of the parse, see ocr.PooledBackend
+        with self.ocr_backend.hold():
+            self._parse()
+
+    def _parse(self):
         print(f'reading player placements: {self.image_filepath}')
         mid_x = self.image_width // 2
+
+        # the header position (with the resolution) fingerprints the layout
+        self.header = placements.locate_player_header(self.image[:,:mid_x], self.ocr_backend)
+        if self.layout_cache is not None:
+            self.layout = self.layout_cache.get(self.image, self.header)
+
+        # the artifact rows line up with the player rows, so the name rows can be predicted from them
+        if self.layout is not None:
+            print(f'Reusing cached {self.layout}')
+            self.artifact_bboxes = list(self.layout.artifact_bboxes)
+        else:
+            self.artifact_bboxes = artifacts.get_artifact_bboxes(self.image, context=self.context)
+            # a layout solved on another resolution/header position, scaled and moved onto this one
+            if self.layout_cache is not None:
+                self.layout = self.layout_cache.transfer(self.image, self.header, self.artifact_bboxes)
+            if self.layout is not None:
+                print(f'Transferred cached {self.layout}')
+                self.artifact_bboxes = list(self.layout.artifact_bboxes)
+        row_spacing = placements.get_row_spacing(self.artifact_bboxes)
+
         t0 = time.time()
-        self.ocr_results = self.reader.readtext(self.image[:,:mid_x],
-                                                width_ths=1.5,  # merge close bboxes
-                                                height_ths=0.7)
+        self.ocr_results = placements.read_player_names(self.image[:,:mid_x], self.ocr_backend,
+                                                        row_spacing=row_spacing,
+                                                        header=self.header,
+                                                        width_ths=1.5,  # merge close bboxes
+                                                        height_ths=0.7,
+                                                        **resolution.get_detector_kwargs())
         t1 = time.time()
         print(f'TIME DELTA {t1} - {t0} = {t1-t0}')
         self.player_placements = placements.get_player_placements(self.ocr_results)
@@ -287,20 +404,34 @@ class MatchParser:
         self.players = sorted(self.players, key=lambda p: p.placement)
 
         print('Getting bboxes')
-        self.artifact_bboxes = artifacts.get_artifact_bboxes(self.image)
         print(f'{len(self.artifact_bboxes)} artifact bboxes')
 
-        max_x = max([p[4][2][0] for p in self.player_placements if p[4]])
-        self.hero_bboxes = heroes.get_hero_bboxes(self.image, max_x=max_x)
+        if self.layout is not None:
+            self.hero_bboxes = list(self.layout.hero_bboxes)
+        else:
+            max_x = max([p[4][2][0] for p in self.player_placements if p[4]])
+            self.hero_bboxes = heroes.get_hero_bboxes(self.image, max_x=max_x, context=self.context)
         print(f'{len(self.hero_bboxes)} hero bboxes')
 
-        self.trait_bboxes, self.missing_trait_bboxes = traits.get_trait_and_missing_bboxes(self.image)
+        if self.layout is not None and self.layout.has_traits:
+            self.trait_bboxes, self.missing_trait_bboxes = self.layout.get_trait_bboxes(self.image, self.context)
+        else:
+            self.trait_bboxes, self.missing_trait_bboxes = traits.get_trait_and_missing_bboxes(self.image,
+                                                                                               self.context)
         print(f'{len(self.trait_bboxes)} trait bboxes')
 
+        if self.layout_cache is not None:
+            if self.layout is None:
+                self.cache_layout()
+            elif not self.layout.has_traits:
+                # e.g. a transferred layout, its trait cells come from the traits detected on this screenshot
+                self.layout.calibrate_traits(self.image, self.missing_trait_bboxes, self.context)
+            logger.debug('Layout cache: %s', self.layout_cache.stats())
+
         reference_width, base_x = genres.calculate_reference_width(self.artifact_bboxes)
         self.associate_bboxes(reference_width, base_x)
-        for player in self.players:
-            player.guess_icons(self.image, self.reader)
+        self.guess_icons()
+        self.read_genre_exps()
 
         self.genres_main = genres.infer_main_genres(self.players)
         self.genres_banned = genres.get_banned_genres(self.genres_main)
@@ -312,16 +443,77 @@ class MatchParser:
             player.genre_exps, player.genre_exp_changes = genres.fix_genre_exps(player.initial_genre_exps,
                                                                                 player.genre_levels,
                                                                                 player.genre_guesses)
-
-        text = self.to_text()
-        print(text)
-        # jsn = self.to_json()
-        # print(jsn)
-        rows, headers = self.to_rows()
-        df = pd.DataFrame(rows, columns=headers)
-        df.to_csv('output.tsv', sep='\t', index=False)
-        print('saved tsv')
     
+    def cache_layout(self):
+        """Add the detected geometry to the layout cache, if it is complete and passes the spot-check."""
+        layout = layouts.solve_layout(self.image, self.header, self.artifact_bboxes, self.hero_bboxes,
+                                      self.missing_trait_bboxes, self.context)
+        if layout is not None:
+            self.layout_cache.put(layout)
+
+    def to_original_bbox(self, bbox):
+        """Map an (x, y, w, h) bbox of the working image back to the original screenshot."""
+        return resolution.to_original_bbox(bbox, self.scale)
+
+    def guess_icons(self):
+        """Guess the icons of every player, one batched match per icon type for the whole screenshot."""
+        for player in self.players:
+            player.order_bboxes()
+
+        # the whole screenshot is matched with one library even if a new one is swapped in meanwhile
+        library = reference_index.get_reference_library()
+        self.reference_version = library.version
+
+        hero_players = [p for p in self.players if p.hero_bbox]
+        hero_guesses = hashes.guess_icon_hashes(self.image, [p.hero_bbox for p in hero_players], 'hero',
+                                                library=library)
+        for player, guess in zip(hero_players, hero_guesses):
+            player.set_hero_guess(*guess)
+
+        artifact_players = [p for p in self.players for _ in p.artifact_bboxes]
+        artifact_bboxes = [bbox for p in self.players for bbox in p.artifact_bboxes]
+        artifact_guesses = hashes.guess_icon_hashes(self.image, artifact_bboxes, 'artifact', library=library)
+        for player, guess in zip(artifact_players, artifact_guesses):
+            player.add_artifact_guess(*guess)
+
+        # traits are matched against the hero's traits, so after the heroes
+        trait_players = [p for p in self.players for _ in p.trait_bboxes]
+        trait_bboxes = [bbox for p in self.players for bbox in p.trait_bboxes]
+        trait_heroes = [p.get_trait_hero() for p in trait_players]
+        # one color labeling pass over the whole trait grid
+        color_map = traits.TraitColorMap(self.image, trait_bboxes)
+        trait_colors = [color for p in self.players for color in p.get_trait_colors(self.image, color_map)]
+        trait_guesses = hashes.guess_icon_hashes(self.image, trait_bboxes, 'trait', trait_heroes, trait_colors,
+                                                 library)
+        for player, guess in zip(trait_players, trait_guesses):
+            player.add_trait_guess(*guess)
+
+        for player in self.players:
+            player.infer_hero_from_traits()
+
+        genre_players = [p for p in self.players for _ in p.genre_bboxes]
+        genre_bboxes = [bbox for p in self.players for bbox in p.genre_bboxes]
+        genre_guesses = hashes.guess_icon_hashes(self.image, genre_bboxes, 'genre', library=library)
+        genre_stars = genres.get_genre_levels(self.image, genre_bboxes, self.context)
+        for player, bbox, guess, stars in zip(genre_players, genre_bboxes, genre_guesses, genre_stars):
+            player.add_genre_guess(self.image, bbox, *guess, context=self.context, genre_stars=stars)
+
+        logger.debug('Hash cascade: %s', hashes.get_cascade_stats())
+
+    def read_genre_exps(self):
+        """Read the genre EXP numbers of every player in one batched OCR call."""
+        genre_bboxes = [bbox for player in self.players for bbox in player.genre_bboxes]
+        digit_reader = self.digit_reader or digits.get_digit_reader()
+        genre_exps = genres.read_genre_exps(self.image, genre_bboxes, self.ocr_backend, digit_reader,
+                                            self.context)
+        print(f'Genre EXP reader hit rates (cumulative): {digit_reader.hit_rates()}')
+
+        i = 0
+        for player in self.players:
+            n = len(player.genre_bboxes)
+            player.initial_genre_exps = [exp for exp, _ in genre_exps[i:i+n]]
+            i += n
+
     def score_main(self):
         num_players = len(self.players)
 
@@ -353,9 +545,11 @@ class MatchParser:
         return scores
 
     def save_icons(self, output_dir):
+        """Save the icons cropped from the original screenshot, at its resolution."""
         if output_dir:
+            to_original_bbox = self.to_original_bbox if self.scale != 1.0 else None
             for player in self.players:
-                player.save_icons(self.image, output_dir)
+                player.save_icons(self.original_image, output_dir, to_original_bbox)
             print('Saved icons')
 
     def associate_bboxes(self, reference_width, base_x):
@@ -444,6 +638,7 @@ class MatchParser:
                    'ban1', 'ban2', 'ban3', 'ban4',
                    *genre_lvl_headers,
                    *genre_exp_headers,
+                   'reference_version',
                    ]
         rows = []
         for player in self.players:
@@ -468,6 +663,7 @@ class MatchParser:
                     *banned_genres,
                     *genre_levels,
                     *genre_exps,
+                    self.reference_version,
                    )
             rows.append(row)
 
@@ -512,6 +708,7 @@ class MatchParser:
                 'region': 'UNKNOWN',
                 'game_type': 'UNKNOWN',
                 'info': {'players': players_data},
+                'reference_version': self.reference_version,
                 'data_version': "1"
                 }
 
@@ -525,7 +722,10 @@ class MatchParser:
                      'hero': player.hero_guess.name,
                      'traits': [guess.name for guess in player.trait_guesses],
                      'artifacts': [guess.name for guess in player.artifact_guesses],
-                     'y_center': player.y_center,
+                     'y_center': player.y_center / self.scale,  # in original image coordinates
+                     'hero_bbox': self.to_original_bbox(player.hero_bbox),
+                     'artifact_bboxes': [self.to_original_bbox(b) for b in player.artifact_bboxes],
+                     'trait_bboxes': [self.to_original_bbox(b) for b in player.trait_bboxes],
                      'artifact_hashes': [h for h in player.artifact_hashes],
                      'hero_hash': player.hero_hash,
                      'trait_hashes': [h for h in player.trait_hashes],}
@@ -545,6 +745,7 @@ class MatchParser:
         return data
 
     def save_processed_image(self, output_dir):
+        """Save the screenshot with the parsed bboxes/guesses drawn on it, at the original resolution."""
         image_copy = self.image.copy()
 
         # draw a color scale "legend"
@@ -666,7 +867,58 @@ class MatchParser:
             text = f'{placement} - {player_name}'
             add_text_top_left(image_copy, text, font_scale=0.5, thickness=1, position=(start_x, y_cen-30))
 
+        # drawn on the working image, where the bboxes are
+        if image_copy.shape[:2] != self.original_image.shape[:2]:
+            image_copy = cv2.resize(image_copy, (self.original_width, self.original_height),
+                                    interpolation=cv2.INTER_LINEAR)
+
         image_fn = os.path.basename(self.image_filepath)
         output_fp = os.path.join(output_dir, f'output_{image_fn}')
         cv2.imwrite(output_fp, image_copy)
         print(f'Saved to: {output_fp}')
+
+
+def get_image_filepaths(input_dir=INPUT_DIR):
+    filepaths = []
+    for fn in sorted(os.listdir(input_dir)):
+        if any(fnmatch.fnmatch(fn.lower(), pattern) for pattern in IMG_EXTENSION_PATTERNS):
+            filepaths.append(os.path.join(input_dir, fn))
+
+    return filepaths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parse every match screenshot in a directory.')
+    parser.add_argument('input_dir', nargs='?', default=INPUT_DIR)
+    parser.add_argument('-o', '--output-dir', default=OUTPUT_DIR)
+    parser.add_argument('--record', metavar='DIR', help='save the OCR results of every image to DIR')
+    parser.add_argument('--replay', metavar='DIR', help='replay OCR results saved with --record (no OCR models are loaded)')
+    parser.add_argument('--save-icons', action='store_true')
+    parser.add_argument('--threads', type=int, default=None, help='torch/OpenCV threads (default: every core)')
+    args = parser.parse_args()
+
+    threads.configure(args.threads)
+
+    if args.record and args.replay:
+        parser.error('--record and --replay cannot be used together')
+
+    if args.replay:
+        backend = ocr.ReplayBackend(args.replay)
+    elif args.record:
+        backend = ocr.RecordingBackend(ocr.get_shared_reader(), args.record)
+    else:
+        backend = ocr.as_backend(ocr.get_shared_reader())
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    image_filepaths = get_image_filepaths(args.input_dir)
+    t0 = time.time()
+    for image_filepath in image_filepaths:
+        match_parser = MatchParser(image_filepath, reader=backend)
+        match_parser.run(output_dir=args.output_dir, is_save_icons=args.save_icons)
+
+    t1 = time.time()
+    print(f'Parsed {len(image_filepaths)} images in {t1-t0:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,616 @@
+"""Shared EasyOCR readers.
+
+Loading an ``easyocr.Reader`` pulls the detector and the recognizer weights
+into memory, which costs seconds of CPU per reader. Readers are built once
+per process, warmed up with a dummy inference and then handed out to the
+parsers through a ``ReaderPool``.
+
+When the text locations are already known (e.g. the genre EXP digits),
+``recognize_crops`` skips the detector and runs the recognizer over all of
+the crops in batches.
+
+Most lobbies are English only, so a ``LazyReader`` starts with the English
+recognizer and only loads the Traditional Chinese one the first time a
+crop needs it (a low confidence English read of a crop that looks like
+CJK script, see ``is_non_latin``, or the caller asks for it).
+
+The parser only talks to an ``OCRBackend``:
+ - ``EasyOCRBackend`` wraps a reader (the default)
+ - ``PooledBackend`` takes a reader from a ``ReaderPool`` for every call, or
+   once for a whole parse with ``hold``
+ - ``RecordingBackend`` wraps another backend and saves every result to disk
+ - ``ReplayBackend`` plays saved results back without loading easyocr/torch,
+   so the non-OCR stages can be profiled and tested deterministically
+
+"""
+import abc
+import hashlib
+import json
+import logging
+import math
+import os
+import queue
+import threading
+
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ENGLISH = ['en']
+CHINESE = ['ch_tra', 'en']
+LANGUAGES = CHINESE
+
+# below this confidence, the English read of a non-Latin looking crop is retried with the Chinese recognizer
+SCRIPT_CONFIDENCE_THRESHOLD = 0.5
+
+# script check: mean number of strokes crossed by the ink columns of a crop scaled to SCRIPT_CHECK_HEIGHT.
+# Latin text crosses 1-3 strokes per column (~1.5 on average), CJK characters stack many horizontal strokes
+SCRIPT_CHECK_HEIGHT = 48
+NON_LATIN_MIN_STROKES = 2.3
+
+# Reader.readtext keyword arguments that belong to the detection step
+DETECT_KWARGS = {'min_size', 'text_threshold', 'low_text', 'link_threshold',
+                 'canvas_size', 'mag_ratio', 'slope_ths', 'ycenter_ths',
+                 'height_ths', 'width_ths', 'add_margin', 'threshold',
+                 'bbox_min_score', 'bbox_min_size', 'max_candidates'}
+
+DEFAULT_POOL_SIZE = 1
+DEFAULT_BATCH_SIZE = 64
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def create_reader(languages=LANGUAGES, warmup=True, detector=True, quantize=True):
+    """Build a new easyocr.Reader, optionally warmed up with a dummy inference.
+
+    ``quantize`` applies dynamic int8 quantization on CPU to both the CRAFT
+    detector and the recognizer (see quantize.py for the accuracy check).
+
+    """
+    import easyocr
+
+    reader = easyocr.Reader(list(languages), detector=detector, quantize=quantize)
+    logger.info('Loaded %s OCR reader %s', 'int8' if quantize else 'fp32', list(languages))
+    if warmup:
+        warmup_reader(reader)
+
+    return reader
+
+
+def _make_warmup_image():
+    image = np.full((64, 320, 3), 255, dtype=np.uint8)
+    cv2.putText(image, 'PLAYER 12', (10, 45), cv2.FONT_HERSHEY_SIMPLEX,
+                1.2, (0, 0, 0), 2, cv2.LINE_AA)
+    return image
+
+
+def warmup_reader(reader):
+    """Run one detection + recognition pass so the first real parse does not pay for it."""
+    image = _make_warmup_image()
+    if getattr(reader, 'detector', None) is None:
+        recognize_crops(reader, [cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)])
+    else:
+        reader.readtext(image)
+
+
+def _is_chinese(languages):
+    return languages is not None and 'ch_tra' in languages
+
+
+def get_stroke_density(gray):
+    """Mean number of separate strokes a column with ink crosses, in a single line text crop."""
+    height, width = gray.shape[:2]
+    if height == 0 or width == 0:
+        return 0.0
+
+    new_width = max(1, int(round(width * SCRIPT_CHECK_HEIGHT / height)))
+    gray = cv2.resize(gray, (new_width, SCRIPT_CHECK_HEIGHT), interpolation=cv2.INTER_CUBIC)
+    _, binary = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # the text is the minority class, light on dark or dark on light
+    if binary.mean() > 0.5:
+        binary = 1 - binary
+
+    stroke_starts = (np.diff(binary.astype(np.int8), axis=0, prepend=0) == 1).sum(axis=0)
+    has_ink = stroke_starts > 0
+    if not has_ink.any():
+        return 0.0
+
+    return float(stroke_starts[has_ink].mean())
+
+
+def is_non_latin(gray):
+    """Check if a single line text crop looks like CJK script (dense stacked strokes)."""
+    return get_stroke_density(gray) >= NON_LATIN_MIN_STROKES
+
+
+def _get_box_key(box):
+    return tuple((int(round(x)), int(round(y))) for x, y in box)
+
+
+def _get_box_crop(gray, box):
+    """Bounding rect crop of an easyocr box (4 points)."""
+    xs = [x for x, _ in box]
+    ys = [y for _, y in box]
+    x0, y0 = max(0, int(min(xs))), max(0, int(min(ys)))
+    return gray[y0:int(math.ceil(max(ys))), x0:int(math.ceil(max(xs)))]
+
+
+class LazyReader:
+    """English reader that loads the Traditional Chinese recognizer on demand.
+
+    Text detection always runs on the English reader (the detector does not
+    depend on the language). Each detected box is then recognized in
+    English and only retried with the Chinese recognizer when the English
+    confidence is below SCRIPT_CONFIDENCE_THRESHOLD and the crop looks like
+    CJK script (``is_non_latin``), keeping the more confident read. Pass ``languages=CHINESE`` to skip the English pass
+    (e.g. when the header is already known to be Chinese), or
+    ``languages=ENGLISH`` to never load the Chinese recognizer.
+
+    """
+
+    def __init__(self, warmup=True, quantize=True):
+        self.warmup = warmup
+        self.quantize = quantize
+        self.english = create_reader(ENGLISH, warmup=warmup, quantize=quantize)
+        self._chinese = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_chinese_loaded(self):
+        return self._chinese is not None
+
+    @property
+    def chinese(self):
+        with self._lock:
+            if self._chinese is None:
+                logger.info('Loading the Traditional Chinese OCR recognizer')
+                # the detector of the English reader is reused, only load the recognizer
+                self._chinese = create_reader(CHINESE, warmup=self.warmup, detector=False,
+                                              quantize=self.quantize)
+
+        return self._chinese
+
+    def readtext(self, image, languages=None, **kwargs):
+        detect_kwargs = {k: v for k, v in kwargs.items() if k in DETECT_KWARGS}
+        recognize_kwargs = {k: v for k, v in kwargs.items() if k not in DETECT_KWARGS}
+
+        horizontal_list, free_list = self.english.detect(image, **detect_kwargs)
+        horizontal_list, free_list = horizontal_list[0], free_list[0]
+        if not horizontal_list and not free_list:
+            return []
+
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if _is_chinese(languages):
+            return self.chinese.recognize(gray, horizontal_list, free_list, **recognize_kwargs)
+
+        results = self.english.recognize(gray, horizontal_list, free_list, **recognize_kwargs)
+        retry_idxs = [i for i, (box, _, conf) in enumerate(results)
+                      if conf < SCRIPT_CONFIDENCE_THRESHOLD and is_non_latin(_get_box_crop(gray, box))]
+        if not retry_idxs:
+            return results
+
+        # easyocr sorts the results by their top y and drops empty boxes, so they are matched
+        # back to the boxes (and the retried results to these results) by their coordinates
+        free_boxes = {_get_box_key(box): box for box in free_list}
+        retry_horizontal = []
+        retry_free = []
+        key2idxs = {}
+        for i in retry_idxs:
+            box = results[i][0]
+            key = _get_box_key(box)
+            if key in key2idxs:
+                key2idxs[key].append(i)
+                continue
+            key2idxs[key] = [i]
+            if key in free_boxes:
+                retry_free.append(free_boxes[key])
+            else:
+                # horizontal boxes come back as the clipped [x_min, x_max, y_min, y_max] corners
+                (x_min, y_min), _, (x_max, y_max), _ = key
+                retry_horizontal.append([x_min, x_max, y_min, y_max])
+        retried = self.chinese.recognize(gray, retry_horizontal, retry_free, **recognize_kwargs)
+
+        results = list(results)
+        for result in retried:
+            for i in key2idxs.get(_get_box_key(result[0]), []):
+                if result[2] > results[i][2]:
+                    results[i] = result
+
+        return results
+
+    def recognize_crops(self, crops, allowlist=None, batch_size=DEFAULT_BATCH_SIZE, languages=None):
+        if _is_chinese(languages):
+            return recognize_crops(self.chinese, crops, allowlist=allowlist, batch_size=batch_size)
+
+        results = recognize_crops(self.english, crops, allowlist=allowlist, batch_size=batch_size)
+        if languages is not None:
+            # explicitly English only
+            return results
+        if allowlist and allowlist.isdigit():
+            # numbers never need the Chinese recognizer
+            return results
+
+        retry_idxs = [i for i, (_, conf) in enumerate(results)
+                      if conf < SCRIPT_CONFIDENCE_THRESHOLD and is_non_latin(crops[i])]
+        if not retry_idxs:
+            return results
+
+        retried = recognize_crops(self.chinese, [crops[i] for i in retry_idxs],
+                                  allowlist=allowlist, batch_size=batch_size)
+        results = list(results)
+        for i, result in zip(retry_idxs, retried):
+            if result[1] > results[i][1]:
+                results[i] = result
+
+        return results
+
+
+class ReaderPool:
+    """Fixed size pool of preloaded readers.
+
+    ``acquire`` blocks until a reader is free, so at most ``size`` parses run
+    OCR at the same time.
+
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, warmup=True, quantize=True):
+        if size < 1:
+            raise ValueError(f'Reader pool size must be at least 1, received: {size}')
+
+        self.size = size
+        self.warmup = warmup
+        self.quantize = quantize
+
+        self._readers = queue.Queue()
+        self._num_created = 0
+        self._lock = threading.Lock()
+
+    def preload(self):
+        """Create (and warm up) every reader in the pool up front."""
+        while self._reserve():
+            self._readers.put(self._create())
+
+    def _reserve(self):
+        with self._lock:
+            if self._num_created >= self.size:
+                return False
+            self._num_created += 1
+            return True
+
+    def _create(self):
+        logger.info('Loading OCR reader %s/%s', self._num_created, self.size)
+        return LazyReader(warmup=self.warmup, quantize=self.quantize)
+
+    def _get(self):
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+
+        if self._reserve():
+            return self._create()
+
+        return self._readers.get()
+
+    @contextmanager
+    def acquire(self):
+        reader = self._get()
+        try:
+            yield reader
+        finally:
+            self._readers.put(reader)
+
+
+def get_reader_pool(size=None, quantize=None):
+    """Return the process-wide reader pool, creating it on first use.
+
+    ``size`` and ``quantize`` configure the pool when it is created, later
+    calls raise a ValueError if they ask for a different configuration
+    (leave them as None to take the existing pool as is).
+
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ReaderPool(size or DEFAULT_POOL_SIZE, quantize=True if quantize is None else quantize)
+        elif (size is not None and size != _POOL.size) or (quantize is not None and quantize != _POOL.quantize):
+            raise ValueError(f'The reader pool already exists with size={_POOL.size}, quantize={_POOL.quantize}, '
+                             f'received: size={size}, quantize={quantize}')
+
+    return _POOL
+
+
+def get_shared_reader():
+    """Return a backend over the process-wide pool, see ``PooledBackend``.
+
+    Meant for callers (scripts, notebooks, workers) that do not manage a
+    pool themselves.
+
+    """
+    return PooledBackend(get_reader_pool())
+
+
+def recognize_crops(reader, crops, allowlist=None, batch_size=DEFAULT_BATCH_SIZE, languages=None):
+    """Run only the recognition network over a list of grayscale crops.
+
+    Parameters
+    ----------
+    reader : easyocr.Reader or LazyReader
+    crops : list of np.ndarray
+        single channel images, each expected to contain one line of text
+    allowlist : str, optional
+        only these characters can be predicted (same as ``readtext``)
+    batch_size : int
+        number of crops per forward pass
+    languages : list, optional
+        recognizer to use with a LazyReader, by default it is picked per crop
+
+    Returns
+    -------
+    list of tuples
+        (text, confidence) for every crop, in the same order as ``crops``
+
+    """
+    if not crops:
+        return []
+
+    if isinstance(reader, LazyReader):
+        return reader.recognize_crops(crops, allowlist=allowlist, batch_size=batch_size, languages=languages)
+
+    from easyocr import easyocr as _easyocr
+    from easyocr.recognition import get_text
+    from easyocr.utils import get_image_list
+
+    model_height = _easyocr.imgH
+
+    if allowlist:
+        ignore_char = ''.join(set(reader.character) - set(allowlist))
+    else:
+        ignore_char = ''.join(set(reader.character) - set(reader.lang_char))
+
+    image_list = []
+    crop_indexes = []
+    max_width = model_height
+    for i, crop in enumerate(crops):
+        height, width = crop.shape[:2]
+        if height == 0 or width == 0:
+            continue
+
+        items, crop_max_width = get_image_list([[0, width, 0, height]], [], crop,
+                                               model_height=model_height, sort_output=False)
+        if not items:
+            continue
+
+        image_list.extend(items)
+        crop_indexes.append(i)
+        max_width = max(max_width, crop_max_width)
+
+    results = [('', 0.0)] * len(crops)
+    if not image_list:
+        return results
+
+    batch_size = max(1, min(batch_size, len(image_list)))
+    predictions = get_text(reader.character, model_height, int(math.ceil(max_width)),
+                           reader.recognizer, reader.converter, image_list,
+                           ignore_char=ignore_char, batch_size=batch_size,
+                           workers=0, device=reader.device)
+
+    for i, (_, text, confidence) in zip(crop_indexes, predictions):
+        results[i] = (text, float(confidence))
+
+    return results
+
+
+class OCRBackend(abc.ABC):
+    """OCR interface used by the parser.
+
+    All methods take ``languages`` as a hint for which recognizer to use,
+    backends are free to ignore it. Backends implement ``readtext`` and
+    ``recognize_crops``, the rest is built on them.
+
+    """
+
+    @abc.abstractmethod
+    def readtext(self, image, languages=None, **kwargs):
+        """Detect and recognize text, same output as ``easyocr.Reader.readtext``."""
+
+    @abc.abstractmethod
+    def recognize_crops(self, crops, allowlist=None, batch_size=DEFAULT_BATCH_SIZE, languages=None):
+        """Recognize pre-cropped single line images, returns (text, confidence) per crop."""
+
+    def recognize(self, image, bboxes, allowlist=None, batch_size=DEFAULT_BATCH_SIZE, languages=None):
+        """Recognize the text inside each (x, y, w, h) bbox of the image, skipping detection."""
+        crops = [image[y:y+h, x:x+w] for x, y, w, h in bboxes]
+        crops = [c if c.ndim == 2 else cv2.cvtColor(c, cv2.COLOR_BGR2GRAY) for c in crops]
+        return self.recognize_crops(crops, allowlist=allowlist, batch_size=batch_size, languages=languages)
+
+    def readtext_batch(self, images, languages=None, **kwargs):
+        return [self.readtext(image, languages=languages, **kwargs) for image in images]
+
+    def for_image(self, image_filepath):
+        """Return the backend to use while parsing ``image_filepath``."""
+        return self
+
+    @contextmanager
+    def hold(self):
+        """Keep what the calls share (e.g. a pooled reader) for the duration of a parse."""
+        yield self
+
+
+class EasyOCRBackend(OCRBackend):
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def readtext(self, image, languages=None, **kwargs):
+        if isinstance(self.reader, LazyReader):
+            kwargs['languages'] = languages
+        return self.reader.readtext(image, **kwargs)
+
+    def recognize_crops(self, crops, allowlist=None, batch_size=DEFAULT_BATCH_SIZE, languages=None):
+        return recognize_crops(self.reader, crops, allowlist=allowlist, batch_size=batch_size, languages=languages)
+
+
+class PooledBackend(OCRBackend):
+    """Acquire a reader from a ReaderPool for every call, or once for a whole parse.
+
+    Within ``with backend.hold():`` every call uses the same reader, so a
+    parse neither waits on the pool for each of its OCR calls nor hops
+    between readers. ``for_image`` returns a new session, concurrent parses
+    each hold their own reader.
+
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._reader = None
+
+    def for_image(self, image_filepath):
+        return PooledBackend(self.pool)
+
+    @contextmanager
+    def hold(self):
+        if self._reader is not None:
+            yield self
+            return
+
+        with self.pool.acquire() as reader:
+            self._reader = reader
+            try:
+                yield self
+            finally:
+                self._reader = None
+
+    @contextmanager
+    def _acquire(self):
+        if self._reader is not None:
+            yield self._reader
+        else:
+            with self.pool.acquire() as reader:
+                yield reader
+
+    def readtext(self, image, languages=None, **kwargs):
+        with self._acquire() as reader:
+            return EasyOCRBackend(reader).readtext(image, languages=languages, **kwargs)
+
+    def recognize_crops(self, crops, allowlist=None, batch_size=DEFAULT_BATCH_SIZE, languages=None):
+        with self._acquire() as reader:
+            return recognize_crops(reader, crops, allowlist=allowlist, batch_size=batch_size, languages=languages)
+
+
+def as_backend(reader):
+    """Wrap a reader (easyocr.Reader or LazyReader) as an OCRBackend, backends are returned as is."""
+    if isinstance(reader, OCRBackend):
+        return reader
+
+    return EasyOCRBackend(reader)
+
+
+def _hash_call(method, image, **kwargs):
+    sha = hashlib.sha1(method.encode())
+    images = image if isinstance(image, (list, tuple)) else [image]
+    for img in images:
+        img = np.ascontiguousarray(img)
+        sha.update(str(img.shape).encode())
+        sha.update(img.tobytes())
+    sha.update(json.dumps(kwargs, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+def _to_json(results):
+    """Convert easyocr output (with numpy numbers) to plain json types."""
+    if isinstance(results, (list, tuple)):
+        return [_to_json(r) for r in results]
+    if isinstance(results, np.generic):
+        return results.item()
+    return results
+
+
+def _from_json_readtext(results):
+    return [(bbox, text, conf) for bbox, text, conf in results]
+
+
+def _from_json_crops(results):
+    return [(text, conf) for text, conf in results]
+
+
+def get_record_filepath(record_dir, image_filepath):
+    return os.path.join(record_dir, f'{os.path.basename(image_filepath)}.ocr.json')
+
+
+class RecordingBackend(OCRBackend):
+    """Run another backend and save its results, one json file per image."""
+
+    def __init__(self, backend, record_dir):
+        self.backend = as_backend(backend)
+        self.record_dir = record_dir
+        self.record_filepath = None
+        self.records = {}
+
+    def for_image(self, image_filepath):
+        os.makedirs(self.record_dir, exist_ok=True)
+        session = RecordingBackend(self.backend.for_image(image_filepath), self.record_dir)
+        session.record_filepath = get_record_filepath(self.record_dir, image_filepath)
+        return session
+
+    @contextmanager
+    def hold(self):
+        with self.backend.hold():
+            yield self
+
+    def _save(self, key, results):
+        self.records[key] = _to_json(results)
+        if self.record_filepath:
+            with open(self.record_filepath, 'w', encoding='utf-8') as f:
+                json.dump(self.records, f, ensure_ascii=False)
+
+    def readtext(self, image, languages=None, **kwargs):
+        results = self.backend.readtext(image, languages=languages, **kwargs)
+        self._save(_hash_call('readtext', image, languages=languages, **kwargs), results)
+        return results
+
+    def recognize_crops(self, crops, allowlist=None, batch_size=DEFAULT_BATCH_SIZE, languages=None):
+        results = self.backend.recognize_crops(crops, allowlist=allowlist, batch_size=batch_size, languages=languages)
+        self._save(_hash_call('recognize_crops', crops, allowlist=allowlist, languages=languages), results)
+        return results
+
+
+class ReplayBackend(OCRBackend):
+    """Return OCR results saved by a RecordingBackend.
+
+    Raises a KeyError if a call was never recorded (e.g. an upstream stage
+    changed the crops), so replays stay deterministic.
+
+    """
+
+    def __init__(self, record_dir):
+        self.record_dir = record_dir
+        self.records = {}
+
+    def for_image(self, image_filepath):
+        record_filepath = get_record_filepath(self.record_dir, image_filepath)
+        if not os.path.exists(record_filepath):
+            raise FileNotFoundError(f'No OCR recording for {image_filepath}: {record_filepath} does not exist, '
+                                    f'record it first with --record {self.record_dir}')
+
+        session = ReplayBackend(self.record_dir)
+        with open(record_filepath, encoding='utf-8') as f:
+            session.records = json.load(f)
+        return session
+
+    def _load(self, key, method):
+        if key not in self.records:
+            raise KeyError(f'No recorded OCR result for this {method} call')
+        return self.records[key]
+
+    def readtext(self, image, languages=None, **kwargs):
+        key = _hash_call('readtext', image, languages=languages, **kwargs)
+        return _from_json_readtext(self._load(key, 'readtext'))
+
+    def recognize_crops(self, crops, allowlist=None, batch_size=DEFAULT_BATCH_SIZE, languages=None):
+        key = _hash_call('recognize_crops', crops, allowlist=allowlist, languages=languages)
+        return _from_json_crops(self._load(key, 'recognize_crops'))
@@ -0,0 +1,263 @@
+"""Memoization of OCR results per crop.
+
+The same crops (genre EXP numbers like "12", "24", "40", the names of the
+regular players) show up across thousands of screenshots. ``CachingBackend``
+sits in front of another OCR backend and keeps an LRU of
+(text, confidence) keyed by a hash of the preprocessed crop:
+
+ - 'exact': hash of the raw pixels, only identical crops hit
+ - 'perceptual': hash of the crop binarized at a fixed height, so crops
+   that only differ by compression noise / background also hit. Only used
+   for digit reads (the genre EXP numbers): different player names can
+   binarize to the same thumbnail, names always use the exact key
+
+The cache is bounded by an (estimated) size in bytes and can be persisted
+between restarts to a journal file, one json [key, value] line per entry.
+``save`` only appends the entries added since the last save, the file is
+rewritten (compacted) once it holds COMPACT_RATIO times more lines than
+the cache has entries.
+
+"""
+import hashlib
+import json
+import os
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from .ocr import DEFAULT_BATCH_SIZE, OCRBackend, as_backend
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+PERCEPTUAL_HEIGHT = 16
+
+# rough per entry overhead of the dict/tuple/str objects
+ENTRY_OVERHEAD_BYTES = 200
+
+KEY_TYPES = ('exact', 'perceptual')
+
+COMPACT_RATIO = 2
+
+
+def validate_key_type(key_type):
+    if key_type not in KEY_TYPES:
+        raise ValueError(f'Unknown cache key type: {key_type}. Expected one of {KEY_TYPES}')
+    return key_type
+
+
+def _exact_digest(image):
+    image = np.ascontiguousarray(image)
+    sha = hashlib.blake2b(digest_size=16)
+    sha.update(str(image.shape).encode())
+    sha.update(image.tobytes())
+    return sha.hexdigest()
+
+
+def _perceptual_digest(image):
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    height, width = image.shape[:2]
+    if height == 0 or width == 0:
+        return _exact_digest(image)
+
+    # round the width so a 1px difference in the crop does not change the key
+    new_width = max(4, int(round(PERCEPTUAL_HEIGHT * width / height / 4)) * 4)
+    small = cv2.resize(image, (new_width, PERCEPTUAL_HEIGHT), interpolation=cv2.INTER_AREA)
+    _, binary = cv2.threshold(small, 0, 1, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    return _exact_digest(np.packbits(binary, axis=1))
+
+
+def get_crop_key(crop, key_type='exact', **kwargs):
+    """Cache key for a crop + the OCR settings used to read it."""
+    if validate_key_type(key_type) == 'exact':
+        digest = _exact_digest(crop)
+    else:
+        digest = _perceptual_digest(crop)
+
+    settings = json.dumps(kwargs, sort_keys=True, default=str)
+    return f'{key_type}:{digest}:{settings}'
+
+
+def _entry_size(key, value):
+    return len(key) + len(json.dumps(value, default=str)) + ENTRY_OVERHEAD_BYTES
+
+
+class OCRCache:
+    """Thread safe LRU of OCR results, bounded by size in bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, filepath=None):
+        self.max_bytes = max_bytes
+        self.filepath = filepath
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_used = 0
+
+        self._entries = OrderedDict()
+        # added since the last save, and the number of lines in the journal file
+        self._unsaved = OrderedDict()
+        self._num_saved_lines = 0
+        self._lock = threading.Lock()
+
+        if filepath and os.path.exists(filepath):
+            self.load(filepath)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._unsaved[key] = value
+            self._put(key, value)
+
+    def _put(self, key, value):
+        if key in self._entries:
+            self.bytes_used -= _entry_size(key, self._entries.pop(key))
+
+        self._entries[key] = value
+        self.bytes_used += _entry_size(key, value)
+
+        while self.bytes_used > self.max_bytes and self._entries:
+            old_key, old_value = self._entries.popitem(last=False)
+            self.bytes_used -= _entry_size(old_key, old_value)
+            self._unsaved.pop(old_key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'entries': len(self._entries),
+                'bytes_used': self.bytes_used,
+                'max_bytes': self.max_bytes,
+                }
+
+    def take_unsaved(self):
+        """Return the (key, value) entries added since the last save/take and forget them."""
+        with self._lock:
+            entries = list(self._unsaved.items())
+            self._unsaved.clear()
+        return entries
+
+    def merge(self, entries):
+        """Add (key, value) entries read elsewhere, e.g. in a parser worker, they are saved like new ones."""
+        for key, value in entries:
+            self.put(key, value)
+
+    def save(self, filepath=None):
+        """Append the entries added since the last save to the journal, compacting it when it grew too long."""
+        filepath = filepath or self.filepath
+        if not filepath:
+            return
+
+        with self._lock:
+            is_compact = (self._num_saved_lines + len(self._unsaved) > COMPACT_RATIO * len(self._entries)
+                          or not os.path.exists(filepath))
+            # least recently used first, so loading restores the LRU order
+            entries = list(self._entries.items() if is_compact else self._unsaved.items())
+            self._unsaved.clear()
+            if is_compact:
+                self._num_saved_lines = len(entries)
+            else:
+                self._num_saved_lines += len(entries)
+
+        if not entries and not is_compact:
+            return
+
+        lines = ''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries)
+        if is_compact:
+            tmp_filepath = f'{filepath}.tmp'
+            with open(tmp_filepath, 'w', encoding='utf-8') as f:
+                f.write(lines)
+            os.replace(tmp_filepath, filepath)
+        else:
+            with open(filepath, 'a', encoding='utf-8') as f:
+                f.write(lines)
+
+    def load(self, filepath):
+        num_lines = 0
+        with open(filepath, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    key, value = json.loads(line)
+                except ValueError:
+                    # e.g. a line cut short by a crash while appending
+                    continue
+                num_lines += 1
+                with self._lock:
+                    self._put(key, value)
+
+        with self._lock:
+            self._num_saved_lines = num_lines
+
+
+class CachingBackend(OCRBackend):
+    """OCR backend that answers repeated crops from an OCRCache."""
+
+    def __init__(self, backend, cache, key_type='exact'):
+        self.backend = as_backend(backend)
+        self.cache = cache
+        self.key_type = validate_key_type(key_type)
+
+    def for_image(self, image_filepath):
+        return CachingBackend(self.backend.for_image(image_filepath), self.cache, self.key_type)
+
+    @contextmanager
+    def hold(self):
+        with self.backend.hold():
+            yield self
+
+    def readtext(self, image, languages=None, **kwargs):
+        # whole regions rarely repeat exactly, only cache exact matches
+        key = get_crop_key(image, 'exact', method='readtext', languages=languages, **kwargs)
+        results = self.cache.get(key)
+        if results is None:
+            results = self.backend.readtext(image, languages=languages, **kwargs)
+            self.cache.put(key, [(_to_int_bbox(bbox), text, float(conf)) for bbox, text, conf in results])
+            return results
+
+        return [(bbox, text, conf) for bbox, text, conf in results]
+
+    def recognize_crops(self, crops, allowlist=None, batch_size=DEFAULT_BATCH_SIZE, languages=None):
+        # a perceptual hit on a name could return another player's name, only digits tolerate it
+        key_type = self.key_type if allowlist and allowlist.isdigit() else 'exact'
+        keys = [get_crop_key(crop, key_type, allowlist=allowlist, languages=languages) for crop in crops]
+        results = [self.cache.get(key) for key in keys]
+
+        # identical crops within the same call (e.g. the same EXP number twice) are only read once
+        key2idx = {}
+        for i, result in enumerate(results):
+            if result is None:
+                key2idx.setdefault(keys[i], i)
+
+        if key2idx:
+            missing_idxs = list(key2idx.values())
+            texts = self.backend.recognize_crops([crops[i] for i in missing_idxs], allowlist=allowlist,
+                                                 batch_size=batch_size, languages=languages)
+            for i, (text, conf) in zip(missing_idxs, texts):
+                self.cache.put(keys[i], (text, float(conf)))
+
+            key2result = {keys[i]: (text, float(conf)) for i, (text, conf) in zip(missing_idxs, texts)}
+            results = [key2result[key] if result is None else result for key, result in zip(keys, results)]
+
+        return [(text, conf) for text, conf in results]
+
+
+def _to_int_bbox(bbox):
+    return [[int(x), int(y)] for x, y in bbox]
@@ -5,11 +5,41 @@ General Algorithm:
  - find all text underneath that start under the "PLAYER" header
  - Assign placements based off the vertical spacing of each text
 
+To keep the OCR text detection cheap, the header is first located from the
+text lines of a downscaled image (only the candidate lines are recognized),
+and text detection then only runs on the name column under it.
+
+When the row spacing is already known (e.g. from the artifact rows), the
+8 name rows are predicted from the header and only recognized, skipping
+text detection entirely. Low confidence rows fall back to the detection path.
 
 """
+import cv2
 import numpy as np
 
+from . import ocr
+
 UNKNOWN_PLAYER_NAME = 'UNKNOWN_PLAYER'
+HEADER_TEXTS = {'PLAYER', '玩家'}
+EXPECTED_PLAYERS = 8
+
+# spacing between the bottom of "PLAYER" header and 1st place, relative to the row spacing
+FIRST_SPACING_FACTOR = 0.73
+
+# header locator
+LOCATOR_SCALE = 0.25
+LOCATOR_MAX_Y_PERC = 0.5  # the header is in the top half of the screenshot
+MIN_LINE_ASPECT_RATIO = 1.2
+MAX_LINE_ASPECT_RATIO = 12
+
+# name column, relative to the width of the header
+NAME_COLUMN_PAD = 0.5
+NAME_COLUMN_WIDTH = 3
+
+# predicted name rows
+NAME_ROW_HEIGHT = 1.6  # relative to the header height
+NAME_ROW_MARGIN = 0.1  # same margin easyocr adds around detected text, relative to the row height
+NAME_ROW_CONFIDENCE_THRESHOLD = 0.5
 
 
 def get_minmax(bounding_box):
@@ -31,6 +61,249 @@ def get_center(bounding_box):
     return float(xcen), float(ycen)
 
 
+def find_text_lines(image, scale=LOCATOR_SCALE):
+    """Find candidate text line bboxes (x, y, w, h) on a downscaled copy of the image."""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    # text has strong edges, merge the edges of each character into one line blob
+    gradient = cv2.morphologyEx(small, cv2.MORPH_GRADIENT, np.ones((3, 3), np.uint8))
+    _, binary = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    closed = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (5, 1)))
+
+    num_labels, _, stats, _ = cv2.connectedComponentsWithStats(closed, connectivity=8)
+
+    lines = []
+    for label in range(1, num_labels):
+        x, y, w, h, _ = stats[label]
+        if h < 3:
+            continue
+        aspect_ratio = w / h
+        if not MIN_LINE_ASPECT_RATIO <= aspect_ratio <= MAX_LINE_ASPECT_RATIO:
+            continue
+
+        # back to the full resolution (with a 1px margin at the small scale)
+        bbox = (int((x - 1) / scale), int((y - 1) / scale), int((w + 2) / scale), int((h + 2) / scale))
+        lines.append(bbox)
+
+    return lines
+
+
+def to_easyocr_bbox(x0, y0, x1, y1):
+    return [[x0, y0], [x1, y0], [x1, y1], [x0, y1]]
+
+
+def _find_header_texts(boxes, texts):
+    headers = []
+    for box, (text, conf) in zip(boxes, texts):
+        text = text.strip().upper()
+        if text in HEADER_TEXTS:
+            headers.append((box, text, conf))
+
+    return headers
+
+
+def locate_player_header(image, ocr_backend):
+    """Locate the "PLAYER" header without running the OCR text detection.
+
+    Returns the header as an easyocr result (bbox, text, confidence),
+    or None if it could not be found.
+
+    """
+    height, width = image.shape[:2]
+    max_y = height * LOCATOR_MAX_Y_PERC
+    lines = [b for b in find_text_lines(image) if b[1] < max_y]
+    if not lines:
+        return None
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    clipped = []
+    crops = []
+    for x, y, w, h in lines:
+        x0, y0 = max(0, x), max(0, y)
+        x1, y1 = min(width, x + w), min(height, y + h)
+        clipped.append((x0, y0, x1, y1))
+        crops.append(gray[y0:y1, x0:x1])
+
+    # most lobbies are English, only try the Chinese recognizer when the English pass finds nothing
+    texts = ocr_backend.recognize_crops(crops, languages=ocr.ENGLISH)
+    headers = _find_header_texts(clipped, texts)
+    if not headers:
+        retry_idxs = [i for i, (_, conf) in enumerate(texts)
+                      if conf < ocr.SCRIPT_CONFIDENCE_THRESHOLD and ocr.is_non_latin(crops[i])]
+        texts = ocr_backend.recognize_crops([crops[i] for i in retry_idxs], languages=ocr.CHINESE)
+        headers = _find_header_texts([clipped[i] for i in retry_idxs], texts)
+
+    if not headers:
+        return None
+
+    (x0, y0, x1, y1), text, conf = max(headers, key=lambda h: h[2])
+    return to_easyocr_bbox(x0, y0, x1, y1), text, conf
+
+
+def get_name_column_roi(header, image_width, image_height):
+    """Return the (x0, y0, x1, y1) region with the header and the player names under it."""
+    px0, px1, py0, py1 = get_minmax(header[0])
+    header_width = px1 - px0
+    header_height = py1 - py0
+
+    x0 = max(0, int(px0 - NAME_COLUMN_PAD * header_width))
+    x1 = min(image_width, int(px1 + NAME_COLUMN_WIDTH * header_width))
+    y0 = max(0, int(py0 - header_height))
+    y1 = image_height
+
+    return x0, y0, x1, y1
+
+
+def offset_easyocr_results(easyocr_results, dx, dy):
+    """Shift the bboxes of easyocr results run on a crop back to the full image."""
+    shifted = []
+    for bbox, text, confidence in easyocr_results:
+        bbox = [[int(x) + dx, int(y) + dy] for x, y in bbox]
+        shifted.append((bbox, text, confidence))
+
+    return shifted
+
+
+def get_row_spacing(bboxes):
+    """Median vertical spacing between the rows of (x, y, w, h) bboxes (e.g. artifacts)."""
+    if not bboxes:
+        return None
+
+    min_height = min(b[3] for b in bboxes)
+    y_centers = sorted(b[1] + b[3] / 2 for b in bboxes)
+
+    # group bboxes on the same row
+    rows = [[y_centers[0]]]
+    for y_center in y_centers[1:]:
+        if y_center - rows[-1][-1] < min_height / 2:
+            rows[-1].append(y_center)
+        else:
+            rows.append([y_center])
+
+    if len(rows) < 2:
+        return None
+
+    row_centers = [np.mean(row) for row in rows]
+    return float(np.median(np.diff(row_centers)))
+
+
+def predict_name_rows(header, row_spacing, max_x):
+    """Predict the (x0, y0, x1, y1) box of each name row from the header position."""
+    px0, px1, py0, py1 = get_minmax(header[0])
+    header_width = px1 - px0
+    row_height = NAME_ROW_HEIGHT * (py1 - py0)
+
+    x0 = int(max(0, px0 - NAME_COLUMN_PAD * header_width))
+    x1 = int(min(max_x, px1 + NAME_COLUMN_WIDTH * header_width))
+
+    rows = []
+    y_center = py1 + FIRST_SPACING_FACTOR * row_spacing
+    for _ in range(EXPECTED_PLAYERS):
+        y0 = int(max(0, y_center - row_height / 2))
+        y1 = int(y_center + row_height / 2)
+        rows.append((x0, y0, x1, y1))
+        y_center += row_spacing
+
+    return rows
+
+
+def tighten_text_box(gray, box, column=None):
+    """Shrink a (x0, y0, x1, y1) box horizontally to the text inside it, or None if it is empty.
+
+    ``column`` is the (min x, max x) range the text has to start in (the
+    header's, see get_players). Anything left of it (the reporter marker,
+    the row highlight) is ignored and the start is clamped into it.
+
+    """
+    x0, y0, x1, y1 = box
+    min_x0, max_x0 = column if column is not None else (x0, x1)
+    x0 = max(x0, int(min_x0))
+    crop = gray[y0:y1, x0:x1]
+    if crop.size == 0:
+        return None
+
+    gradient = cv2.morphologyEx(crop, cv2.MORPH_GRADIENT, np.ones((3, 3), np.uint8))
+    _, binary = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    columns = np.flatnonzero(binary.any(axis=0))
+    if len(columns) == 0:
+        return None
+
+    margin = int(NAME_ROW_MARGIN * (y1 - y0))
+    return (int(min(max_x0, max(x0, x0 + columns[0] - margin))), y0,
+            int(min(x1, x0 + columns[-1] + 1 + margin)), y1)
+
+
+def recognize_name_rows(image, ocr_backend, header, row_spacing, languages=None):
+    """Recognize the predicted name rows without text detection.
+
+    Returns easyocr style results (header first), or None if any row is
+    below NAME_ROW_CONFIDENCE_THRESHOLD.
+
+    """
+    height, width = image.shape[:2]
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # get_players only keeps the names starting within the header
+    px0, px1, _, _ = get_minmax(header[0])
+
+    boxes = []
+    for box in predict_name_rows(header, row_spacing, width):
+        if box[3] > height:
+            return None
+        box = tighten_text_box(gray, box, column=(px0, px1))
+        if box is None:
+            return None
+        boxes.append(box)
+
+    crops = [gray[y0:y1, x0:x1] for x0, y0, x1, y1 in boxes]
+    texts = ocr_backend.recognize_crops(crops, languages=languages)
+    if any(conf < NAME_ROW_CONFIDENCE_THRESHOLD for _, conf in texts):
+        return None
+
+    results = [header]
+    for (x0, y0, x1, y1), (text, conf) in zip(boxes, texts):
+        results.append((to_easyocr_bbox(x0, y0, x1, y1), text, conf))
+
+    return results
+
+
+def read_player_names(image, ocr_backend, row_spacing=None, header=None, **readtext_kwargs):
+    """OCR the player name column.
+
+    The column is found from the "PLAYER" header (located here unless
+    ``header`` is given), with a fallback to scanning the whole image when
+    the header cannot be located. If ``row_spacing`` is given, the name rows
+    are recognized directly first.
+
+    """
+    height, width = image.shape[:2]
+    if header is None:
+        header = locate_player_header(image, ocr_backend)
+    if header is not None:
+        if header[1] == '玩家':
+            readtext_kwargs['languages'] = ocr.CHINESE
+
+        if row_spacing:
+            results = recognize_name_rows(image, ocr_backend, header, row_spacing,
+                                          languages=readtext_kwargs.get('languages'))
+            if results is not None:
+                return results
+            print('Low confidence on the predicted name rows, falling back to text detection')
+
+        x0, y0, x1, y1 = get_name_column_roi(header, width, height)
+        results = ocr_backend.readtext(image[y0:y1, x0:x1], **readtext_kwargs)
+        results = offset_easyocr_results(results, x0, y0)
+
+        if not any(text in HEADER_TEXTS for _, text, _ in results):
+            results = [header] + results
+
+        if get_players(results):
+            return results
+
+    print('Could not locate the player name column, reading the whole image')
+    return ocr_backend.readtext(image, **readtext_kwargs)
+
+
 def get_player_header(easyocr_results):
     px0 = None
     for i, (bbox, text, confidence) in enumerate(easyocr_results):
@@ -133,7 +406,7 @@ def get_player_placements(easyocr_results):
 
     ydeltas = [players[i+1][1] - players[i][1] for i in range(len(players)-1)]
     median_spacing = np.median(ydeltas)
-    expected_1st_spacing = median_spacing * 0.73  # spacing between the bottom of "PLAYER" header and 1st place
+    expected_1st_spacing = median_spacing * FIRST_SPACING_FACTOR  # spacing between the bottom of "PLAYER" header and 1st place
 
     placement = 1
     placements = []
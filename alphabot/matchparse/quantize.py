@@ -0,0 +1,128 @@
+"""Accuracy gate for the int8 (dynamically quantized) OCR models.
+
+Parses a sample corpus of screenshots with fp32 and with int8 readers and
+compares what ends up in the spreadsheet: player placements (names) and
+genre EXP numbers. Quantization is only enabled if both agree at least
+``min_agreement`` of the time.
+
+    python -m matchparse.quantize input/ --min-agreement 0.98
+
+"""
+import argparse
+import contextlib
+import io
+import os
+import time
+import traceback
+
+from .digits import DigitReader
+from .layouts import LayoutCache
+from .match_parser import MatchParser, get_image_filepaths
+from .ocr import LazyReader
+
+MIN_AGREEMENT = 0.98
+# the check parses every sample twice at startup, only the most recent ones are used
+MAX_SAMPLES = 20
+
+
+def _parse(image_filepath, reader):
+    """Parse without writing output, printing or touching the shared caches.
+
+    Every parse gets its own layout cache and an empty digit atlas, so every
+    genre EXP number goes through the OCR being compared.
+
+    """
+    match_parser = MatchParser(image_filepath, reader=reader, layout_cache=LayoutCache(),
+                               digit_reader=DigitReader())
+    with contextlib.redirect_stdout(io.StringIO()):
+        match_parser.parse()
+    return match_parser
+
+
+def _agreement(matches, totals):
+    return matches / totals if totals else 1.0
+
+
+def compare_readers(image_filepaths, fp32_reader, int8_reader):
+    """Parse every image with both readers and report how often the outputs agree.
+
+    Returns
+    -------
+    dict
+        agreement (0-1) for 'placements' and 'genre_exps', the number of
+        images that failed to parse (each counts as one disagreement of
+        both), plus the total OCR seconds spent by each reader
+
+    """
+    placement_matches, placement_total = 0, 0
+    exp_matches, exp_total = 0, 0
+    errors = 0
+    seconds = {'fp32': 0.0, 'int8': 0.0}
+
+    for image_filepath in image_filepaths:
+        t0 = time.time()
+        try:
+            fp32 = _parse(image_filepath, fp32_reader)
+            t1 = time.time()
+            int8 = _parse(image_filepath, int8_reader)
+        except Exception:
+            print(f'Quantization check failed to parse {image_filepath}:\n{traceback.format_exc()}')
+            errors += 1
+            placement_total += 1
+            exp_total += 1
+            continue
+        t2 = time.time()
+        seconds['fp32'] += t1 - t0
+        seconds['int8'] += t2 - t1
+
+        for fp32_player, int8_player in zip(fp32.players, int8.players):
+            placement_total += 1
+            placement_matches += fp32_player.name == int8_player.name
+
+            for fp32_exp, int8_exp in zip(fp32_player.initial_genre_exps, int8_player.initial_genre_exps):
+                exp_total += 1
+                exp_matches += fp32_exp == int8_exp
+
+    return {'placements': _agreement(placement_matches, placement_total),
+            'genre_exps': _agreement(exp_matches, exp_total),
+            'errors': errors,
+            'seconds_fp32': seconds['fp32'],
+            'seconds_int8': seconds['int8'],
+            }
+
+
+def get_sample_filepaths(input_dir, max_samples=MAX_SAMPLES):
+    """Return the ``max_samples`` most recent screenshots in ``input_dir``, none if it does not exist."""
+    if not input_dir or not os.path.isdir(input_dir):
+        return []
+
+    image_filepaths = sorted(get_image_filepaths(input_dir), key=os.path.getmtime)
+    return image_filepaths[-max_samples:]
+
+
+def is_quantization_safe(image_filepaths, min_agreement=MIN_AGREEMENT):
+    """Return True if the int8 readers agree with the fp32 readers on the sample corpus."""
+    if not image_filepaths:
+        print('No sample images to check quantization against, keeping fp32')
+        return False
+
+    try:
+        report = compare_readers(image_filepaths,
+                                 LazyReader(quantize=False),
+                                 LazyReader(quantize=True))
+    except Exception:
+        print(f'Quantization check failed, keeping fp32:\n{traceback.format_exc()}')
+        return False
+    print(f'Quantization check on {len(image_filepaths)} images: {report}')
+
+    return min(report['placements'], report['genre_exps']) >= min_agreement
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare int8 vs fp32 OCR models on a sample corpus.')
+    parser.add_argument('input_dir', help='directory with sample screenshots')
+    parser.add_argument('--min-agreement', type=float, default=MIN_AGREEMENT)
+    args = parser.parse_args()
+
+    is_safe = is_quantization_safe(get_image_filepaths(args.input_dir), args.min_agreement)
+    print('int8 OK' if is_safe else f'int8 agreement below {args.min_agreement}, keep fp32')
@@ -0,0 +1,603 @@
+"""Compiled, memory-mapped index of the reference hashes.
+
+Instead of rebuilding the lookup tables from the dict literals in hashes.py
+in every process, the build command compiles them once into a binary file:
+
+ - the packed reference hashes (uint64 words) of every table partition:
+   per icon type, and for traits per hero / color / (hero, color)
+ - the label (info) and name id of every row
+ - the ambiguous pairs: references with different names that are closer
+   than the matching threshold of their icon type
+ - the difference hash of the references hashed from icon PNGs, for the
+   second stage of the matching cascade (see hashes.CASCADE_MARGIN)
+
+The parser memory-maps the file, so forked workers share the pages. The
+index can also be built from a directory of labelled icon PNGs, so the
+reference data can be edited without touching hashes.py:
+
+    icons/artifacts/<artifact name>/*.png
+    icons/heroes/<hero name>/*.png
+    icons/genres/<genre name>/*.png
+    icons/traits/<hero name>/<color>/<trait name>/*.png
+
+    python -m matchparse.reference_index [--icons icons/ [--icons-only]]
+
+An index built from the tables in hashes.py is ignored once those tables
+change (it stores their digest), until it is rebuilt.
+
+Every index carries a library version (``--library-version``, by default
+derived from its content). The parser looks its tables up through a
+``ReferenceLibrary``, and ``start_watcher`` polls the index file so a
+rebuilt index is picked up by the running bot: the new library is loaded
+next to the old one and swapped in with a single assignment, parses that
+already started keep the library (and version) they started with.
+
+"""
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+
+import cv2
+import numpy as np
+
+from . import hashes
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(__file__), 'data', 'reference_index.bin')
+
+MAGIC = b'ABREFIDX'
+VERSION = 1
+ALIGNMENT = 64
+
+DEFAULT_RELOAD_SECONDS = 60
+
+# magic, version, header length
+_PREFIX = struct.Struct('<8sII')
+
+ICON_DIRS = {'artifact': 'artifacts', 'hero': 'heroes', 'genre': 'genres', 'trait': 'traits'}
+
+
+def get_python_tables():
+    """The reference tables defined in hashes.py."""
+    return {'artifact': hashes.ARTIFACTS,
+            'hero': hashes.HEROES,
+            'trait': hashes.TRAITS,
+            'genre': hashes.GENRES,
+            }
+
+
+def get_tables_digest(tables):
+    serialized = json.dumps(tables, ensure_ascii=False).encode()
+    return hashlib.blake2b(serialized, digest_size=16).hexdigest()
+
+
+def get_partition_key(icon_type, hero=None, color=None):
+    return f'{icon_type}|{hero or ""}|{color or ""}'
+
+
+def iter_partition_keys(tables):
+    """Yield the (icon_type, hero, color) of every table the parser can ask for."""
+    yield 'artifact', None, None
+    yield 'hero', None, None
+    yield 'genre', None, None
+
+    traits = tables['trait']
+    colors = sorted(set(color for data in traits.values() for color in data))
+    yield 'trait', None, None
+    for color in colors:
+        yield 'trait', None, color
+    for hero in traits:
+        yield 'trait', hero, None
+        for color in traits[hero]:
+            yield 'trait', hero, color
+
+
+def get_partitions(tables):
+    """Yield (icon_type, hero, color, hash2info) for every table the parser can ask for."""
+    for icon_type, hero, color in iter_partition_keys(tables):
+        if icon_type == 'artifact':
+            hash2info = hashes.build_hash_to_artifact_info(tables['artifact'])
+        elif icon_type == 'hero':
+            hash2info = hashes.build_hash_to_hero_info(tables['hero'])
+        elif icon_type == 'genre':
+            hash2info = hashes.build_hash_to_genre_info(tables['genre'])
+        else:
+            hash2info = hashes.build_hash_to_trait_info(tables['trait'], hero, color)
+        yield icon_type, hero, color, hash2info
+
+
+def _info_to_row(icon_type, info):
+    if icon_type == 'trait':
+        return [icon_type, info.name, info.hero_name, info.color, info.reference_hash]
+    return [icon_type, info.name, None, None, info.reference_hash]
+
+
+def _row_to_info(row):
+    icon_type, name, hero_name, color, reference_hash = row
+    if icon_type == 'artifact':
+        return hashes.Artifact(name, reference_hash)
+    elif icon_type == 'hero':
+        return hashes.Hero(name, reference_hash)
+    elif icon_type == 'trait':
+        return hashes.Trait(name, hero_name, reference_hash, color)
+    elif icon_type == 'genre':
+        return hashes.Genre(name, reference_hash)
+    raise ValueError(f'Unknown icon type: {icon_type}')
+
+
+def find_ambiguous_pairs(table, hamming_threshold):
+    """(row a, row b, hamming) of references with different names closer than the threshold."""
+    words = np.asarray(table.words)
+    distances = hashes._popcount(words[:, None, :] ^ words[None, :, :]).sum(axis=2)
+    is_other_name = table.name_ids[:, None] != table.name_ids[None, :]
+    rows_a, rows_b = np.nonzero(np.triu(is_other_name & (distances < hamming_threshold), k=1))
+
+    return [(int(a), int(b), int(distances[a, b])) for a, b in zip(rows_a, rows_b)]
+
+
+def get_content_digest(header, arrays):
+    sha = hashlib.blake2b(digest_size=16)
+    sha.update(json.dumps([header['infos'], header['partitions']], ensure_ascii=False).encode())
+    for name in sorted(arrays):
+        sha.update(np.ascontiguousarray(arrays[name]).tobytes())
+    return sha.hexdigest()
+
+
+def compile_index(tables, source='tables', library_version=None, dhashes=None):
+    """Compile reference tables (in the nested dict layout of hashes.py) to a header + arrays.
+
+    ``library_version`` is stamped on every row parsed with the index, it
+    defaults to the source and a digest of the compiled references.
+    ``dhashes`` maps icon type -> reference hash -> difference hash, for
+    the references whose icon is available.
+
+    """
+    dhashes = dhashes or {}
+    infos, info_to_id = [], {}
+    names, name_to_id = [], {}
+    partitions = {}
+    words, info_ids, name_ids = [], [], []
+    dhash_words, has_dhash = [], []
+    ambiguous_pairs = []
+
+    for icon_type, hero, color, hash2info in get_partitions(tables):
+        table = hashes.ReferenceTable.from_hash2info(hash2info, dhashes.get(icon_type))
+        if table.has_dhash is not None:
+            dhash_words.append(table.dhash_words)
+            has_dhash.append(table.has_dhash)
+        else:
+            dhash_words.append(np.zeros_like(table.words))
+            has_dhash.append(np.zeros(len(table), dtype=bool))
+
+        start = len(info_ids)
+        for info in table.infos:
+            if info not in info_to_id:
+                info_to_id[info] = len(infos)
+                infos.append(_info_to_row(icon_type, info))
+            if info.name not in name_to_id:
+                name_to_id[info.name] = len(names)
+                names.append(info.name)
+            info_ids.append(info_to_id[info])
+            name_ids.append(name_to_id[info.name])
+        words.append(table.words)
+        partitions[get_partition_key(icon_type, hero, color)] = [start, len(info_ids)]
+
+        if hero is None and color is None:
+            hamming_threshold = hashes.ICON_TYPES[icon_type][1]
+            for a, b, hamming in find_ambiguous_pairs(table, hamming_threshold):
+                ambiguous_pairs.append((info_to_id[table.infos[a]], info_to_id[table.infos[b]], hamming))
+
+    header = {'version': VERSION,
+              'source': source,
+              'tables_digest': get_tables_digest(tables),
+              'hash_words': hashes.HASH_WORDS,
+              'infos': infos,
+              'names': names,
+              'partitions': partitions,
+              }
+    arrays = {'words': np.concatenate(words).astype(np.uint64),
+              'info_ids': np.array(info_ids, dtype=np.int32),
+              'name_ids': np.array(name_ids, dtype=np.int32),
+              'ambiguous_pairs': np.array(ambiguous_pairs, dtype=np.int32).reshape(-1, 3),
+              'dhash_words': np.concatenate(dhash_words).astype(np.uint64),
+              'has_dhash': np.concatenate(has_dhash),
+              }
+    header['library_version'] = library_version or f'{source}-{get_content_digest(header, arrays)[:10]}'
+    return header, arrays
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_index(filepath, header, arrays):
+    """Write the index: prefix, json header, then every array at an aligned offset."""
+    header = dict(header, arrays={})
+
+    # the array offsets depend on the header length, which depends on the offsets
+    while True:
+        header_bytes = json.dumps(header, ensure_ascii=False).encode()
+        offset = _align(_PREFIX.size + len(header_bytes))
+        layout = {}
+        for name, array in arrays.items():
+            layout[name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+            offset = _align(offset + array.nbytes)
+        if layout == header['arrays']:
+            break
+        header['arrays'] = layout
+
+    os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+    tmp_filepath = f'{filepath}.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(layout[name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(offset)
+    os.replace(tmp_filepath, filepath)
+
+
+class ReferenceIndex:
+    """A memory-mapped reference index file."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._mmap = np.memmap(filepath, dtype=np.uint8, mode='r')
+
+        magic, version, header_length = _PREFIX.unpack(self._mmap[:_PREFIX.size].tobytes())
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'Not a version {VERSION} reference index: {filepath}')
+
+        self.header = json.loads(self._mmap[_PREFIX.size:_PREFIX.size+header_length].tobytes().decode())
+        if self.header['hash_words'] != hashes.HASH_WORDS:
+            raise ValueError(f'Reference index {filepath} was built for a different hash size')
+
+        self.arrays = {}
+        for name, layout in self.header['arrays'].items():
+            dtype = np.dtype(layout['dtype'])
+            nbytes = dtype.itemsize * int(np.prod(layout['shape']))
+            data = self._mmap[layout['offset']:layout['offset']+nbytes]
+            self.arrays[name] = data.view(dtype).reshape(layout['shape'])
+
+        self.infos = [_row_to_info(row) for row in self.header['infos']]
+        # indexes built before the cascade have no dHashes
+        self.has_dhashes = 'has_dhash' in self.arrays and bool(self.arrays['has_dhash'].any())
+        self._empty = hashes.ReferenceTable(np.zeros((0, hashes.HASH_WORDS), dtype=np.uint64), [],
+                                            np.zeros(0, dtype=np.int32))
+
+    @property
+    def source(self):
+        return self.header['source']
+
+    @property
+    def library_version(self):
+        # indexes built before the versioning only have the digest of the tables
+        return self.header.get('library_version') or f'{self.source}-{self.header["tables_digest"][:10]}'
+
+    def is_stale(self):
+        """True for an index built from the hashes.py tables that have changed since."""
+        return self.source == 'tables' and self.header['tables_digest'] != get_tables_digest(get_python_tables())
+
+    def get_table(self, icon_type, hero=None, color=None):
+        """ReferenceTable viewing the partition's rows (empty for e.g. an unknown hero)."""
+        if icon_type not in hashes.ICON_TYPES:
+            raise ValueError('Unknown icon type')
+
+        partition = self.header['partitions'].get(get_partition_key(icon_type, hero, color))
+        if partition is None:
+            return self._empty
+
+        start, stop = partition
+        infos = [self.infos[i] for i in self.arrays['info_ids'][start:stop]]
+        dhash_words, has_dhash = None, None
+        if self.has_dhashes and self.arrays['has_dhash'][start:stop].any():
+            dhash_words, has_dhash = self.arrays['dhash_words'][start:stop], self.arrays['has_dhash'][start:stop]
+
+        return hashes.ReferenceTable(self.arrays['words'][start:stop], infos, self.arrays['name_ids'][start:stop],
+                                     dhash_words, has_dhash)
+
+    def iter_partitions(self):
+        """Yield the (icon_type, hero, color) of every partition."""
+        for key in self.header['partitions']:
+            icon_type, hero, color = key.split('|')
+            yield icon_type, hero or None, color or None
+
+    def get_ambiguous_pairs(self):
+        """(info a, info b, hamming) of references that could be confused with each other."""
+        return [(self.infos[a], self.infos[b], int(hamming)) for a, b, hamming in self.arrays['ambiguous_pairs']]
+
+
+def load_index(filepath=DEFAULT_INDEX_PATH):
+    """Load the index file, or return None if it is missing or stale."""
+    if not os.path.exists(filepath):
+        return None
+
+    index = ReferenceIndex(filepath)
+    if index.is_stale():
+        logger.warning('Reference index %s is older than the tables in hashes.py, ignoring it. '
+                       'Rebuild it with: python -m matchparse.reference_index', filepath)
+        return None
+
+    return index
+
+
+class ReferenceLibrary:
+    """One version of the reference tables, from an index or from the tables in hashes.py.
+
+    A library is never modified after it is loaded (apart from filling its
+    table cache), a reload builds a new one. Parses hold on to the library
+    they started with, so reading needs no lock.
+
+    """
+
+    def __init__(self, index=None):
+        self.index = index
+        if index is not None:
+            self.version = index.library_version
+        else:
+            self.version = f'tables-{get_tables_digest(get_python_tables())[:10]}'
+        self._tables = {}
+
+    def __repr__(self):
+        source = self.index.filepath if self.index is not None else 'hashes.py'
+        return f'ReferenceLibrary(version={self.version!r}, source={source!r}, cascade={self.has_dhashes})'
+
+    @property
+    def has_dhashes(self):
+        """Whether any reference has a dHash, without one the matching cascade is off (see hashes.CASCADE_MARGIN)."""
+        return self.index is not None and self.index.has_dhashes
+
+    def get_table(self, icon_type, hero=None, color=None):
+        """ReferenceTable of an icon type, for traits optionally restricted to a hero / color."""
+        key = (icon_type, hero, color)
+        table = self._tables.get(key)
+        if table is None:
+            if self.index is not None:
+                table = self.index.get_table(icon_type, hero, color)
+            else:
+                table = hashes.ReferenceTable.from_hash2info(hashes.get_hash2info(icon_type, hero, color))
+            self._tables[key] = table
+
+        return table
+
+    def iter_partitions(self):
+        if self.index is not None:
+            return self.index.iter_partitions()
+        return iter_partition_keys(get_python_tables())
+
+    def preload(self):
+        """Build every table up front (e.g. before forking workers, so they share them)."""
+        for icon_type, hero, color in self.iter_partitions():
+            self.get_table(icon_type, hero, color)
+        return self
+
+
+_INDEX_PATH = DEFAULT_INDEX_PATH
+_LIBRARY = None
+_LIBRARY_LOCK = threading.Lock()
+_WATCHER = None
+
+
+def set_index_path(filepath):
+    """Use the index at ``filepath`` (e.g. on a volume) instead of the one built into the image."""
+    global _INDEX_PATH, _LIBRARY
+    with _LIBRARY_LOCK:
+        _INDEX_PATH = filepath
+        _LIBRARY = None
+
+
+def get_index_path():
+    return _INDEX_PATH
+
+
+def load_library(filepath=None):
+    """Load the library of the index file, the tables in hashes.py when there is no usable index."""
+    return ReferenceLibrary(load_index(filepath or _INDEX_PATH))
+
+
+def get_reference_library():
+    """Return the active reference library, loading it on first use."""
+    library = _LIBRARY
+    if library is None:
+        with _LIBRARY_LOCK:
+            if _LIBRARY is None:
+                _set_library(load_library())
+            library = _LIBRARY
+
+    return library
+
+
+def get_reference_index():
+    """Return the index of the active library (None when there is no usable index file)."""
+    return get_reference_library().index
+
+
+def _set_library(library):
+    global _LIBRARY
+    _LIBRARY = library
+
+
+def reload_library(filepath=None):
+    """Load the index again and swap the new library in.
+
+    The new library is fully built before the swap, if loading fails the
+    active library stays in place. Returns the new library or None.
+
+    """
+    old_library = _LIBRARY
+    try:
+        library = load_library(filepath).preload()
+    except Exception:
+        logger.exception('Could not load the reference index %s, keeping %s', filepath or _INDEX_PATH, old_library)
+        return None
+
+    _set_library(library)
+    print(f'Reference library reloaded: {old_library.version if old_library else None} -> {library.version}')
+    return library
+
+
+def _get_file_stat(filepath):
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class ReferenceWatcher:
+    """Daemon thread that reloads the reference library when the index file changes.
+
+    Rebuilding the index replaces the file (write to a temp file, then
+    rename), so the watcher never sees a half written index and the old
+    library keeps reading the old file until no parse uses it anymore.
+
+    """
+
+    def __init__(self, filepath=None, interval=DEFAULT_RELOAD_SECONDS):
+        self.filepath = filepath or _INDEX_PATH
+        self.interval = interval
+        self._stat = _get_file_stat(self.filepath)
+        self._stop = None
+        self._thread = None
+
+    def check(self):
+        """Reload if the file changed since the last check, returns True if a new library was loaded."""
+        stat = _get_file_stat(self.filepath)
+        if stat == self._stat:
+            return False
+
+        self._stat = stat
+        return reload_library(self.filepath) is not None
+
+    def _run(self, stop):
+        while not stop.wait(self.interval):
+            self.check()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return self
+
+        # threads do not survive a fork, start() again in the child
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop,), name='reference-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+        self._thread = None
+
+
+def start_watcher(interval=DEFAULT_RELOAD_SECONDS):
+    """Watch the index file and hot swap the reference library when it is rebuilt."""
+    global _WATCHER
+    get_reference_library()
+    if _WATCHER is None:
+        _WATCHER = ReferenceWatcher(_INDEX_PATH, interval)
+    return _WATCHER.start()
+
+
+def restart_watcher():
+    """Start the watcher in a forked worker if the parent process was watching."""
+    if _WATCHER is not None:
+        _WATCHER.start()
+
+
+def load_icon_tables(icon_dir):
+    """Hash a directory of labelled icon PNGs into the nested dict layout of hashes.py.
+
+    Returns the tables and icon type -> average hash -> difference hash of
+    the icons.
+
+    """
+    tables = {icon_type: {} for icon_type in ICON_DIRS}
+    dhashes = {icon_type: {} for icon_type in ICON_DIRS}
+    num_icons = 0
+    for icon_type, sub_dir in ICON_DIRS.items():
+        hashes_func = hashes.ICON_TYPES[icon_type][0]
+        dhashes_func = hashes.CASCADE_TYPES[icon_type][0]
+        # traits are nested by hero and color
+        depth = 3 if icon_type == 'trait' else 1
+        pattern = os.path.join(icon_dir, sub_dir, *['*'] * depth, '*.png')
+        for filepath in sorted(glob.glob(pattern)):
+            image = cv2.imread(filepath)
+            if image is None:
+                continue
+
+            height, width = image.shape[:2]
+            icon_hash = str(hashes_func(image, [(0, 0, width, height)])[0])
+            # icons with the same average hash keep the first difference hash
+            dhashes[icon_type].setdefault(icon_hash, str(dhashes_func(image, [(0, 0, width, height)])[0]))
+            labels = os.path.relpath(os.path.dirname(filepath), os.path.join(icon_dir, sub_dir)).split(os.sep)
+
+            node = tables[icon_type]
+            for label in labels[:-1]:
+                node = node.setdefault(label, {})
+            node.setdefault(labels[-1], []).append(icon_hash)
+            num_icons += 1
+
+    print(f'Hashed {num_icons} icons from {icon_dir}')
+    return tables, dhashes
+
+
+def merge_tables(tables, other):
+    """Add the hashes of ``other`` to ``tables`` (same nested layout), returning a new dict."""
+    if not isinstance(other, dict):
+        return list(tables) + [h for h in other if h not in tables]
+
+    merged = dict(tables)
+    for key, value in other.items():
+        merged[key] = merge_tables(merged[key], value) if key in merged else value
+    return merged
+
+
+def build_index(filepath=DEFAULT_INDEX_PATH, icon_dir=None, is_icons_only=False, library_version=None):
+    dhashes = None
+    if icon_dir and is_icons_only:
+        (tables, dhashes), source = load_icon_tables(icon_dir), 'icons'
+    elif icon_dir:
+        icon_tables, dhashes = load_icon_tables(icon_dir)
+        tables, source = merge_tables(get_python_tables(), icon_tables), 'tables+icons'
+    else:
+        tables, source = get_python_tables(), 'tables'
+
+    header, arrays = compile_index(tables, source, library_version, dhashes)
+    write_index(filepath, header, arrays)
+
+    print(f'Saved reference index ({source}, version {header["library_version"]}) to: {filepath}')
+    print(f'{len(header["infos"])} references, {len(header["partitions"])} partitions, '
+          f'{os.path.getsize(filepath) / 1024:.1f}KB')
+    num_dhashes = int(arrays['has_dhash'].sum())
+    print(f'{num_dhashes} of {len(arrays["has_dhash"])} rows have a dHash for the matching cascade')
+    if num_dhashes == 0:
+        print('The matching cascade is off with this index, the dHashes come from icon PNGs (--icons)')
+
+    index = ReferenceIndex(filepath)
+    pairs = index.get_ambiguous_pairs()
+    print(f'{len(pairs)} ambiguous reference pairs')
+    for info_a, info_b, hamming in sorted(pairs, key=lambda p: p[2])[:20]:
+        print(f'  {hamming}: {info_a} <-> {info_b}')
+
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile the reference hashes into a memory-mapped index.')
+    parser.add_argument('-o', '--output', default=DEFAULT_INDEX_PATH)
+    parser.add_argument('--icons', metavar='DIR', help='directory of labelled icon PNGs to add to the tables')
+    parser.add_argument('--icons-only', action='store_true', help='only use the icons, not the tables in hashes.py')
+    parser.add_argument('--library-version', help='version stamped on the parsed rows (default: content digest)')
+    args = parser.parse_args()
+
+    if args.icons_only and not args.icons:
+        parser.error('--icons-only needs --icons')
+
+    build_index(args.output, args.icons, args.icons_only, args.library_version)
@@ -0,0 +1,71 @@
+"""Resolution normalization.
+
+Screenshots come in at very different resolutions. They are rescaled to a
+canonical working height before parsing, so the detector pixel constants
+(e.g. artifacts.MIN_WIDTH, traits.MIN_RADIUS) and the OCR cost are the same
+for a 4K phone capture and a 1080p one.
+
+The pixel constants are defined at CANONICAL_HEIGHT. Detectors go through
+``scale_px`` so they still behave when given an image that was not
+normalized.
+
+"""
+import cv2
+
+CANONICAL_HEIGHT = 1080
+
+# don't bother resizing when the image is already within 5% of the canonical height
+SCALE_TOLERANCE = 0.05
+
+# EasyOCR resizes the detector input to at most canvas_size (default 2560),
+# a normalized half screenshot always fits in this
+DETECTOR_CANVAS_SIZE = 1280
+DETECTOR_MAG_RATIO = 1.0
+
+
+def get_scale(image, canonical_height=CANONICAL_HEIGHT):
+    """Return the factor that takes the image to the canonical height."""
+    height = image.shape[0]
+    scale = canonical_height / height
+    if abs(scale - 1) <= SCALE_TOLERANCE:
+        return 1.0
+
+    return scale
+
+
+def normalize_image(image, canonical_height=CANONICAL_HEIGHT):
+    """Rescale the image to the canonical working height.
+
+    Returns
+    -------
+    tuple
+        (normalized image, scale), where working = original * scale
+
+    """
+    scale = get_scale(image, canonical_height)
+    if scale == 1.0:
+        return image, scale
+
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+    normalized = cv2.resize(image, None, fx=scale, fy=scale, interpolation=interpolation)
+    return normalized, scale
+
+
+def scale_px(value, image, canonical_height=CANONICAL_HEIGHT):
+    """Scale a pixel constant defined at the canonical height to the image."""
+    return value * image.shape[0] / canonical_height
+
+
+def to_original_bbox(bbox, scale):
+    """Map an (x, y, w, h) bbox of the normalized image back to the original image."""
+    if bbox is None:
+        return None
+
+    x, y, w, h = bbox
+    return (int(round(x / scale)), int(round(y / scale)),
+            int(round(w / scale)), int(round(h / scale)))
+
+
+def get_detector_kwargs():
+    """EasyOCR detector settings matching the canonical working resolution."""
+    return {'canvas_size': DETECTOR_CANVAS_SIZE, 'mag_ratio': DETECTOR_MAG_RATIO}
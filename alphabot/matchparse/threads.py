@@ -0,0 +1,175 @@
+"""Split the CPU between concurrent parses.
+
+Torch's intra-op pool and OpenCV's internal pool both default to one thread
+per core. With more than one parse running at a time (OCR_POOL_SIZE > 1 or
+forked parser workers) every parse then asks for every core and throughput
+collapses. ``ThreadBudget`` divides a total number of threads between the
+concurrent parses and applies it to torch and OpenCV, optionally pinning
+each worker process to its own cores.
+
+Benchmark mode sweeps (workers, threads per worker) and prints images/sec:
+
+    python -m matchparse.threads input/ --workers 1 2 4 --threads-per-worker 1 2 4
+
+Without ``--threads-per-worker`` every worker count gets an even split of
+the cores.
+
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+
+import cv2
+
+logger = logging.getLogger(__name__)
+
+
+def get_num_cores():
+    """Number of cores this process may run on (respects container cpusets)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def set_num_threads(num_threads):
+    """Set the torch intra-op and OpenCV thread pool sizes for this process."""
+    try:
+        import torch
+        torch.set_num_threads(num_threads)
+    except ImportError:
+        pass
+
+    cv2.setNumThreads(num_threads)
+
+
+class ThreadBudget:
+    """``total_threads`` (default: every core) shared by ``num_parsers`` concurrent parses."""
+
+    def __init__(self, total_threads=None, num_parsers=1, pin=False):
+        self.total_threads = total_threads or get_num_cores()
+        self.num_parsers = max(1, num_parsers)
+        self.pin = pin
+
+    def __repr__(self):
+        return (f'ThreadBudget(total_threads={self.total_threads}, num_parsers={self.num_parsers}, '
+                f'threads_per_parser={self.threads_per_parser}, pin={self.pin})')
+
+    @property
+    def threads_per_parser(self):
+        return max(1, self.total_threads // self.num_parsers)
+
+    def get_cores(self, worker_index):
+        """Cores a worker is pinned to, a contiguous slice of the allowed cores."""
+        cores = sorted(os.sched_getaffinity(0))
+        start = (worker_index * self.threads_per_parser) % len(cores)
+        return sorted({cores[(start + i) % len(cores)] for i in range(self.threads_per_parser)})
+
+    def apply(self, worker_index=None):
+        """Apply the budget to the current process.
+
+        Parses running as threads of one process share the torch/OpenCV
+        pools, so ``threads_per_parser`` is set process wide. Forked workers
+        pass their ``worker_index`` so they can be pinned to their own cores.
+
+        """
+        set_num_threads(self.threads_per_parser)
+
+        if self.pin and worker_index is not None and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.get_cores(worker_index))
+
+        logger.info('Applied %s (worker %s)', self, worker_index)
+
+
+_BUDGET = None
+_BUDGET_LOCK = threading.Lock()
+_IS_APPLIED = False
+
+
+def set_thread_budget(budget, worker_index=None):
+    """Make ``budget`` the process-wide thread budget and apply it."""
+    global _BUDGET, _IS_APPLIED
+    with _BUDGET_LOCK:
+        _BUDGET = budget
+        _BUDGET.apply(worker_index)
+        _IS_APPLIED = True
+
+    return budget
+
+
+def configure(total_threads=None, num_parsers=1, pin=False):
+    """Set the process-wide thread budget from the config values and apply it."""
+    return set_thread_budget(ThreadBudget(total_threads, num_parsers, pin))
+
+
+def get_thread_budget():
+    """Return the process-wide thread budget (every core for a single parse unless configured)."""
+    global _BUDGET
+    with _BUDGET_LOCK:
+        if _BUDGET is None:
+            _BUDGET = ThreadBudget()
+
+    return _BUDGET
+
+
+def ensure_applied():
+    """Apply the process-wide budget once, e.g. when a parse starts without explicit configuration."""
+    global _IS_APPLIED
+    budget = get_thread_budget()
+    with _BUDGET_LOCK:
+        if not _IS_APPLIED:
+            budget.apply()
+            _IS_APPLIED = True
+
+    return budget
+
+
+def benchmark(image_filepaths, worker_counts, thread_counts=None, total_threads=None, pin=False):
+    """Parse the images with every (worker count, threads per worker) and print images/sec for each.
+
+    ``thread_counts`` are the threads per worker to try, by default
+    ``total_threads`` (every core) split evenly between the workers.
+    Returns a list of (num workers, threads per worker, images/sec).
+
+    """
+    from .workers import ParserWorkerPool
+
+    total_threads = total_threads or get_num_cores()
+    results = []
+    for num_workers in worker_counts:
+        for threads_per_worker in thread_counts or [max(1, total_threads // num_workers)]:
+            budget = ThreadBudget(threads_per_worker * num_workers, num_workers, pin)
+            with ParserWorkerPool(num_workers, output_dir='output/benchmark', thread_budget=budget) as worker_pool:
+                # first image per worker pays for the lazy imports, keep it out of the timing
+                worker_pool.parse_many(image_filepaths[:num_workers])
+
+                t0 = time.time()
+                worker_pool.parse_many(image_filepaths)
+                seconds = time.time() - t0
+
+            images_per_sec = len(image_filepaths) / seconds if seconds else 0.0
+            results.append((num_workers, budget.threads_per_parser, images_per_sec))
+            print(f'{num_workers} workers x {budget.threads_per_parser} threads: {images_per_sec:.2f} images/sec')
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep parser worker/thread configurations.')
+    parser.add_argument('input_dir', help='directory with screenshots')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads-per-worker', type=int, nargs='+', default=None,
+                        help='threads per worker to try (default: the total split evenly between the workers)')
+    parser.add_argument('--threads', type=int, default=None, help='total thread budget (default: every core)')
+    parser.add_argument('--pin', action='store_true', help='pin every worker to its own cores')
+    args = parser.parse_args()
+
+    from .match_parser import get_image_filepaths
+
+    os.makedirs('output/benchmark', exist_ok=True)
+    results = benchmark(get_image_filepaths(args.input_dir), args.workers, args.threads_per_worker, args.threads,
+                        args.pin)
+    best = max(results, key=lambda r: r[2])
+    print(f'Best: {best[0]} workers x {best[1]} threads ({best[2]:.2f} images/sec)')
@@ -5,6 +5,9 @@ import numpy as np
 
 from collections import defaultdict
 
+from .image_context import get_image_context
+from .resolution import scale_px
+
 # in RGB, don't put 255, use 254 instead
 TRAIT_COLORS = {
     'blue': (55, 83, 254),  # blue
@@ -14,12 +17,20 @@ TRAIT_COLORS = {
 }
 
 
-# TOOD: this should scale with some reference object
+# pixel sizes at resolution.CANONICAL_HEIGHT
 MIN_RADIUS = 10
 MAX_RADIUS = 40
+POSITION_TOLERANCE = 15
 
 CIRCULARITY_THRESHOLD = 0.7
 
+# HSV range of the gray circles of the missing traits
+MISSING_LOWER = np.array([0, 0, 90])
+MISSING_UPPER = np.array([50, 50, 175])
+
+GRID_COLS = 6
+GRID_ROWS = 8
+
 # TODO: might want to consildate this code into base.py or something
 def get_center(x, y, w, h):
     return int(x + w/2), int(y+h/2)
@@ -65,34 +76,73 @@ def closest_color(image, colors=TRAIT_COLORS):
     return closest_color_name
 
 
-def get_trait_and_missing_bboxes(image):
+def get_trait_and_missing_bboxes(image, context=None):
     """Use the missing trait bounding boxes to build the trait bounding boxes."""
-    missing_bboxes = get_trait_missing_bboxes(image)
-    grid_cols = 6
-    grid_rows = 8
+    missing_bboxes = get_trait_missing_bboxes(image, context)
+    trait_bboxes = [bbox for bbox, is_missing in get_trait_grid(missing_bboxes, image) if not is_missing]
+    return trait_bboxes, missing_bboxes
+
 
+def get_trait_grid(missing_bboxes, image):
+    """Return the (bbox, is missing) of every cell of the trait grid, row by row.
+
+    The grid is positioned from the missing trait bounding boxes.
+
+    """
     horizontal_spacing, vertical_spacing = calculate_spacing(missing_bboxes)
     trait_width = math.ceil(np.median([b[2] for b in missing_bboxes]))
     trait_height = math.ceil(np.median([b[3] for b in missing_bboxes]))
 
     max_x = int(max([box[0] for box in missing_bboxes]))
     max_y = int(max([box[1] for box in missing_bboxes]))
-    min_x = int(max_x - 5*horizontal_spacing)
-    min_y = int(max_y - 7*vertical_spacing)
+    min_x = int(max_x - (GRID_COLS-1)*horizontal_spacing)
+    min_y = int(max_y - (GRID_ROWS-1)*vertical_spacing)
 
-    trait_bboxes = []
-    for row in range(grid_rows):
-        for col in range(grid_cols):
+    tolerance = scale_px(POSITION_TOLERANCE, image)
+
+    cells = []
+    for row in range(GRID_ROWS):
+        for col in range(GRID_COLS):
             x = int(min_x + col * horizontal_spacing)
             y = int(min_y + row * vertical_spacing)
 
             is_detected = any(
-                abs(x - box[0]) < 15 and abs(y - box[1]) < 15  # Tolerance for position
+                abs(x - box[0]) < tolerance and abs(y - box[1]) < tolerance  # Tolerance for position
                 for box in missing_bboxes
             )
 
-            if not is_detected:
-                trait_bboxes.append((x, y, trait_width, trait_height))
+            cells.append(((x, y, trait_width, trait_height), is_detected))
+
+    return cells
+
+
+def get_missing_fill(image, bbox, context=None):
+    """Share of the bbox in the gray range of the missing trait circles."""
+    x, y, w, h = bbox
+    if context is None:
+        hsv = cv2.cvtColor(image[y:y+h, x:x+w], cv2.COLOR_BGR2HSV)
+    else:
+        hsv = context.hsv[y:y+h, x:x+w]
+
+    if hsv.size == 0:
+        return 0.0
+    return mask_percent(cv2.inRange(hsv, MISSING_LOWER, MISSING_UPPER))
+
+
+def split_trait_cells(image, cells, min_missing_fill, context=None):
+    """Split known trait grid cells into (trait bboxes, missing bboxes) by their gray fill.
+
+    Used instead of ``get_trait_and_missing_bboxes`` when the grid is
+    already known (see layouts.py), no contours are needed.
+
+    """
+    trait_bboxes = []
+    missing_bboxes = []
+    for bbox in cells:
+        if get_missing_fill(image, bbox, context) >= min_missing_fill:
+            missing_bboxes.append(bbox)
+        else:
+            trait_bboxes.append(bbox)
 
     return trait_bboxes, missing_bboxes
 
@@ -106,31 +156,30 @@ def highlight_and_save_contours(image, contours, filename):
     cv2.imwrite(filename, image_copy)
 
 
-def get_trait_missing_bboxes(image):
+def get_trait_missing_bboxes(image, context=None):
     """Find the bounding boxes for (?) missing traits."""
     # HACK TO GET RID OF THE BIG BOX AROUND THE MATCH.
     # NOTE: FIX THIS JANK HACK
     # this just chops off the right side of the image
     _, width = image.shape[:2]
     x_min = width//4
-    left_side = image[:, :width-width//4]
-
-    hsv_image = cv2.cvtColor(left_side, cv2.COLOR_BGR2HSV)
+    context = get_image_context(image, context)
+    hsv_image = context.hsv[:, :width-width//4]
     # cv2.imwrite('testtraits_hcsv.png', hsv_image)
 
-    lower_gray = np.array([0, 0, 90])   # Lower bound for gray
-    upper_gray = np.array([50, 50, 175])  # Upper bound for gray
-
-    mask = cv2.inRange(hsv_image, lower_gray, upper_gray)
+    mask = cv2.inRange(hsv_image, MISSING_LOWER, MISSING_UPPER)
     # cv2.imwrite('testtraits.png', mask)
     contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
+    min_radius = scale_px(MIN_RADIUS, image)
+    max_radius = scale_px(MAX_RADIUS, image)
+
     bboxes = []
     minsize_contours = []
     for contour in contours:
         _, radius = cv2.minEnclosingCircle(contour)
 
-        if MIN_RADIUS <= radius <= MAX_RADIUS:
+        if min_radius <= radius <= max_radius:
             minsize_contours.append(contour)
             area = cv2.contourArea(contour)
             perimeter = cv2.arcLength(contour, True)
@@ -162,7 +211,8 @@ def mask_percent(mask):
     return white_pixels / total_pixels
 
 
-def apply_mask(image, rgb_color, tolerance=20):
+def get_color_bounds(rgb_color, tolerance=20):
+    """BGR lower/upper bounds of the colors within ``tolerance`` of ``rgb_color``."""
     r, g, b = rgb_color
 
     lower = np.array([max(0, b - tolerance),
@@ -172,7 +222,12 @@ def apply_mask(image, rgb_color, tolerance=20):
     upper = np.array([min(255, b + tolerance),
                       min(255, g + tolerance),
                       min(255, r + tolerance)])
-    
+
+    return lower, upper
+
+
+def apply_mask(image, rgb_color, tolerance=20):
+    lower, upper = get_color_bounds(rgb_color, tolerance)
     mask = cv2.inRange(image.copy(), lower, upper)
     return mask
 
@@ -198,12 +253,73 @@ def determine_primary_bbox_color(image, bbox=None):
     return primary_color, perc_color
 
 
+class TraitColorMap:
+    """Trait color of many bboxes from one labeling pass over their region.
+
+    ``determine_primary_bbox_color`` masks every bbox once per trait color.
+    Here the region covering all the bboxes is labeled once, every pixel
+    gets a bit per TRAIT_COLORS entry it is within ``tolerance`` of (the
+    yellow and lime green ranges overlap, so a pixel can match two). The
+    color fractions of a bbox are then a bincount of its labels, the
+    results are the same as ``determine_primary_bbox_color``.
+
+    """
+
+    def __init__(self, image, bboxes=None, colors=TRAIT_COLORS, tolerance=20):
+        height, width = image.shape[:2]
+        if bboxes:
+            x0 = max(0, min(b[0] for b in bboxes))
+            y0 = max(0, min(b[1] for b in bboxes))
+            x1 = min(width, max(b[0] + b[2] for b in bboxes))
+            y1 = min(height, max(b[1] + b[3] for b in bboxes))
+        else:
+            x0, y0, x1, y1 = 0, 0, width, height
+
+        self.origin = (x0, y0)
+        self.shape = (height, width)
+        self.color_names = list(colors)
+
+        region = image[y0:y1, x0:x1]
+        self.labels = np.zeros(region.shape[:2], dtype=np.uint8)
+        for bit, rgb_color in enumerate(colors.values()):
+            lower, upper = get_color_bounds(rgb_color, tolerance)
+            mask = cv2.inRange(region, lower, upper)
+            cv2.bitwise_or(self.labels, cv2.bitwise_and(mask, 1 << bit), dst=self.labels)
+
+        # which colors every label value (combination of bits) counts towards
+        num_labels = 1 << len(self.color_names)
+        self._label_colors = np.array([[(label >> bit) & 1 for bit in range(len(self.color_names))]
+                                       for label in range(num_labels)])
+
+    def get_color_percents(self, bbox):
+        """Return {color name: fraction of the bbox's pixels within range of the color}."""
+        x, y, w, h = bbox
+        height, width = self.shape
+        # clip like slicing the image would
+        x1, y1 = min(width, x + w), min(height, y + h)
+        x0, y0 = self.origin
+        labels = self.labels[max(0, y - y0):max(0, y1 - y0), max(0, x - x0):max(0, x1 - x0)]
+
+        if labels.size == 0:
+            return dict.fromkeys(self.color_names, 0.0)
+
+        counts = np.bincount(labels.ravel(), minlength=len(self._label_colors)) @ self._label_colors
+        return dict(zip(self.color_names, counts / labels.size))
+
+    def determine_primary_color(self, bbox):
+        """Same as ``determine_primary_bbox_color(image, bbox)``."""
+        color2percent = self.get_color_percents(bbox)
+        primary_color = max(color2percent, key=lambda k:color2percent[k])
+        return primary_color, color2percent[primary_color]
+
+
 def split_trait_bboxes_by_color(image, trait_bboxes):
+    color_map = TraitColorMap(image, trait_bboxes)
     color2bboxes = defaultdict(list)
     for bbox in trait_bboxes:
         # TODO: might want to ignore bboxes where the primary color
         # isn't a certain percentage
-        color, _ = determine_primary_bbox_color(image, bbox)
+        color, _ = color_map.determine_primary_color(bbox)
 
         color2bboxes[color].append(bbox)
 
@@ -0,0 +1,229 @@
+"""Pre-forked pool of MatchParser workers.
+
+Spawning a process per core would load the EasyOCR/torch weights and the
+hash reference tables once per process. Instead the parent process loads
+everything once and then forks the workers, which share those pages
+copy-on-write:
+
+ - the OCR readers (English + Traditional Chinese) and the digit atlas are
+   loaded and warmed up in the parent
+ - the OCR cache entries and digit glyphs a worker learns go back to the
+   parent with its results, only the parent saves them
+ - the hash reference tables are built in the parent
+ - ``gc.freeze()`` moves all of it out of the collector's reach, otherwise
+   the first collection in a worker touches every object header and dirties
+   (copies) the shared pages
+
+Only works where the 'fork' start method exists (Linux).
+
+    python -m matchparse.workers input/ -n 4
+
+"""
+import argparse
+import gc
+import multiprocessing
+import os
+import time
+
+from . import digits, hashes, ocr, reference_index, threads
+
+DEFAULT_NUM_WORKERS = 2
+
+_SMAPS_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty')
+
+# set in the workers by _init_worker
+_WORKER_BACKEND = None
+_WORKER_CACHE = None
+
+
+def get_memory_usage(pid=None):
+    """Return the unique (private) and shared memory of a process in MB.
+
+    Reads /proc/<pid>/smaps_rollup, pages inherited from the parent and not
+    written to since the fork count as shared.
+
+    """
+    pid = pid or os.getpid()
+    kbs = dict.fromkeys(_SMAPS_FIELDS, 0)
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                name = parts[0].rstrip(':')
+                if name in kbs:
+                    kbs[name] += int(parts[1])
+    except OSError:
+        return None
+
+    return {'pid': pid,
+            'rss_mb': kbs['Rss'] / 1024,
+            'pss_mb': kbs['Pss'] / 1024,
+            'unique_mb': (kbs['Private_Clean'] + kbs['Private_Dirty']) / 1024,
+            'shared_mb': (kbs['Shared_Clean'] + kbs['Shared_Dirty']) / 1024,
+            }
+
+
+def preload(quantize=True):
+    """Load everything the workers need in the current (parent) process."""
+    reader_pool = ocr.get_reader_pool(1, quantize=quantize)
+    reader_pool.preload()
+    with reader_pool.acquire() as reader:
+        reader.chinese  # loaded lazily otherwise, i.e. once per worker
+
+    hashes.preload_reference_tables()
+    digits.get_digit_reader()
+
+
+def _init_worker(thread_budget, worker_counter, ocr_cache, cache_key):
+    global _WORKER_BACKEND, _WORKER_CACHE
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+    # the parent's torch/OpenMP pools do not survive the fork, size them for this worker
+    threads.set_thread_budget(thread_budget, worker_index)
+    # the watcher thread does not survive the fork either, every worker swaps in new libraries itself
+    reference_index.restart_watcher()
+
+    backend = ocr.get_shared_reader()
+    if ocr_cache is not None:
+        from .ocr_cache import CachingBackend
+        backend = CachingBackend(backend, ocr_cache, cache_key)
+        # the parent's unsaved entries were copied too, they are saved by the parent
+        ocr_cache.take_unsaved()
+    # same for the parent's learned glyphs
+    digits.get_digit_reader().take_learned()
+    _WORKER_BACKEND = backend
+    _WORKER_CACHE = ocr_cache
+
+
+def _parse(image_filepath, output_dir, is_save_icons):
+    from .match_parser import MatchParser
+
+    match_parser = MatchParser(image_filepath, reader=_WORKER_BACKEND)
+    match_parser.run(output_dir=output_dir, is_save_icons=is_save_icons)
+
+    # new OCR cache entries and digit glyphs go back to the parent, which persists them
+    cache_entries = _WORKER_CACHE.take_unsaved() if _WORKER_CACHE is not None else []
+    learned_glyphs = digits.get_digit_reader().take_learned()
+    return match_parser.to_df(), get_memory_usage(), cache_entries, learned_glyphs
+
+
+class ParserWorkerPool:
+    """Fork ``num_workers`` parser processes that share the preloaded models.
+
+    ``parse`` returns the parsed DataFrame (MatchParser objects hold the
+    images and are not sent back). ``ocr_cache`` is copied into every worker
+    at fork time, each worker then keeps its own. The entries a worker adds
+    are sent back with every result and merged into ``ocr_cache``, so the
+    parent can save them (OCRCache.save). The digit glyphs a worker learns
+    are merged into the parent's digit reader the same way.
+
+    """
+
+    def __init__(self, num_workers=DEFAULT_NUM_WORKERS, quantize=True, output_dir='output/', is_save_icons=False,
+                 thread_budget=None, ocr_cache=None, cache_key='exact'):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise RuntimeError('The parser worker pool needs the "fork" start method (Linux)')
+
+        self.num_workers = num_workers
+        self.quantize = quantize
+        self.output_dir = output_dir
+        self.is_save_icons = is_save_icons
+        # by default the cores are split evenly between the workers
+        self.thread_budget = thread_budget or threads.ThreadBudget(num_parsers=num_workers)
+        self.ocr_cache = ocr_cache
+        self.cache_key = cache_key
+
+        self.worker_memory = {}
+        self._pool = None
+
+    def start(self):
+        if self._pool is not None:
+            return self
+
+        t0 = time.time()
+        preload(self.quantize)
+        print(self.thread_budget)
+        print(f'Preloaded models in {time.time()-t0:.2f}s, parent memory: {get_memory_usage()}')
+
+        gc.collect()
+        gc.freeze()
+
+        context = multiprocessing.get_context('fork')
+        worker_counter = context.Value('i', 0)
+        self._pool = context.Pool(self.num_workers,
+                                  initializer=_init_worker,
+                                  initargs=(self.thread_budget, worker_counter, self.ocr_cache, self.cache_key))
+        return self
+
+    def close(self):
+        if self._pool is None:
+            return
+
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+        gc.unfreeze()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _collect(self, result):
+        df, memory, cache_entries, learned_glyphs = result
+        if memory is not None:
+            self.worker_memory[memory['pid']] = memory
+        if self.ocr_cache is not None:
+            self.ocr_cache.merge(cache_entries)
+        digits.get_digit_reader().merge(learned_glyphs)
+        return df
+
+    def parse(self, image_filepath):
+        """Parse one image in a worker (blocking) and return its DataFrame."""
+        self.start()
+        result = self._pool.apply(_parse, (str(image_filepath), self.output_dir, self.is_save_icons))
+        return self._collect(result)
+
+    def parse_many(self, image_filepaths):
+        """Parse the images across all workers, returning the DataFrames in order."""
+        self.start()
+        args = [(str(fp), self.output_dir, self.is_save_icons) for fp in image_filepaths]
+        return [self._collect(result) for result in self._pool.starmap(_parse, args)]
+
+    def memory_report(self):
+        """Per worker unique vs shared memory, as of the last image each worker parsed."""
+        workers = sorted(self.worker_memory.values(), key=lambda m: m['pid'])
+        return {'parent': get_memory_usage(),
+                'workers': workers,
+                'total_unique_mb': sum(m['unique_mb'] for m in workers),
+                }
+
+
+def print_memory_report(report):
+    parent = report['parent']
+    if parent:
+        print(f'parent {parent["pid"]}: rss {parent["rss_mb"]:.0f}MB, unique {parent["unique_mb"]:.0f}MB')
+    for memory in report['workers']:
+        print(f'worker {memory["pid"]}: rss {memory["rss_mb"]:.0f}MB, pss {memory["pss_mb"]:.0f}MB, '
+              f'unique {memory["unique_mb"]:.0f}MB, shared {memory["shared_mb"]:.0f}MB')
+    print(f'workers unique total: {report["total_unique_mb"]:.0f}MB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parse screenshots with a pool of forked workers.')
+    parser.add_argument('input_dir', help='directory with screenshots')
+    parser.add_argument('-n', '--num-workers', type=int, default=DEFAULT_NUM_WORKERS)
+    parser.add_argument('-o', '--output-dir', default='output/')
+    args = parser.parse_args()
+
+    from .match_parser import get_image_filepaths
+
+    image_filepaths = get_image_filepaths(args.input_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
+    with ParserWorkerPool(args.num_workers, output_dir=args.output_dir) as worker_pool:
+        t0 = time.time()
+        worker_pool.parse_many(image_filepaths)
+        print(f'Parsed {len(image_filepaths)} images in {time.time()-t0:.2f}s with {args.num_workers} workers')
+        print_memory_report(worker_pool.memory_report())
@@ -1,12 +1,15 @@
+import asyncio
 import datetime
 import os
 import aiohttp
 import discord
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from discord.ext import commands, tasks
 
+from matchparse import digits, layouts, ocr, ocr_cache, quantize, reference_index, threads, workers
 from matchparse.match_parser import MatchParser
 from utils.sheets_manager import GoogleSheetsManager
 
@@ -76,7 +79,31 @@ ALLOWED_CHANNEL_IDS = _env_list_int('ALLOWED_CHANNEL_IDS', [1351265799561809920]
 SAVE_ICONS = _env_bool('SAVE_ICONS', False)
 INITIAL_RECENT_HOURS = _env_int('INITIAL_RECENT_HOURS', 240)
 RECURRING_RECENT_HOURS = _env_int('RECURRING_RECENT_HOURS', 1)
-print('ENVS', ALLOWED_CHANNEL_IDS, SAVE_ICONS, INITIAL_RECENT_HOURS, RECURRING_RECENT_HOURS) # TODO log this instead
+OCR_POOL_SIZE = _env_int('OCR_POOL_SIZE', ocr.DEFAULT_POOL_SIZE)
+OCR_QUANTIZE = _env_bool('OCR_QUANTIZE', True)
+OCR_QUANTIZE_SAMPLE_DIR = os.getenv('OCR_QUANTIZE_SAMPLE_DIR') or DOWNLOADS_DIR
+OCR_CACHE_MB = _env_int('OCR_CACHE_MB', 64)
+OCR_CACHE_KEY = os.getenv('OCR_CACHE_KEY', 'exact')
+OCR_CACHE_PATH = os.getenv('OCR_CACHE_PATH')
+PARSER_WORKERS = _env_int('PARSER_WORKERS', 0)
+CPU_THREADS = _env_int('CPU_THREADS', 0) or None  # default: every core
+CPU_AFFINITY = _env_bool('CPU_AFFINITY', False)
+REFERENCE_INDEX_PATH = os.getenv('REFERENCE_INDEX_PATH') or reference_index.DEFAULT_INDEX_PATH
+REFERENCE_RELOAD_SECONDS = _env_int('REFERENCE_RELOAD_SECONDS', reference_index.DEFAULT_RELOAD_SECONDS)
+LAYOUT_CACHE_SIZE = _env_int('LAYOUT_CACHE_SIZE', layouts.DEFAULT_MAX_LAYOUTS)
+DIGIT_ATLAS_PATH = os.getenv('DIGIT_ATLAS_PATH') or 'output/digit_atlas.npz'
+print('ENVS', ALLOWED_CHANNEL_IDS, SAVE_ICONS, INITIAL_RECENT_HOURS, RECURRING_RECENT_HOURS, OCR_POOL_SIZE, OCR_QUANTIZE, OCR_CACHE_MB, OCR_CACHE_KEY, PARSER_WORKERS, CPU_THREADS, CPU_AFFINITY, REFERENCE_INDEX_PATH, REFERENCE_RELOAD_SECONDS, LAYOUT_CACHE_SIZE, DIGIT_ATLAS_PATH) # TODO log this instead
+
+# shared across parses, 0 MB disables it
+OCR_CACHE = ocr_cache.OCRCache(OCR_CACHE_MB * 1024 * 1024, OCR_CACHE_PATH) if OCR_CACHE_MB > 0 else None
+
+# forked parser processes sharing the preloaded models, created in main() when PARSER_WORKERS > 0
+WORKER_POOL = None
+
+# without workers, up to OCR_POOL_SIZE parses run in these threads (one per OCR reader),
+# keeping the event loop (and the Discord heartbeat) free
+PARSE_CONCURRENCY = max(1, OCR_POOL_SIZE)
+PARSE_EXECUTOR = ThreadPoolExecutor(max_workers=PARSE_CONCURRENCY, thread_name_prefix='parser')
 
 
 # Define image signatures for validation
@@ -241,8 +268,7 @@ async def process_image_attachment(attachment, parent_message, nth_attachment):
         fn_prefix = f'{fn_prefix}_{nth_attachment}'
 
     filepath = await download_image(attachment, fn_prefix)
-    parser = await process_image(filepath)
-    df = parser.to_df()
+    df = await process_image(filepath)
     await upload_df(df, parent_message, filepath.name)
 
     await add_reaction(parent_message, DONE_EMOJI)
@@ -274,10 +300,34 @@ def get_message_metadata(message):
 
 
 async def process_image(filepath, upload=True):
-    parser = MatchParser(filepath)
-    parser.run(output_dir='output/', is_save_icons=SAVE_ICONS)
-
-    return parser
+    loop = asyncio.get_running_loop()
+    if WORKER_POOL is not None:
+        # parse in a forked worker without blocking the event loop, its new OCR cache entries come back with it
+        df = await loop.run_in_executor(None, WORKER_POOL.parse, filepath)
+        workers.print_memory_report(WORKER_POOL.memory_report())
+    else:
+        df = await loop.run_in_executor(PARSE_EXECUTOR, parse_image, filepath)
+
+    if OCR_CACHE is not None:
+        print(f'OCR cache: {OCR_CACHE.stats()}')
+        OCR_CACHE.save()
+    # the workers' glyphs were merged by WORKER_POOL, only this process writes the atlas
+    if digits.get_digit_reader().save_if_changed():
+        print(f'Saved the learned digit atlas to: {DIGIT_ATLAS_PATH}')
+
+    return df
+
+
+def parse_image(filepath):
+    """Parse an image in the bot process, holding one reader of the pool for the whole parse."""
+    reader_pool = ocr.get_reader_pool(OCR_POOL_SIZE)
+    with reader_pool.acquire() as reader:
+        if OCR_CACHE is not None:
+            reader = ocr_cache.CachingBackend(reader, OCR_CACHE, OCR_CACHE_KEY)
+        parser = MatchParser(filepath, reader=reader)
+        parser.run(output_dir='output/', is_save_icons=SAVE_ICONS)
+
+    return parser.to_df()
 
 async def upload_df(df, message, filename):
     timestamp, author, channel, server = get_message_metadata(message)
@@ -299,10 +349,48 @@ async def upload_df(df, message, filename):
 
 def main():
     """Start the bot."""
+    global WORKER_POOL
     os.makedirs(DOWNLOADS_DIR, exist_ok=True)
     token = _get_discord_token()
     if not token:
         raise RuntimeError('Discord token not provided. Mount docker secret "discord_token" to /run/secrets/discord_token')
+
+    # fail now rather than on the first parse
+    ocr_cache.validate_key_type(OCR_CACHE_KEY)
+
+    # int8 is checked against fp32 on the most recent screenshots, when there are any yet
+    is_quantize = OCR_QUANTIZE
+    sample_filepaths = quantize.get_sample_filepaths(OCR_QUANTIZE_SAMPLE_DIR) if is_quantize else []
+    if sample_filepaths:
+        is_quantize = quantize.is_quantization_safe(sample_filepaths)
+    elif is_quantize:
+        print(f'No sample screenshots in {OCR_QUANTIZE_SAMPLE_DIR}, int8 quantization is not checked')
+    print(f'OCR models: {"int8" if is_quantize else "fp32"}')
+
+    # rebuilding the reference index at REFERENCE_INDEX_PATH swaps in the new library without a restart
+    reference_index.set_index_path(REFERENCE_INDEX_PATH)
+    if REFERENCE_RELOAD_SECONDS > 0:
+        reference_index.start_watcher(REFERENCE_RELOAD_SECONDS)
+    print(f'Reference library: {reference_index.get_reference_library()}')
+
+    # before forking the workers, every worker then fills its own copy
+    layouts.configure(LAYOUT_CACHE_SIZE)
+    # the glyphs learned from the OCR fallback are saved back to DIGIT_ATLAS_PATH
+    digit_reader = digits.configure(DIGIT_ATLAS_PATH)
+    print(f'Digit atlas: {sum(len(t) for t in digit_reader.atlas.values())} glyph templates, '
+          f'digits {sorted(digit_reader.atlas)}, complete: {digit_reader.is_complete}')
+
+    # load and warm up the OCR models before any images come in
+    # the CPU_THREADS budget is split between the parses that can run at the same time
+    if PARSER_WORKERS > 0:
+        thread_budget = threads.ThreadBudget(CPU_THREADS, PARSER_WORKERS, pin=CPU_AFFINITY)
+        WORKER_POOL = workers.ParserWorkerPool(PARSER_WORKERS, quantize=is_quantize, output_dir='output/',
+                                               is_save_icons=SAVE_ICONS, thread_budget=thread_budget,
+                                               ocr_cache=OCR_CACHE, cache_key=OCR_CACHE_KEY).start()
+    else:
+        # the cores are only split when parses really run at the same time in PARSE_EXECUTOR
+        print(threads.configure(CPU_THREADS, num_parsers=PARSE_CONCURRENCY))
+        ocr.get_reader_pool(OCR_POOL_SIZE, quantize=is_quantize).preload()
     bot.run(token)
 
 
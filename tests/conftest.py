@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the bot runs from alphabot/ and imports matchparse as a top level package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'alphabot'))
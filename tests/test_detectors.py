@@ -0,0 +1,44 @@
+import cv2
+
+import numpy as np
+
+from matchparse import artifacts, heroes
+from matchparse.image_context import ImageContext
+
+
+def draw_scoreboard(frame=False):
+    """Synthetic 1920x1080 scoreboard: 8 hero squares left, 8x3 artifact squares right."""
+    image = np.full((1080, 1920, 3), 30, dtype=np.uint8)
+    for row in range(8):
+        y = 100 + row * 115
+        cv2.rectangle(image, (100, y), (179, y + 79), (200, 200, 200), 3)
+        for col in range(3):
+            x = 1500 + col * 70
+            cv2.rectangle(image, (x, y), (x + 49, y + 49), (200, 200, 200), 3)
+
+    if frame:
+        # the bright box around the match
+        cv2.rectangle(image, (20, 20), (1899, 1059), (220, 220, 220), 4)
+    return image
+
+
+def detect(image):
+    context = ImageContext(image)
+    artifact_bboxes = artifacts.get_artifact_bboxes(image, context=context)
+    hero_bboxes = heroes.get_hero_bboxes(image, context=context)
+    return sorted(artifact_bboxes), sorted(hero_bboxes)
+
+
+def test_detects_icons():
+    artifact_bboxes, hero_bboxes = detect(draw_scoreboard())
+    assert len(artifact_bboxes) == artifacts.EXPECTED_NUM_ARTIFACTS
+    assert len(hero_bboxes) == heroes.EXPECTED_HEROES
+
+
+def test_enclosing_frame_does_not_hide_icons():
+    assert detect(draw_scoreboard(frame=True)) == detect(draw_scoreboard())
+
+
+def test_context_matches_standalone_detection():
+    image = draw_scoreboard(frame=True)
+    assert detect(image) == (sorted(artifacts.get_artifact_bboxes(image)), sorted(heroes.get_hero_bboxes(image)))
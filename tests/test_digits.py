@@ -0,0 +1,128 @@
+import cv2
+
+import numpy as np
+
+from matchparse import digits, genres
+
+
+def draw_number(text, scale=0.8, thickness=2):
+    """Gray crop with a bright number on a dark background, like the EXP corner of a genre icon."""
+    crop = np.full((28, 20 * len(text) + 12), 40, dtype=np.uint8)
+    cv2.putText(crop, text, (6, 22), cv2.FONT_HERSHEY_SIMPLEX, scale, 230, thickness)
+    return crop
+
+
+def make_atlas(digit_chars='0123456789'):
+    return {int(char): np.stack(digits.segment_digits(draw_number(char))) for char in digit_chars}
+
+
+class FakeBackend:
+    """Reads every crop as the next of ``texts``."""
+
+    def __init__(self, texts):
+        self.texts = list(texts)
+        self.num_crops = 0
+
+    def recognize_crops(self, crops, allowlist=None):
+        self.num_crops += len(crops)
+        return [self.texts.pop(0) for _ in crops]
+
+
+def test_segments_glyphs_left_to_right():
+    glyphs = digits.segment_digits(draw_number('407'))
+    assert len(glyphs) == 3
+
+    atlas = make_atlas()
+    labels = [max(atlas, key=lambda d: float(atlas[d][0] @ glyph)) for glyph in glyphs]
+    assert labels == [4, 0, 7]
+
+
+def test_segments_nothing_in_an_empty_crop():
+    assert digits.segment_digits(np.full((28, 40), 40, dtype=np.uint8)) == []
+
+
+def test_reads_numbers_with_a_complete_atlas():
+    digit_reader = digits.DigitReader(make_atlas())
+    for number in (0, 7, 12, 58, 99):
+        exp, conf = digit_reader.read(draw_number(str(number)))
+        assert exp == number
+        assert conf >= digits.MATCH_THRESHOLD
+    assert digit_reader.hit_rates()['template'] == 1.0
+
+
+def test_incomplete_atlas_falls_back():
+    # a "7" matches something best even when there is no "7" template
+    digit_reader = digits.DigitReader(make_atlas('012345689'))
+    number, _ = digit_reader.match(draw_number('7'))
+    assert number is not None
+
+    assert not digit_reader.is_complete
+    assert digit_reader.read(draw_number('7')) is None
+    assert digit_reader.hit_rates()['fallback'] == 1.0
+
+
+def test_unreadable_crop_falls_back():
+    digit_reader = digits.DigitReader(make_atlas())
+    assert digit_reader.read(np.full((28, 40), 40, dtype=np.uint8)) is None
+
+
+def test_learn_rejects_glyphs_that_disagree_with_the_atlas():
+    digit_reader = digits.DigitReader(make_atlas('0123456'))
+    # a "1" misread as "7" looks like the "1" templates
+    assert not digit_reader.learn(draw_number('1'), '7')
+    # a "3" misread as "1" does not look like the "1" templates
+    assert not digit_reader.learn(draw_number('3'), '1')
+    assert digit_reader.counts['rejected'] == 2
+    assert 7 not in digit_reader.atlas
+    assert not digit_reader.is_changed
+
+    assert digit_reader.learn(draw_number('78'), '78')
+    assert digit_reader.learn(draw_number('9'), '9')
+    assert digit_reader.is_complete
+    # the same glyph again adds nothing
+    assert not digit_reader.learn(draw_number('9'), '9')
+
+
+def test_learned_glyphs_merge_into_another_reader(tmp_path):
+    worker_reader = digits.DigitReader(make_atlas('012345678'))
+    assert worker_reader.learn(draw_number('9'), '9')
+    learned = worker_reader.take_learned()
+    assert [digit for digit, _ in learned] == [9]
+    assert worker_reader.take_learned() == []
+
+    path = str(tmp_path / 'digit_atlas.npz')
+    parent_reader = digits.DigitReader(make_atlas('012345678'), path=path)
+    assert parent_reader.merge(learned)
+    assert parent_reader.save_if_changed()
+    assert not parent_reader.save_if_changed()
+
+    loaded = digits.DigitReader.from_file(path, fallback_path=None)
+    assert loaded.is_complete
+    assert loaded.read(draw_number('9'))[0] == 9
+
+
+def test_from_file_falls_back_to_the_curated_atlas(tmp_path):
+    curated_path = str(tmp_path / 'curated.npz')
+    digits.DigitReader(make_atlas(), path=curated_path).save()
+
+    path = str(tmp_path / 'learned.npz')
+    digit_reader = digits.DigitReader.from_file(path, fallback_path=curated_path)
+    assert digit_reader.is_complete
+    assert digit_reader.path == path
+
+
+def test_read_genre_exps_uses_ocr_for_the_misses():
+    icons = [np.full((40, 40, 3), 40, dtype=np.uint8) for _ in range(3)]
+    for icon, text in zip(icons, ('5', '27', '8')):
+        cv2.putText(icon, text, (21, 16), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (230, 230, 230), 1)
+    image = np.concatenate(icons, axis=1)
+    bboxes = [(40 * i, 0, 40, 40) for i in range(3)]
+
+    # nothing is trusted before the atlas has all of 0-9
+    digit_reader = digits.DigitReader()
+    backend = FakeBackend([('5', 0.99), ('27', 0.95), ('8', 0.5)])
+    exps = genres.read_genre_exps(image, bboxes, backend, digit_reader)
+    assert exps == [(5, 0.99), (27, 0.95), (8, 0.5)]
+    assert backend.num_crops == 3
+    # the unconfident "8" is not learned
+    assert sorted(digit_reader.atlas) == [2, 5, 7]
@@ -0,0 +1,136 @@
+import cv2
+
+import numpy as np
+
+from matchparse import digits, genres, ocr
+from matchparse.image_context import ImageContext
+
+YELLOW = (40, 220, 250)
+
+
+def draw_genre_icons(seed, rows=6, cols=10, size=48, gap=12):
+    """Icons with yellow blobs anywhere in them, many crossing the top of the bottom region."""
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 90, ((size + gap) * rows + gap, (size + gap) * cols + gap, 3), dtype=np.uint8)
+    bottom_start = size - int(size * genres.STAR_BOTTOM_REGION_RATIO)
+
+    bboxes = []
+    for row in range(rows):
+        for col in range(cols):
+            x, y = gap + col * (size + gap), gap + row * (size + gap)
+            bboxes.append((x, y, size, size))
+            for _ in range(rng.integers(0, 5)):
+                w, h = rng.integers(2, 10, 2)
+                sx = x + rng.integers(0, size - w)
+                sy = y + bottom_start + rng.integers(-4, 4) if rng.random() < 0.5 else y + rng.integers(0, size - h)
+                cv2.rectangle(image, (int(sx), int(sy)), (int(sx + w), int(sy + h)), YELLOW, -1)
+            # some speckle noise for the opening
+            for _ in range(rng.integers(0, 6)):
+                px, py = x + rng.integers(0, size), y + rng.integers(0, size)
+                image[py, px] = YELLOW
+    return image, bboxes
+
+
+def contour_rects(contours):
+    return sorted(cv2.boundingRect(c) for c in contours)
+
+
+def test_batched_levels_match_per_icon():
+    for seed in range(10):
+        image, bboxes = draw_genre_icons(seed)
+        for context in (None, ImageContext(image)):
+            batched = genres.get_genre_levels(image, bboxes, context)
+            for bbox, (level, contours) in zip(bboxes, batched):
+                expected_level, expected_contours = genres.get_genre_level(image, bbox, context)
+                assert level == expected_level, (seed, bbox)
+                assert contour_rects(contours) == contour_rects(expected_contours), (seed, bbox)
+
+
+def test_batched_levels_of_bboxes_past_the_image_edge():
+    image, bboxes = draw_genre_icons(0, rows=1, cols=3)
+    height, width = image.shape[:2]
+    bboxes = [(2, 2, 40, 40), (width - 30, height - 40, 40, 45)]
+    for bbox, (level, contours) in zip(bboxes, genres.get_genre_levels(image, bboxes)):
+        expected_level, expected_contours = genres.get_genre_level(image, bbox)
+        assert level == expected_level
+        assert contour_rects(contours) == contour_rects(expected_contours)
+
+
+EXP_FONT = cv2.FONT_HERSHEY_SIMPLEX, 0.5  # (font, scale) of the synthetic EXP numbers
+
+
+class FakeDigitOCR(ocr.OCRBackend):
+    """Detects the ink with a 3px margin and recognizes digits by template, for comparing the read paths.
+
+    The confidence drops with the share of background in the crop, like a
+    recognizer given more than the text box.
+
+    """
+
+    def __init__(self):
+        atlas = {}
+        for digit in range(10):
+            crop = np.full((24, 20), 40, dtype=np.uint8)
+            cv2.putText(crop, str(digit), (4, 17), *EXP_FONT, 235, 1)
+            atlas[digit] = np.stack(digits.segment_digits(cv2.GaussianBlur(crop, (3, 3), 0)))
+        self.digit_reader = digits.DigitReader(atlas)
+        self.crop_shapes = []
+
+    def _recognize(self, crop):
+        self.crop_shapes.append(crop.shape)
+        number, score = self.digit_reader.match(crop)
+        if number is None:
+            return '', 0.0
+        ink = (crop > cv2.threshold(crop, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[0]).mean()
+        return str(number), round(float(score) * min(1.0, 3 * ink), 2)
+
+    def readtext(self, image, languages=None, **kwargs):
+        ys, xs = np.nonzero(image > cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[0])
+        if not len(xs):
+            return []
+        height, width = image.shape[:2]
+        x0, y0 = max(0, xs.min() - 3), max(0, ys.min() - 3)
+        x1, y1 = min(width, xs.max() + 4), min(height, ys.max() + 4)
+        text, conf = self._recognize(image[y0:y1, x0:x1])
+        return [([[x0, y0], [x1, y0], [x1, y1], [x0, y1]], text, conf)]
+
+    def recognize_crops(self, crops, allowlist=None, batch_size=ocr.DEFAULT_BATCH_SIZE, languages=None):
+        return [self._recognize(crop) for crop in crops]
+
+
+def draw_genre_exp_icons(numbers, size=64):
+    rng = np.random.default_rng(0)
+    icons = []
+    for number in numbers:
+        icon = rng.integers(20, 60, (size, size, 3), dtype=np.uint8)
+        x = size // 2 + 3
+        for char in str(number):
+            cv2.putText(icon, char, (x, size // 4 + 6), *EXP_FONT, (235, 235, 235), 1)
+            # spaced out so the blur does not merge the glyphs
+            x += cv2.getTextSize(char, *EXP_FONT, 1)[0][0] + 3
+        icons.append(icon)
+    return np.concatenate(icons, axis=1), [(size * i, 0, size, size) for i in range(len(numbers))]
+
+
+def test_batched_exps_match_per_icon_reads_on_recorded_crops(tmp_path):
+    image, bboxes = draw_genre_exp_icons([3, 12, 40, 7, 99, 58])
+    image_filepath = str(tmp_path / 'screenshot.png')
+
+    # record the per-icon (detect + recognize) and the batched (recognize only) reads
+    backend = FakeDigitOCR()
+    recording = ocr.RecordingBackend(backend, str(tmp_path / 'ocr')).for_image(image_filepath)
+    expected = [genres.read_genre_exp(image, bbox, recording) for bbox in bboxes]
+    detected_shapes = list(backend.crop_shapes)
+    backend.crop_shapes.clear()
+    genres.read_genre_exps(image, bboxes, recording, digits.DigitReader())
+    # the recognizer sees the text boxes readtext found, not the whole top right quarter
+    for detected_shape, shape in zip(detected_shapes, backend.crop_shapes):
+        assert np.abs(np.subtract(detected_shape, shape)).max() <= 2
+
+    # the recordings replay without the backend
+    replay = ocr.ReplayBackend(str(tmp_path / 'ocr')).for_image(image_filepath)
+    assert [genres.read_genre_exp(image, bbox, replay) for bbox in bboxes] == expected
+    genre_exps = genres.read_genre_exps(image, bboxes, replay, digits.DigitReader())
+    assert [exp for exp, _ in genre_exps] == [exp for exp, _ in expected] == [3, 12, 40, 7, 99, 58]
+    for (_, conf), (_, expected_conf) in zip(genre_exps, expected):
+        assert abs(conf - expected_conf) <= 0.1
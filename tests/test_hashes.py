@@ -0,0 +1,195 @@
+import numpy as np
+import pytest
+
+from matchparse import hashes
+
+
+class FixedLibrary:
+    """Stands in for a reference_index.ReferenceLibrary with a single table."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def get_table(self, icon_type, hero=None, color=None):
+        return self.table
+
+
+def draw_icons(num_icons, size=40, seed=0):
+    """Random blocky icons side by side, with their bboxes."""
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, 256, (num_icons, 5, 5, 3), dtype=np.uint8)
+    icons = [np.kron(block, np.ones((size // 5, size // 5, 1), dtype=np.uint8)) for block in blocks]
+    return np.concatenate(icons, axis=1), [(size * i, 0, size, size) for i in range(num_icons)]
+
+
+def flip_bits(image_hash, num_bits, rng):
+    bits = image_hash.hash.copy().ravel()
+    bits[rng.choice(len(bits), num_bits, replace=False)] ^= True
+    return hashes.imagehash.ImageHash(bits.reshape(image_hash.hash.shape))
+
+
+def make_table(icon_hashes, seed=0):
+    """References near the icons: some close, some near the threshold, some tied between two names."""
+    rng = np.random.default_rng(seed)
+    hash2info = {}
+    for i, icon_hash in enumerate(icon_hashes):
+        for j, num_bits in enumerate(rng.integers(0, hashes.HAMMING_ARTIFACT_THRESHOLD + 4, 3)):
+            reference = str(flip_bits(icon_hash, int(num_bits), rng))
+            name = f'artifact_{i}' if j < 2 or i % 3 else f'artifact_{i}_twin'
+            hash2info[reference] = hashes.Artifact(name, reference)
+    return hashes.ReferenceTable.from_hash2info(hash2info)
+
+
+@pytest.mark.parametrize('method', ['bktree', 'mih'])
+def test_index_search_matches_linear_without_a_full_scan(method, monkeypatch):
+    image, bboxes = draw_icons(30)
+    table = make_table(hashes.get_icon_hashes(image, bboxes))
+    library = FixedLibrary(table)
+
+    stats0 = hashes.get_cascade_stats()
+    expected = hashes.guess_icon_hashes(image, bboxes, 'artifact', library=library)
+    stats1 = hashes.get_cascade_stats()
+
+    def full_scan(*args):
+        raise AssertionError('full table scan')
+
+    monkeypatch.setitem(hashes.SEARCH_METHODS, 'artifact', method)
+    monkeypatch.setattr(table, 'distances', full_scan)
+    monkeypatch.setattr(table, 'distance_matrix', full_scan)
+    assert hashes.guess_icon_hashes(image, bboxes, 'artifact', library=library) == expected
+
+    # the cascade sees the same candidates
+    stats2 = hashes.get_cascade_stats()
+    for key in ('ambiguous', 'cascaded'):
+        assert stats2[key] - stats1[key] == stats1[key] - stats0[key]
+    assert stats1['ambiguous'] > stats0['ambiguous']
+    assert any(hashes.is_unknown(info) for info, _, _ in expected)
+    assert any(hashes.is_known(info) for info, _, _ in expected)
+
+
+def test_find_within_methods_agree():
+    image, bboxes = draw_icons(30, seed=1)
+    icon_hashes = hashes.get_icon_hashes(image, bboxes)
+    table = make_table(icon_hashes, seed=1)
+    for icon_hash in icon_hashes:
+        rows, distances = table.find_within(icon_hash, hashes.HAMMING_ARTIFACT_THRESHOLD)
+        for method in ('bktree', 'mih'):
+            method_rows, method_distances = table.find_within(icon_hash, hashes.HAMMING_ARTIFACT_THRESHOLD, method)
+            assert sorted(zip(method_distances.tolist(), method_rows.tolist())) == \
+                sorted(zip(distances.tolist(), rows.tolist()))
+
+
+def draw_varied_icons(seed=0):
+    """Icons of assorted sizes and content: noise, gradients, flat areas, smaller and larger than the hash."""
+    rng = np.random.default_rng(seed)
+    icons = []
+    for i in range(60):
+        h, w = rng.integers(6, 140, 2)
+        kind = i % 3
+        if kind == 0:
+            icon = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        elif kind == 1:
+            ys, xs = np.mgrid[0:h, 0:w]
+            icon = np.dstack([(xs * 255 // max(1, w - 1)), (ys * 255 // max(1, h - 1)), (xs + ys) % 256])
+            icon = icon.astype(np.uint8)
+        else:
+            icon = np.full((h, w, 3), rng.integers(0, 256, 3), dtype=np.uint8)
+            icon[h // 3:, : w // 2] = rng.integers(0, 256, 3)
+        icons.append(icon)
+    return icons
+
+
+def place_icons(icons):
+    height = max(icon.shape[0] for icon in icons)
+    image = np.zeros((height, sum(icon.shape[1] for icon in icons), 3), dtype=np.uint8)
+    bboxes = []
+    x = 0
+    for icon in icons:
+        h, w = icon.shape[:2]
+        image[:h, x:x+w] = icon
+        bboxes.append((x, 0, w, h))
+        x += w
+    return image, bboxes
+
+
+def test_numpy_hashes_match_imagehash():
+    from PIL import Image
+
+    for seed in range(3):
+        icons = draw_varied_icons(seed)
+        image, bboxes = place_icons(icons)
+        ahashes = hashes.get_icon_hashes(image, bboxes)
+        dhashes = hashes.get_icon_dhashes(image, bboxes)
+        genre_hashes = hashes.get_genre_hashes(image, bboxes)
+        for icon, ahash, dhash, genre_hash in zip(icons, ahashes, dhashes, genre_hashes):
+            assert ahash == hashes.imagehash.average_hash(Image.fromarray(icon), hash_size=10)
+            assert dhash == hashes.imagehash.dhash(Image.fromarray(icon), hash_size=10)
+            middle = hashes.get_middle_section(icon)
+            assert genre_hash == hashes.imagehash.average_hash(Image.fromarray(middle), hash_size=10)
+
+
+def old_guess_icon_hash(icon_hash, hash2info, hamming_threshold, unknown_obj, is_genre=False):
+    """The per icon linear scan over the hash -> info dict, as the guess_*_hash functions used to do it."""
+    all_names = set(info.name for info in hash2info.values())
+    if not is_genre and len(all_names) == 1:
+        info = list(hash2info.values())[0]
+        return info, icon_hash, hashes.imagehash.hex_to_hash(info.reference_hash) - icon_hash
+
+    hammings = {}
+    for reference_hash, info in hash2info.items():
+        hamming = hashes.imagehash.hex_to_hash(reference_hash) - icon_hash
+        if hamming < hamming_threshold:
+            hammings.setdefault(hamming, []).append(info)
+
+    if not hammings:
+        return unknown_obj, icon_hash, 9999
+
+    lowest_hamming = min(hammings)
+    lowest_infos = hammings[lowest_hamming]
+    if len(set(info.name for info in lowest_infos)) > 1:
+        return unknown_obj, icon_hash, 9999
+    return lowest_infos[0], icon_hash, lowest_hamming
+
+
+def draw_hash_icon(hex_hash, num_flips, rng, is_genre=False):
+    """An icon whose average hash is (about) a reference hash with a few bits flipped."""
+    bits = hashes.imagehash.hex_to_hash(hex_hash).hash.copy()
+    flips = rng.choice(bits.size, num_flips, replace=False)
+    bits.ravel()[flips] ^= True
+    pattern = np.where(bits, 200, 40).astype(np.uint8)
+    if not is_genre:
+        return np.repeat(np.kron(pattern, np.ones((4, 4), dtype=np.uint8))[:, :, None], 3, axis=2)
+
+    # only the middle section is hashed
+    icon = np.full((200, 100, 3), 120, dtype=np.uint8)
+    icon[90:110, 20:80] = np.kron(pattern, np.ones((2, 6), dtype=np.uint8))[:, :, None]
+    return icon
+
+
+def test_batched_matches_equal_the_old_linear_scan():
+    from PIL import Image
+
+    from matchparse.reference_index import ReferenceLibrary, get_python_tables, iter_partition_keys
+
+    library = ReferenceLibrary()
+    rng = np.random.default_rng(0)
+    for icon_type, hero, color in iter_partition_keys(get_python_tables()):
+        if icon_type == 'trait' and (hero is None or color is None):
+            continue  # traits are matched per (hero, color)
+
+        hash2info = hashes.get_hash2info(icon_type, hero, color)
+        _, hamming_threshold, unknown_obj = hashes.ICON_TYPES[icon_type]
+        is_genre = icon_type == 'genre'
+        references = list(hash2info)
+        icons = [draw_hash_icon(references[rng.integers(len(references))], int(num_flips), rng, is_genre)
+                 for num_flips in rng.integers(0, hamming_threshold + 6, 12)]
+        image, bboxes = place_icons(icons)
+
+        heroes = [hero] * len(bboxes) if icon_type == 'trait' else None
+        colors = [color] * len(bboxes) if icon_type == 'trait' else None
+        results = hashes.guess_icon_hashes(image, bboxes, icon_type, heroes, colors, library=library)
+        for icon, result in zip(icons, results):
+            pil_icon = Image.fromarray(hashes.get_middle_section(icon) if is_genre else icon)
+            icon_hash = hashes.imagehash.average_hash(pil_icon, hash_size=10)
+            expected = old_guess_icon_hash(icon_hash, hash2info, hamming_threshold, unknown_obj, is_genre)
+            assert (result[0], str(result[1]), int(result[2])) == (expected[0], str(expected[1]), int(expected[2]))
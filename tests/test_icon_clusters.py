@@ -0,0 +1,75 @@
+import numpy as np
+
+from matchparse import hashes, icon_clusters
+
+
+def random_hex(rng):
+    return f'{int(rng.integers(0, 2 ** 62)) << 38 | int(rng.integers(0, 2 ** 38)):025x}'
+
+
+def make_noisy_copies(num_sources, copies_per_source, max_flips, rng):
+    """Packed hashes of noisy copies of random source hashes, with the source of every copy."""
+    source_bits = rng.random((num_sources, hashes.HASH_BITS)) < 0.5
+    sources = np.repeat(np.arange(num_sources), copies_per_source)
+    bits = source_bits[sources]
+    for i in range(len(bits)):
+        bits[i, rng.choice(hashes.HASH_BITS, rng.integers(0, max_flips + 1), replace=False)] ^= True
+    order = rng.permutation(len(bits))
+    return hashes.bits_to_words(bits[order]), sources[order]
+
+
+def test_parses_the_saved_icon_file_names(tmp_path):
+    rng = np.random.default_rng(0)
+    unknown, known, other, trait = (random_hex(rng) for _ in range(4))
+    (tmp_path / 'artifacts').mkdir()
+    for fn in (f'{unknown}_artifacts_40x40_u.png', f'{known}_artifacts_40x40.png',
+               f'{other}_heroes_40x40_u.png', 'notes.png', f'{unknown}_artifacts_40x40_u.jpg'):
+        (tmp_path / 'artifacts' / fn).write_bytes(b'')
+    (tmp_path / 'traits').mkdir()
+    for fn in (f'{trait}_red_alicia_30x30.png', f'{unknown}_traits_30x30_u.png', f'{known}_traits_30x30.png'):
+        (tmp_path / 'traits' / fn).write_bytes(b'')
+
+    filepaths, words, labels = icon_clusters.load_icons(str(tmp_path), 'artifact')
+    assert [icon_clusters._to_hex(w) for w in words] == [unknown]
+    assert labels == [(None, None)]
+
+    filepaths, words, labels = icon_clusters.load_icons(str(tmp_path), 'artifact', is_include_known=True)
+    assert sorted(icon_clusters._to_hex(w) for w in words) == sorted([unknown, known])
+
+    # the unknown trait file names carry the hero (lower case in the name) and the color
+    filepaths, words, labels = icon_clusters.load_icons(str(tmp_path), 'trait')
+    hex2label = {icon_clusters._to_hex(w): label for w, label in zip(words, labels)}
+    assert hex2label == {trait: ('Alicia', 'red'), unknown: (None, None)}
+
+    assert icon_clusters.load_icons(str(tmp_path), 'hero')[0] == []
+
+
+def test_clusters_are_the_noisy_copies_of_each_icon():
+    rng = np.random.default_rng(0)
+    words, sources = make_noisy_copies(20, 8, 4, rng)
+    # a few singletons, left out with the default min_size
+    singletons, _ = make_noisy_copies(3, 1, 0, rng)
+    words = np.concatenate([words, singletons])
+    filepaths = [f'icon_{i}.png' for i in range(len(words))]
+
+    clusters = icon_clusters.cluster_icons(filepaths, words, hashes.HAMMING_ARTIFACT_THRESHOLD, num_threads=2)
+    assert len(clusters) == 20
+    for cluster in clusters:
+        assert cluster['num_icons'] == 8
+        assert len({sources[i] for i in cluster['examples']}) == 1
+        assert cluster['representative'] in cluster['examples']
+        assert len(cluster['examples']) <= icon_clusters.MAX_ICONS_PER_CLUSTER
+
+
+def test_clustering_in_small_tiles_and_spanning_forests_agrees(monkeypatch):
+    words, sources = make_noisy_copies(30, 10, 6, np.random.default_rng(1))
+    expected = icon_clusters.cluster_hashes(words, hashes.HAMMING_ARTIFACT_THRESHOLD)
+
+    monkeypatch.setattr(icon_clusters, 'ROW_BLOCK', 16)
+    monkeypatch.setattr(icon_clusters, 'COL_BLOCK', 40)
+    monkeypatch.setattr(icon_clusters, 'MAX_EDGES', 50)
+    labels = icon_clusters.cluster_hashes(words, hashes.HAMMING_ARTIFACT_THRESHOLD, num_threads=1)
+
+    # the same partition, up to the numbering of the components
+    assert np.array_equal(labels[:, None] == labels[None, :], expected[:, None] == expected[None, :])
+    assert np.array_equal(labels[:, None] == labels[None, :], sources[:, None] == sources[None, :])
@@ -0,0 +1,178 @@
+import numpy as np
+
+from matchparse import layouts
+
+ARTIFACT_SIZE = 50
+HERO_SIZE = 80
+HEADER = (100, 40)
+
+
+def get_template_bboxes():
+    """Canonical 1080p geometry: 8x3 artifact squares right, 8 hero squares left."""
+    artifact_bboxes = [(1500 + col * 70, 100 + row * 115, ARTIFACT_SIZE, ARTIFACT_SIZE)
+                       for row in range(8) for col in range(3)]
+    hero_bboxes = [(100, 100 + row * 115, HERO_SIZE, HERO_SIZE) for row in range(8)]
+    return artifact_bboxes, hero_bboxes
+
+
+def make_header(x, y):
+    return [[x, y], [x + 120, y], [x + 120, y + 30], [x, y + 30]], 'PLAYER', 0.99
+
+
+def draw_frames(bboxes, shape=(1080, 1920), band=4):
+    """Dark image with a bright frame along the inside of every bbox."""
+    image = np.full(shape + (3,), 30, dtype=np.uint8)
+    for x, y, w, h in bboxes:
+        image[y:y+h, x:x+w] = 200
+        image[y+band:y+h-band, x+band:x+w-band] = 30
+    return image
+
+
+def make_template():
+    artifact_bboxes, hero_bboxes = get_template_bboxes()
+    image = draw_frames(artifact_bboxes + hero_bboxes)
+    fingerprint = layouts.get_fingerprint(image, make_header(*HEADER))
+    return layouts.Layout(fingerprint, artifact_bboxes, hero_bboxes)
+
+
+def move(bboxes, scale, offset):
+    return layouts.transform_bboxes(bboxes, scale, np.asarray(offset, dtype=float))
+
+
+def test_fit_scale_offset_recovers_the_model():
+    rng = np.random.default_rng(0)
+    template_points = rng.uniform(0, 1000, (20, 2))
+    scale, offset = layouts.fit_scale_offset(template_points, template_points * 0.8 + [35, -12])
+    assert np.isclose(scale, 0.8)
+    assert np.allclose(offset, [35, -12])
+
+    assert layouts.fit_scale_offset(np.ones((3, 2)), np.ones((3, 2))) is None
+
+
+def test_transfer_generates_the_missing_artifacts_and_heroes():
+    template = make_template()
+    scale, offset = 0.9, (60, 30)
+    artifact_bboxes = move(template.artifact_bboxes, scale, offset)
+    hero_bboxes = move(template.hero_bboxes, scale, offset)
+    image = draw_frames(artifact_bboxes + hero_bboxes)
+    header = make_header(*np.rint(np.array(HEADER) * scale + offset).astype(int))
+
+    # a few detections are missing, the rest are off by a pixel
+    rng = np.random.default_rng(1)
+    detected = [(x + int(rng.integers(-1, 2)), y + int(rng.integers(-1, 2)), w, h)
+                for i, (x, y, w, h) in enumerate(artifact_bboxes) if i % 7 != 3]
+
+    layout = layouts.transfer_layout(template, image, header, detected)
+    assert layout is not None
+    assert layout.fingerprint == layouts.get_fingerprint(image, header)
+    assert set(detected) <= set(layout.artifact_bboxes)
+    assert len(layout.artifact_bboxes) == len(artifact_bboxes)
+    for fitted, expected in zip(layout.artifact_bboxes + layout.hero_bboxes, artifact_bboxes + hero_bboxes):
+        assert np.abs(np.subtract(fitted, expected)).max() <= 2
+    transfer_scale, residual, num_anchors = layout.transfer
+    assert abs(transfer_scale - scale) < 0.01
+    assert num_anchors == len(detected)
+    assert not layout.has_traits
+
+
+def test_transfer_rejects_a_bad_fit():
+    template = make_template()
+    header = make_header(*HEADER)
+
+    # another arrangement of the artifacts: the columns a bit (residual) or far (no matches) further apart
+    for spacing in (80, 95):
+        artifact_bboxes = [(1570 - spacing + col * spacing, 100 + row * 115, ARTIFACT_SIZE, ARTIFACT_SIZE)
+                           for row in range(8) for col in range(3)]
+        image = draw_frames(artifact_bboxes + template.hero_bboxes)
+        assert layouts.transfer_layout(template, image, header, artifact_bboxes) is None
+
+    # too few anchors
+    image = draw_frames(template.artifact_bboxes + template.hero_bboxes)
+    assert layouts.transfer_layout(template, image, header, template.artifact_bboxes[:layouts.MIN_FIT_ANCHORS - 1]) is None
+
+    # the model fits the detections but the heroes are not where it puts them
+    image = draw_frames(template.artifact_bboxes)
+    assert layouts.transfer_layout(template, image, header, template.artifact_bboxes) is None
+
+
+def test_transfer_needs_a_cached_template():
+    template = make_template()
+    image = draw_frames(template.artifact_bboxes + template.hero_bboxes)
+    header = make_header(*HEADER)
+
+    layout_cache = layouts.LayoutCache()
+    assert layout_cache.transfer(image, header, template.artifact_bboxes) is None
+
+    layout_cache.put(template)
+    layout = layout_cache.transfer(image, header, template.artifact_bboxes)
+    assert layout is not None
+    assert layout_cache.stats()['transfers'] == 1
+
+
+def test_cache_hit():
+    template = make_template()
+    image = draw_frames(template.artifact_bboxes + template.hero_bboxes)
+    layout_cache = layouts.LayoutCache()
+    layout_cache.put(template)
+
+    # the header is read a few px off from screenshot to screenshot
+    assert layout_cache.get(image, make_header(HEADER[0] + 2, HEADER[1] - 2)) is template
+    assert layout_cache.stats()['hits'] == 1
+
+
+def test_cache_rejects_a_shifted_or_other_scoreboard():
+    template = make_template()
+    layout_cache = layouts.LayoutCache()
+    layout_cache.put(template)
+    header = make_header(*HEADER)
+
+    shifted = draw_frames(move(template.artifact_bboxes + template.hero_bboxes, 1.0, (8, 6)))
+    assert layout_cache.get(shifted, header) is None
+
+    # same resolution and header, artifacts laid out differently
+    artifact_bboxes = [(1480 + col * 80, 90 + row * 115, ARTIFACT_SIZE, ARTIFACT_SIZE)
+                       for row in range(8) for col in range(3)]
+    other = draw_frames(artifact_bboxes + template.hero_bboxes)
+    assert layout_cache.get(other, header) is None
+
+    assert layout_cache.get(draw_frames([]), header) is None
+    stats = layout_cache.stats()
+    assert (stats['hits'], stats['rejects'], stats['misses']) == (0, 3, 0)
+
+
+def test_cache_miss():
+    template = make_template()
+    layout_cache = layouts.LayoutCache()
+    image = draw_frames(template.artifact_bboxes + template.hero_bboxes)
+    header = make_header(*HEADER)
+    assert layout_cache.get(image, header) is None
+
+    layout_cache.put(template)
+    # header moved past the tolerance, another resolution, no header
+    assert layout_cache.get(image, make_header(HEADER[0] + 20, HEADER[1])) is None
+    assert layout_cache.get(draw_frames([], shape=(1080, 2400)), header) is None
+    assert layout_cache.get(image, None) is None
+    assert layout_cache.stats()['misses'] == 3
+
+
+def test_cache_evicts_the_least_recently_used():
+    template = make_template()
+    layout_cache = layouts.LayoutCache(max_layouts=2)
+    for x in (100, 200, 300):
+        layout_cache.put(layouts.Layout((1080, 1920, x, 40), template.artifact_bboxes, template.hero_bboxes))
+    assert len(layout_cache) == 2
+
+    image = draw_frames(template.artifact_bboxes + template.hero_bboxes)
+    assert layout_cache.get(image, make_header(100, 40)) is None
+    assert layout_cache.get(image, make_header(300, 40)) is not None
+
+
+def test_solve_layout_only_caches_complete_detections():
+    template = make_template()
+    image = draw_frames(template.artifact_bboxes + template.hero_bboxes)
+    header = make_header(*HEADER)
+
+    layout = layouts.solve_layout(image, header, template.artifact_bboxes, template.hero_bboxes, [])
+    assert layout is not None and layout.fingerprint == template.fingerprint
+    assert layouts.solve_layout(image, header, template.artifact_bboxes[1:], template.hero_bboxes, []) is None
+    assert layouts.solve_layout(draw_frames([]), header, template.artifact_bboxes, template.hero_bboxes, []) is None
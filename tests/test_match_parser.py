@@ -0,0 +1,41 @@
+import os
+
+import cv2
+import numpy as np
+
+from matchparse import hashes, resolution
+from matchparse.match_parser import Player
+
+
+def test_icons_are_saved_from_the_original_screenshot(tmp_path):
+    rng = np.random.default_rng(0)
+    blocks = rng.integers(0, 256, (54, 96, 3), dtype=np.uint8)
+    original = cv2.resize(blocks, (1920 * 2, 1080 * 2), interpolation=cv2.INTER_NEAREST)
+    working, scale = resolution.normalize_image(original)
+    assert scale == 0.5
+
+    player = Player('name', 1, 150)
+    player.hero_bbox = (100, 100, 80, 80)
+    player.hero_guess = hashes.UNKNOWN_HERO
+    player.hero_hash = hashes.get_icon_hash(working, player.hero_bbox)
+    player.artifact_bboxes = [(1500, 100, 50, 50), (1570, 100, 50, 50)]
+    player.artifact_hashes = hashes.get_icon_hashes(working, player.artifact_bboxes)
+    player.unknown_artifact_indexes = [1]
+    player.genre_bboxes = [(1000, 100, 60, 60)]
+
+    player.save_icons(original, str(tmp_path), lambda bbox: resolution.to_original_bbox(bbox, scale))
+
+    expected = {'heroes': [((200, 200, 160, 160), True)],
+                'artifacts': [((3000, 200, 100, 100), False), ((3140, 200, 100, 100), True)],
+                'genres': [((2000, 200, 120, 120), False)],
+                }
+    for icon_type, icons in expected.items():
+        filenames = sorted(os.listdir(tmp_path / icon_type))
+        expected_filenames = sorted(f'{hashes.get_icon_hash(original, bbox)}_{icon_type}_{bbox[2]}x{bbox[3]}'
+                                    f'{"_u" if is_unknown else ""}.png' for bbox, is_unknown in icons)
+        assert filenames == expected_filenames
+        for bbox, is_unknown in icons:
+            x, y, w, h = bbox
+            filename = f'{hashes.get_icon_hash(original, bbox)}_{icon_type}_{w}x{h}{"_u" if is_unknown else ""}.png'
+            saved = cv2.imread(str(tmp_path / icon_type / filename))
+            assert np.array_equal(saved, original[y:y+h, x:x+w])
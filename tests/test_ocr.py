@@ -0,0 +1,148 @@
+import threading
+
+import cv2
+
+import numpy as np
+import pytest
+
+from matchparse import ocr
+from matchparse.ocr_cache import CachingBackend, OCRCache
+
+
+class FakeReader:
+    """Reads every image as its own id."""
+
+    def __init__(self, reader_id):
+        self.reader_id = reader_id
+
+    def readtext(self, image, **kwargs):
+        return [([[0, 0], [1, 0], [1, 1], [0, 1]], str(self.reader_id), 1.0)]
+
+
+class FakeReaderPool(ocr.ReaderPool):
+
+    def __init__(self, size):
+        super().__init__(size, warmup=False)
+        self.num_acquires = 0
+
+    def _create(self):
+        return FakeReader(self._num_created)
+
+    def acquire(self):
+        self.num_acquires += 1
+        return super().acquire()
+
+
+def read_id(backend, value=0):
+    return backend.readtext(np.full((4, 4), value, dtype=np.uint8))[0][1]
+
+
+def test_held_reader_is_used_for_the_whole_parse():
+    pool = FakeReaderPool(2)
+    backend = ocr.PooledBackend(pool).for_image('a.png')
+    with backend.hold():
+        reader_ids = {read_id(backend, value) for value in range(5)}
+        # another parse at the same time gets the other reader
+        assert read_id(ocr.PooledBackend(pool).for_image('b.png')) not in reader_ids
+    assert len(reader_ids) == 1
+    assert pool.num_acquires == 2
+
+    # without hold every call goes to the pool
+    for _ in range(3):
+        read_id(backend)
+    assert pool.num_acquires == 5
+
+
+def test_wrapped_backends_hold_the_pooled_reader(tmp_path):
+    pool = FakeReaderPool(1)
+    backend = ocr.RecordingBackend(CachingBackend(ocr.PooledBackend(pool), OCRCache()), str(tmp_path))
+    backend = backend.for_image('a.png')
+    with backend.hold():
+        for value in range(3):
+            read_id(backend, value)
+        # the only reader is taken
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (read_id(ocr.PooledBackend(pool)), acquired.set()))
+        thread.start()
+        assert not acquired.wait(0.1)
+    thread.join(1)
+    assert acquired.is_set()
+    assert pool.num_acquires == 2
+
+
+def test_reader_pool_refuses_a_different_configuration(monkeypatch):
+    monkeypatch.setattr(ocr, '_POOL', None)
+    pool = ocr.get_reader_pool(2, quantize=False)
+    assert ocr.get_reader_pool() is pool
+    assert ocr.get_reader_pool(2, quantize=False) is pool
+
+    with pytest.raises(ValueError):
+        ocr.get_reader_pool(3)
+    with pytest.raises(ValueError):
+        ocr.get_reader_pool(quantize=True)
+
+
+def draw_latin(text='Player Name'):
+    gray = np.full((32, 200), 30, dtype=np.uint8)
+    cv2.putText(gray, text, (4, 22), cv2.FONT_HERSHEY_SIMPLEX, 0.7, 230, 2)
+    return gray
+
+
+def draw_cjk_like(num_chars=4):
+    """Glyphs made of stacked horizontal strokes and a vertical one, like most CJK characters."""
+    gray = np.full((32, 30 * num_chars + 8), 30, dtype=np.uint8)
+    for i in range(num_chars):
+        x = 4 + 30 * i
+        for y in range(5, 28, 5):
+            cv2.line(gray, (x, y), (x + 22, y), 230, 2)
+        cv2.line(gray, (x + 11, 3), (x + 11, 29), 230, 2)
+    return gray
+
+
+class FakeRecognizer:
+
+    def __init__(self, languages, results):
+        self.languages = languages
+        self.results = results
+        self.crops = []
+
+    def read(self, crops):
+        self.crops.extend(crops)
+        return [self.results(crop) for crop in crops]
+
+
+def test_script_check():
+    assert not ocr.is_non_latin(draw_latin())
+    assert not ocr.is_non_latin(draw_latin('12 40 99'))
+    assert ocr.is_non_latin(draw_cjk_like())
+
+
+def test_chinese_recognizer_is_loaded_for_unconfident_non_latin_crops(monkeypatch):
+    created = []
+
+    def create_reader(languages=ocr.LANGUAGES, warmup=True, detector=True, quantize=True):
+        # the English reader is unsure of everything, the Chinese one only of Latin text
+        if ocr._is_chinese(languages):
+            reader = FakeRecognizer(languages, lambda crop: ('中文', 0.3 if ocr.is_non_latin(crop) else 0.1))
+        else:
+            reader = FakeRecognizer(languages, lambda crop: ('Name', 0.2))
+        created.append(reader)
+        return reader
+
+    monkeypatch.setattr(ocr, 'create_reader', create_reader)
+    monkeypatch.setattr(ocr, 'recognize_crops', lambda reader, crops, **kwargs: reader.read(crops))
+
+    lazy_reader = ocr.LazyReader(warmup=False)
+    latin, cjk = draw_latin(), draw_cjk_like()
+    # digits and explicitly English reads never need it
+    assert lazy_reader.recognize_crops([cjk], allowlist='0123456789') == [('Name', 0.2)]
+    assert lazy_reader.recognize_crops([cjk], languages=ocr.ENGLISH) == [('Name', 0.2)]
+    assert lazy_reader.recognize_crops([latin, latin]) == [('Name', 0.2)] * 2
+    assert not lazy_reader.is_chinese_loaded
+
+    # only the non-Latin crop is retried, the more confident read wins
+    assert lazy_reader.recognize_crops([latin, cjk]) == [('Name', 0.2), ('中文', 0.3)]
+    assert lazy_reader.is_chinese_loaded
+    chinese = lazy_reader.chinese
+    assert len(chinese.crops) == 1 and chinese.crops[0] is cjk
+    assert [reader.languages for reader in created] == [ocr.ENGLISH, ocr.CHINESE]
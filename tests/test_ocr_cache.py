@@ -0,0 +1,140 @@
+import cv2
+
+import numpy as np
+
+from matchparse import ocr
+from matchparse.ocr_cache import COMPACT_RATIO, CachingBackend, OCRCache, _entry_size, get_crop_key
+
+
+class CountingBackend(ocr.OCRBackend):
+    """Reads every crop as its mean brightness, counting the crops it was given."""
+
+    def __init__(self):
+        self.num_crops = 0
+
+    def readtext(self, image, languages=None, **kwargs):
+        return []
+
+    def recognize_crops(self, crops, allowlist=None, batch_size=ocr.DEFAULT_BATCH_SIZE, languages=None):
+        self.num_crops += len(crops)
+        return [(str(int(crop.mean())), 0.9) for crop in crops]
+
+
+def draw_text(text, noise_seed=None):
+    crop = np.full((24, 80), 40, dtype=np.uint8)
+    cv2.putText(crop, text, (4, 18), cv2.FONT_HERSHEY_SIMPLEX, 0.6, 230, 2)
+    if noise_seed is not None:
+        rng = np.random.default_rng(noise_seed)
+        crop = np.clip(crop.astype(int) + rng.integers(-3, 4, crop.shape), 0, 255).astype(np.uint8)
+    return crop
+
+
+def count_lines(filepath):
+    with open(filepath, encoding='utf-8') as f:
+        return sum(1 for _ in f)
+
+
+def test_evicts_least_recently_used_by_bytes():
+    entries = [(f'key{i}', ['12', 0.9]) for i in range(4)]
+    cache = OCRCache(max_bytes=3 * _entry_size(*entries[0]))
+    for key, value in entries[:3]:
+        cache.put(key, value)
+    assert len(cache) == 3
+
+    # key0 was used last, key1 goes first
+    assert cache.get('key0') == ['12', 0.9]
+    cache.put(*entries[3])
+    assert len(cache) == 3
+    assert cache.get('key1') is None
+    assert cache.get('key0') is not None
+    assert cache.bytes_used <= cache.max_bytes
+
+    # an entry bigger than the whole cache does not stay
+    cache.put('big', ['x' * cache.max_bytes, 0.9])
+    assert cache.get('big') is None
+    assert cache.bytes_used == 0
+
+
+def test_reloads_from_the_journal(tmp_path):
+    filepath = str(tmp_path / 'ocr_cache.jsonl')
+    cache = OCRCache(filepath=filepath)
+    cache.put('a', ['1', 0.9])
+    cache.put('b', ['2', 0.8])
+    cache.save()
+    cache.put('c', ['3', 0.7])
+    cache.save()
+    # only the new entry was appended
+    assert count_lines(filepath) == 3
+
+    # a line cut short by a crash is skipped
+    with open(filepath, 'a', encoding='utf-8') as f:
+        f.write('["d", ["4"')
+
+    loaded = OCRCache(filepath=filepath)
+    assert len(loaded) == 3
+    assert loaded.get('b') == ['2', 0.8]
+    assert loaded.take_unsaved() == []
+
+
+def test_reload_keeps_the_lru_order(tmp_path):
+    filepath = str(tmp_path / 'ocr_cache.jsonl')
+    cache = OCRCache(filepath=filepath)
+    for key in 'abc':
+        cache.put(key, [key, 0.9])
+    cache.get('a')
+    # rewritten from scratch: the file did not exist
+    cache.save()
+
+    loaded = OCRCache(max_bytes=2 * _entry_size('a', ['a', 0.9]), filepath=filepath)
+    assert len(loaded) == 2
+    assert loaded.get('b') is None
+    assert loaded.get('a') is not None
+
+
+def test_compacts_the_journal_at_the_ratio(tmp_path):
+    filepath = str(tmp_path / 'ocr_cache.jsonl')
+    cache = OCRCache(filepath=filepath)
+    cache.put('a', ['1', 0.9])
+    cache.put('b', ['2', 0.9])
+    cache.save()
+    assert count_lines(filepath) == 2
+
+    # rewriting the same keys only appends until the journal holds COMPACT_RATIO times the entries
+    num_lines = 2
+    while num_lines + 1 <= COMPACT_RATIO * len(cache):
+        cache.put('a', [str(num_lines), 0.9])
+        cache.save()
+        num_lines += 1
+        assert count_lines(filepath) == num_lines
+
+    cache.put('a', ['last', 0.9])
+    cache.save()
+    assert count_lines(filepath) == len(cache) == 2
+
+    loaded = OCRCache(filepath=filepath)
+    assert loaded.get('a') == ['last', 0.9]
+    assert loaded.get('b') == ['2', 0.9]
+
+
+def test_perceptual_keys_ignore_noise():
+    assert get_crop_key(draw_text('12'), 'perceptual') == get_crop_key(draw_text('12', noise_seed=0), 'perceptual')
+    assert get_crop_key(draw_text('12'), 'exact') != get_crop_key(draw_text('12', noise_seed=0), 'exact')
+    assert get_crop_key(draw_text('12'), 'perceptual') != get_crop_key(draw_text('40'), 'perceptual')
+
+
+def test_names_are_never_served_from_a_perceptual_key():
+    backend = CountingBackend()
+    caching_backend = CachingBackend(backend, OCRCache(), key_type='perceptual')
+    crops = [draw_text('12'), draw_text('12', noise_seed=0)]
+
+    # digits: the noisy crop is answered from the cache, identical crops are read once
+    caching_backend.recognize_crops(crops + crops[:1], allowlist='0123456789')
+    assert backend.num_crops == 1
+    caching_backend.recognize_crops(crops, allowlist='0123456789')
+    assert backend.num_crops == 1
+
+    # names: the noisy crop is read again
+    caching_backend.recognize_crops(crops)
+    assert backend.num_crops == 3
+    caching_backend.recognize_crops(crops)
+    assert backend.num_crops == 3
@@ -0,0 +1,116 @@
+import cv2
+
+import numpy as np
+
+from matchparse import ocr, placements
+
+HEADER = (placements.to_easyocr_bbox(100, 52, 166, 70), 'PLAYER', 0.99)
+ROW_SPACING = 40
+NAMES = ['Alpha', 'Bravo', 'Charlie', 'Delta', 'Echo', 'Foxtrot', 'Golf', 'Hotel']
+
+
+def get_row_centers():
+    first = 70 + placements.FIRST_SPACING_FACTOR * ROW_SPACING
+    return [first + i * ROW_SPACING for i in range(placements.EXPECTED_PLAYERS)]
+
+
+def draw_scoreboard(is_marked=False):
+    """The "PLAYER" header and the 8 names under it, optionally with a marker left of the names."""
+    image = np.full((440, 600, 3), 30, dtype=np.uint8)
+    cv2.putText(image, 'PLAYER', (100, 68), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (230, 230, 230), 1)
+    for name, y_center in zip(NAMES, get_row_centers()):
+        cv2.putText(image, name, (110, int(y_center) + 6), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (230, 230, 230), 1)
+        if is_marked:
+            cv2.rectangle(image, (76, int(y_center) - 4), (84, int(y_center) + 4), (230, 230, 230), -1)
+    return image
+
+
+class FakeNameOCR(ocr.OCRBackend):
+    """Recognizes the crops as ``texts`` and detects every ink line, the topmost read as the header."""
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.crops = []
+        self.readtext_shapes = []
+
+    def recognize_crops(self, crops, allowlist=None, batch_size=ocr.DEFAULT_BATCH_SIZE, languages=None):
+        self.crops.extend(crops)
+        return [self.texts[i % len(self.texts)] for i in range(len(crops))]
+
+    def readtext(self, image, languages=None, **kwargs):
+        self.readtext_shapes.append(image.shape)
+        ink = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) > 128
+        ink_rows = np.flatnonzero(ink.any(axis=1))
+        lines = np.split(ink_rows, np.flatnonzero(np.diff(ink_rows) > 1) + 1) if len(ink_rows) else []
+
+        results = []
+        for i, rows in enumerate(lines):
+            xs = np.flatnonzero(ink[rows[0]:rows[-1] + 1].any(axis=0))
+            text = 'PLAYER' if i == 0 else f'line{i}'
+            results.append((placements.to_easyocr_bbox(int(xs[0]), int(rows[0]), int(xs[-1]) + 1, int(rows[-1]) + 1),
+                            text, 0.9))
+        return results
+
+
+def test_low_confidence_rows_fall_back_to_detection_on_the_name_column():
+    image = draw_scoreboard()
+    backend = FakeNameOCR([(name, 0.2 if name == 'Delta' else 0.9) for name in NAMES])
+    results = placements.read_player_names(image, backend, row_spacing=ROW_SPACING, header=HEADER)
+
+    # detection ran once, on the name column under the header rather than the whole image
+    x0, y0, x1, y1 = placements.get_name_column_roi(HEADER, image.shape[1], image.shape[0])
+    assert backend.readtext_shapes == [(y1 - y0, x1 - x0, 3)]
+    assert (x1 - x0) < image.shape[1]
+
+    # the detected boxes are back in image coordinates
+    player_placements = placements.get_player_placements(results)
+    assert [p[1] for p in player_placements] == [f'line{i}' for i in range(1, 9)]
+    for (_, _, _, y_center, _), expected in zip(player_placements, get_row_centers()):
+        assert abs(y_center - expected) < 5
+
+
+def test_reads_the_whole_image_without_a_header():
+    image = draw_scoreboard()
+    backend = FakeNameOCR([('', 0.0)])
+    placements.read_player_names(image, backend, row_spacing=ROW_SPACING)
+    # the locator only recognized the candidate lines, none of them was the header
+    assert backend.crops
+    assert backend.readtext_shapes == [image.shape]
+
+
+def test_confident_predicted_rows_skip_detection():
+    image = draw_scoreboard()
+    backend = FakeNameOCR([(name, 0.9) for name in NAMES])
+    results = placements.read_player_names(image, backend, row_spacing=ROW_SPACING, header=HEADER)
+    assert backend.readtext_shapes == []
+    assert len(backend.crops) == placements.EXPECTED_PLAYERS
+
+    player_placements = placements.get_player_placements(results)
+    assert [p[1] for p in player_placements] == NAMES
+    assert [p[0] for p in player_placements] == list(range(1, 9))
+
+
+def test_predicted_rows_follow_the_header():
+    rows = placements.predict_name_rows(HEADER, ROW_SPACING, max_x=200)
+    assert len(rows) == placements.EXPECTED_PLAYERS
+    for (x0, y0, x1, y1), y_center in zip(rows, get_row_centers()):
+        assert x1 == 200
+        assert abs((y0 + y1) / 2 - y_center) <= 1
+        assert abs((y1 - y0) - placements.NAME_ROW_HEIGHT * 18) <= 1
+
+
+def test_tightened_box_ignores_marks_left_of_the_column():
+    gray = cv2.cvtColor(draw_scoreboard(is_marked=True), cv2.COLOR_BGR2GRAY)
+    y_center = int(get_row_centers()[0])
+    box = (60, y_center - 14, 300, y_center + 14)
+
+    # without the column the marker is the start of the text
+    x0, _, x1, _ = placements.tighten_text_box(gray, box)
+    assert x0 < 80
+
+    x0, y0, x1, y1 = placements.tighten_text_box(gray, box, column=(100, 166))
+    assert 100 <= x0 <= 110
+    assert 150 < x1 < 300
+    assert (y0, y1) == box[1:4:2]
+
+    assert placements.tighten_text_box(gray, (300, 10, 400, 40)) is None
@@ -0,0 +1,16 @@
+import os
+
+from matchparse import quantize
+
+
+def test_samples_are_the_most_recent_screenshots(tmp_path):
+    assert quantize.get_sample_filepaths(str(tmp_path / 'missing')) == []
+    assert quantize.get_sample_filepaths(str(tmp_path)) == []
+
+    for i, fn in enumerate(['c.png', 'a.jpg', 'b.png', 'notes.txt']):
+        filepath = tmp_path / fn
+        filepath.write_bytes(b'')
+        os.utime(filepath, (i, i))
+
+    sample_filepaths = quantize.get_sample_filepaths(str(tmp_path), max_samples=2)
+    assert [os.path.basename(fp) for fp in sample_filepaths] == ['a.jpg', 'b.png']
@@ -0,0 +1,101 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from matchparse import hashes, reference_index
+
+
+@pytest.fixture
+def index_path(tmp_path, monkeypatch):
+    """An index path the process-wide library is loaded from, restored after the test."""
+    monkeypatch.setattr(reference_index, '_INDEX_PATH', reference_index._INDEX_PATH)
+    monkeypatch.setattr(reference_index, '_LIBRARY', None)
+    filepath = str(tmp_path / 'reference_index.bin')
+    reference_index.set_index_path(filepath)
+    return filepath
+
+
+def write_icons(icon_dir, names, size=40, seed=0):
+    """One random blocky artifact icon PNG per name."""
+    rng = np.random.default_rng(seed)
+    for name in names:
+        block = rng.integers(0, 256, (5, 5, 3), dtype=np.uint8)
+        icon = np.kron(block, np.ones((size // 5, size // 5, 1), dtype=np.uint8))
+        os.makedirs(icon_dir / 'artifacts' / name)
+        cv2.imwrite(str(icon_dir / 'artifacts' / name / 'icon.png'), icon)
+
+
+def test_built_index_round_trips_the_tables(tmp_path):
+    index = reference_index.build_index(str(tmp_path / 'reference_index.bin'))
+    assert reference_index.load_index(index.filepath).library_version == index.library_version
+    assert not index.has_dhashes
+
+    # the arrays are views of the read-only memory map, not copies
+    assert not index.arrays['words'].flags.writeable
+    assert np.shares_memory(index.arrays['words'], index._mmap)
+
+    tables_library = reference_index.ReferenceLibrary()
+    partitions = list(index.iter_partitions())
+    assert partitions == list(tables_library.iter_partitions())
+    for icon_type, hero, color in partitions:
+        table = index.get_table(icon_type, hero, color)
+        expected = tables_library.get_table(icon_type, hero, color)
+        assert table.infos == expected.infos
+        assert np.array_equal(table.words, expected.words)
+        # name ids are numbered across the index, the same rows still share them
+        assert np.array_equal(table.name_ids == table.name_ids[:, None],
+                              expected.name_ids == expected.name_ids[:, None])
+
+
+def test_index_of_changed_tables_is_ignored(tmp_path, monkeypatch):
+    filepath = str(tmp_path / 'reference_index.bin')
+    reference_index.build_index(filepath)
+    monkeypatch.setattr(hashes, 'GENRES', dict(hashes.GENRES, New=['0' * 25]))
+    assert reference_index.load_index(filepath) is None
+    assert reference_index.ReferenceIndex(filepath).is_stale()
+
+
+def test_index_built_from_icons_has_dhashes(tmp_path):
+    write_icons(tmp_path / 'icons', ['Alpha', 'Beta', 'Gamma'])
+    index = reference_index.build_index(str(tmp_path / 'reference_index.bin'), str(tmp_path / 'icons'),
+                                        is_icons_only=True)
+    assert index.source == 'icons'
+    assert reference_index.ReferenceLibrary(index).has_dhashes
+
+    table = index.get_table('artifact')
+    assert sorted(info.name for info in table.infos) == ['Alpha', 'Beta', 'Gamma']
+    assert table.has_dhash.all()
+
+    icon = cv2.imread(str(tmp_path / 'icons' / 'artifacts' / 'Beta' / 'icon.png'))
+    icon_hash = hashes.get_icon_hashes(icon, [(0, 0, 40, 40)])[0]
+    rows, distances = table.find_within(icon_hash, hashes.HAMMING_ARTIFACT_THRESHOLD)
+    assert [table.infos[row].name for row in rows[distances == 0]] == ['Beta']
+
+
+def test_watcher_swaps_in_a_rebuilt_index(index_path):
+    reference_index.build_index(index_path, library_version='v1')
+    old_library = reference_index.get_reference_library()
+    assert old_library.version == 'v1'
+
+    watcher = reference_index.ReferenceWatcher(index_path)
+    assert not watcher.check()
+
+    reference_index.build_index(index_path, library_version='v2')
+    assert watcher.check()
+    assert reference_index.get_reference_library().version == 'v2'
+    # parses that started before the reload keep reading the old library
+    assert old_library.version == 'v1'
+    assert len(old_library.get_table('artifact')) == len(reference_index.get_reference_library().get_table('artifact'))
+
+
+def test_failed_reload_keeps_the_active_library(index_path):
+    reference_index.build_index(index_path, library_version='v1')
+    watcher = reference_index.ReferenceWatcher(index_path)
+    library = reference_index.get_reference_library()
+
+    with open(index_path, 'wb') as f:
+        f.write(b'not an index')
+    assert not watcher.check()
+    assert reference_index.get_reference_library() is library
@@ -0,0 +1,38 @@
+import cv2
+
+from matchparse import threads
+
+
+def test_budget_splits_the_threads_between_the_parsers():
+    assert threads.ThreadBudget(8, 3).threads_per_parser == 2
+    assert threads.ThreadBudget(8, 0).num_parsers == 1
+    # never less than one thread per parser
+    assert threads.ThreadBudget(2, 4).threads_per_parser == 1
+
+
+def test_workers_get_contiguous_slices_of_the_allowed_cores(monkeypatch):
+    monkeypatch.setattr(threads.os, 'sched_getaffinity', lambda pid: {2, 3, 5, 7, 11, 13}, raising=False)
+    budget = threads.ThreadBudget(6, 3, pin=True)
+    assert [budget.get_cores(i) for i in range(3)] == [[2, 3], [5, 7], [11, 13]]
+    # more workers than cores wrap around
+    assert budget.get_cores(4) == [5, 7]
+
+    budget = threads.ThreadBudget(4, 4)
+    assert [budget.get_cores(i) for i in range(6)] == [[2], [3], [5], [7], [11], [13]]
+
+
+def test_apply_sets_the_pools_and_pins_only_workers(monkeypatch):
+    monkeypatch.setattr(threads.os, 'sched_getaffinity', lambda pid: {0, 1, 2, 3}, raising=False)
+    pinned = []
+    monkeypatch.setattr(threads.os, 'sched_setaffinity', lambda pid, cores: pinned.append(cores), raising=False)
+    num_threads = cv2.getNumThreads()
+    try:
+        budget = threads.ThreadBudget(4, 2, pin=True)
+        budget.apply()
+        assert cv2.getNumThreads() == 2
+        assert pinned == []
+
+        budget.apply(worker_index=1)
+        assert pinned == [[2, 3]]
+    finally:
+        cv2.setNumThreads(num_threads)
@@ -0,0 +1,40 @@
+import numpy as np
+
+from matchparse import traits
+
+
+def draw_trait_icons(seed, num_icons=24, size=30):
+    """Icons in a noisy trait color (plus some pixels in the yellow/lime green overlap) on a dark background."""
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 80, (size * 4, size * (num_icons // 4 + 1), 3), dtype=np.uint8)
+    colors = list(traits.TRAIT_COLORS.values())
+    bboxes = []
+    for i in range(num_icons):
+        x, y = size * (i // 4), size * (i % 4)
+        r, g, b = colors[i % len(colors)]
+        noise = rng.integers(-25, 26, (size - 6, size - 6, 3))
+        image[y+3:y+size-3, x+3:x+size-3] = np.clip(noise + (b, g, r), 0, 255)
+        # within range of both yellow and lime green
+        image[y+3:y+8, x+3:x+8] = (53, 238, 237)
+        bboxes.append((x, y, size, size))
+    return image, bboxes
+
+
+def test_color_map_matches_the_per_bbox_masks():
+    for seed in range(5):
+        image, bboxes = draw_trait_icons(seed)
+        height, width = image.shape[:2]
+        # also bboxes crossing the right and bottom edges
+        bboxes += [(width - 10, 5, 30, 30), (5, height - 12, 30, 30)]
+        color_map = traits.TraitColorMap(image, bboxes)
+        for bbox in bboxes:
+            expected_color, expected_percent = traits.determine_primary_bbox_color(image, bbox)
+            color, percent = color_map.determine_primary_color(bbox)
+            assert (color, round(percent, 9)) == (expected_color, round(expected_percent, 9)), (seed, bbox)
+
+
+def test_split_by_color():
+    image, bboxes = draw_trait_icons(0, num_icons=8)
+    color2bboxes = traits.split_trait_bboxes_by_color(image, bboxes)
+    assert {color: len(color_bboxes) for color, color_bboxes in color2bboxes.items()} == \
+        dict.fromkeys(traits.TRAIT_COLORS, 2)
@@ -0,0 +1,75 @@
+import cv2
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from matchparse import digits, match_parser, ocr, threads, workers
+from matchparse.ocr_cache import OCRCache
+
+
+def draw_digit(char):
+    crop = np.full((28, 32), 40, dtype=np.uint8)
+    cv2.putText(crop, char, (6, 22), cv2.FONT_HERSHEY_SIMPLEX, 0.8, 230, 2)
+    return crop
+
+
+class FakeMatchParser:
+    """Adds an OCR cache entry and learns a "9" glyph per image, like a parse would."""
+
+    def __init__(self, image_filepath, reader=None):
+        self.image_filepath = image_filepath
+        self.reader = reader
+
+    def run(self, output_dir, is_save_icons):
+        self.reader.cache.put(self.image_filepath, ('12', 0.9))
+        digits.get_digit_reader().learn(draw_digit('9'), '9')
+
+    def to_df(self):
+        return pd.DataFrame({'image': [self.image_filepath]})
+
+
+@pytest.fixture
+def digit_reader(monkeypatch):
+    atlas = {digit: np.stack(digits.segment_digits(draw_digit(str(digit)))) for digit in range(9)}
+    digit_reader = digits.DigitReader(atlas)
+    monkeypatch.setattr(digits, '_DIGIT_READER', digit_reader)
+    return digit_reader
+
+
+def test_collect_merges_what_the_worker_learned(digit_reader):
+    ocr_cache = OCRCache()
+    worker_pool = workers.ParserWorkerPool(2, ocr_cache=ocr_cache)
+    glyph = digits.segment_digits(draw_digit('9'))[0]
+    df = pd.DataFrame({'image': ['a.png']})
+    memory = {'pid': 123, 'rss_mb': 1.0, 'pss_mb': 1.0, 'unique_mb': 1.0, 'shared_mb': 0.0}
+
+    assert worker_pool._collect((df, memory, [('key', ('12', 0.9))], [(9, glyph)])) is df
+    assert ocr_cache.get('key') == ('12', 0.9)
+    # the parent saves both
+    assert ocr_cache.take_unsaved() == [('key', ('12', 0.9))]
+    assert digit_reader.is_complete
+    assert worker_pool.memory_report()['workers'] == [memory]
+
+
+def test_forked_workers_send_their_cache_entries_and_glyphs_back(digit_reader, monkeypatch):
+    monkeypatch.setattr(workers, 'preload', lambda quantize: None)
+    monkeypatch.setattr(match_parser, 'MatchParser', FakeMatchParser)
+    monkeypatch.setattr(ocr, '_POOL', None)
+
+    ocr_cache = OCRCache()
+    # unsaved in the parent before the fork, the workers must not send it back again
+    ocr_cache.put('parent', ('1', 0.9))
+    merged = []
+    monkeypatch.setattr(ocr_cache, 'merge', lambda entries: (merged.extend(entries), OCRCache.merge(ocr_cache, entries)))
+    thread_budget = threads.ThreadBudget(2, 2)
+    with workers.ParserWorkerPool(2, thread_budget=thread_budget, ocr_cache=ocr_cache) as worker_pool:
+        dfs = worker_pool.parse_many(['a.png', 'b.png', 'c.png'])
+    assert [df['image'][0] for df in dfs] == ['a.png', 'b.png', 'c.png']
+
+    assert sorted(key for key, _ in merged) == ['a.png', 'b.png', 'c.png']
+    assert sorted(key for key, _ in ocr_cache.take_unsaved()) == ['a.png', 'b.png', 'c.png', 'parent']
+    # every worker learned the "9" on its own, the parent keeps one copy
+    assert digit_reader.is_complete
+    assert len(digit_reader.atlas[9]) == 1
+    assert digit_reader.counts['rejected'] == 0